@@ -0,0 +1,115 @@
+import os
+import re
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# Builds the synthetic aggregate (meter1.csv) out of the submeter csvs.
+# Replaces Constructed_Data_12Hour/aggregateAllCSV.py: rows are matched by
+# timestamp instead of by position and summed as one time x meter array,
+# reading every submeter in chunks so the whole recording never sits in memory.
+#
+# to run (from the repo root)
+# python SeniorDataset/aggregateCSV.py SeniorDataset/building1/elec
+
+CHUNKSIZE = 1000000
+
+
+def read_submeter(filename, chunksize=CHUNKSIZE):
+    '''Reads the timestamp and first value column of a meter#.csv in chunks
+
+    Yields: (int64 timestamps, float64 watts), NaNs read as 0
+    '''
+    reader = pd.read_csv(filename, header=None, skiprows=2, usecols=[0, 1], names=['timestamp', 'power'],
+                         dtype={'timestamp': np.int64, 'power': np.float64}, chunksize=chunksize,
+                         encoding='utf-8-sig')
+    for chunk in reader:
+        yield chunk['timestamp'].values, np.nan_to_num(chunk['power'].values)
+
+
+def aggregate_chunks(csv_files, chunksize=CHUNKSIZE):
+    '''Sums submeters on their timestamps, chunk by chunk
+
+    Every step only aggregates the timestamps up to the smallest last
+    timestamp read so far, so later chunks can't add to rows already
+    emitted. A meter missing a timestamp adds 0 to it.
+
+    Parameters
+    ----------
+    csv_files : list of meter#.csv files, each sorted by timestamp
+    chunksize : number of rows read from each file at once
+
+    Yields: (timestamps, watts) of the aggregate
+    '''
+    readers = [read_submeter(f, chunksize) for f in csv_files]
+    n = len(readers)
+    empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+    buffers = [empty] * n
+    exhausted = [False] * n
+
+    while True:
+        # Make sure every unfinished meter has buffered data
+        for i in range(n):
+            while not exhausted[i] and len(buffers[i][0]) == 0:
+                try:
+                    buffers[i] = next(readers[i])
+                except StopIteration:
+                    exhausted[i] = True
+        if all(len(b[0]) == 0 for b in buffers):
+            return
+
+        ends = [b[0][-1] for i, b in enumerate(buffers) if not exhausted[i]]
+        safe = min(ends) if ends else np.iinfo(np.int64).max
+
+        parts = []
+        for i in range(n):
+            t, v = buffers[i]
+            cut = np.searchsorted(t, safe, side='right')
+            parts.append((t[:cut], v[:cut]))
+            buffers[i] = (t[cut:], v[cut:])
+
+        timestamps = np.unique(np.concatenate([p[0] for p in parts]))
+        matrix = np.zeros((len(timestamps), n))
+        for i, (t, v) in enumerate(parts):
+            matrix[np.searchsorted(timestamps, t), i] = v
+        yield timestamps, matrix.sum(axis=1)
+
+
+def aggregate(csv_files, outfile, chunksize=CHUNKSIZE):
+    '''Writes the sum of `csv_files` to `outfile` in the meter#.csv form
+
+    Returns: number of rows written
+    '''
+    rows = 0
+    with open(outfile, 'w', newline='') as csvfile:
+        csvfile.write('timestamp,power\n,apparent\n')
+        for timestamps, watts in aggregate_chunks(csv_files, chunksize):
+            df = pd.DataFrame({'timestamp': timestamps, 'power': watts})
+            df.to_csv(csvfile, header=False, index=False, float_format='%.3f')
+            rows += len(df)
+    return rows
+
+
+def find_submeters(path, site_meter=1):
+    '''Returns the meter#.csv files of `path` other than the site meter, in meter order'''
+    meters = []
+    for f in os.listdir(path):
+        match = re.match(r'meter(\d+)\.csv$', f)
+        if match and int(match.group(1)) != site_meter:
+            meters.append((int(match.group(1)), os.path.join(path, f)))
+    return [f for _, f in sorted(meters)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build meter1.csv as the sum of the submeter csvs')
+    parser.add_argument('path', nargs='?', default='SeniorDataset/building1/elec',
+                        help='directory holding the meter#.csv files')
+    parser.add_argument('--site-meter', type=int, default=1)
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE)
+    args = parser.parse_args()
+
+    submeters = find_submeters(args.path, args.site_meter)
+    outfile = os.path.join(args.path, 'meter' + str(args.site_meter) + '.csv')
+    rows = aggregate(submeters, outfile, args.chunksize)
+    print(outfile + ": " + str(rows) + " rows from " + str(len(submeters)) + " submeters")
@@ -1,3 +1,12 @@
+import io
+import os
+import csv
+import shutil
+import hashlib
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 from nilm_metadata import convert_yaml_to_hdf5
@@ -5,50 +14,361 @@ from nilmtk import DataSet
 from nilmtk.measurement import LEVEL_NAMES
 import matplotlib.pyplot as plt
 
-number = 1
-keys = ['/building1/elec/meter1', '/building1/elec/meter2', '/building1/elec/meter3']#, '/building1/elec/meter4', '/building1/elec/meter5', '/building1/elec/meter6', '/building1/elec/meter7']
-# keys = ['/96Hour_' + str(number) + 'Second/meter1', '/96Hour_' + str(number) + 'Second/meter2', '/96Hour_' + str(number) + 'Second/meter3', '/96Hour_' + str(number) + 'Second/meter4', '/96Hour_' + str(number) + 'Second/meter5', '/96Hour_' + str(number) + 'Second/meter6', '/96Hour_' + str(number) + 'Second/meter7']
-pathBeg = 'SeniorDataset'
+from pyramid import PERIODS, build_pyramid
+from goodSections import METADATA_DIR, device_periods, build_sections
+from meterStats import build_stats
+
+CHUNKSIZE = 500000   # rows of a meter csv held in memory at once
+COMPLEVEL = 5
+COMPLIB = 'zlib'
+
+
+def read_columns(filename):
+    '''Reads the two header rows of a meter#.csv, e.g. "timestamp,power" / ",apparent"
+
+    Returns: pd.MultiIndex of (physical_quantity, type) for the value columns
+    '''
+    with open(filename, 'r', newline='', encoding='utf-8-sig') as csvfile:
+        csvreader = csv.reader(csvfile)
+        quantities = next(csvreader)[1:]
+        types = next(csvreader)[1:]
+    return pd.MultiIndex.from_tuples(list(zip(quantities, types)), names=LEVEL_NAMES)
+
+
+class _FileRange(io.RawIOBase):
+    '''The bytes of an open file up to `end`, from wherever it was seeked to'''
+
+    def __init__(self, f, end):
+        self.f = f
+        self.end = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self.end - self.f.tell())
+        if n <= 0:
+            return 0
+        data = self.f.read(n)
+        b[:len(data)] = data
+        return len(data)
+
+
+def read_meter_csv(filename, chunksize=CHUNKSIZE, start=0, end=None):
+    '''Reads a meter#.csv in chunks of at most `chunksize` rows
+
+    Parameters
+    ----------
+    filename : csv of the form shown in the README
+    chunksize : number of rows held in memory at once
+    start : byte offset of the first row to read, 0 for the first row
+        after the header. Anything else must be the start of a line, e.g.
+        the end of the rows read by the last ingest
+    end : byte offset the rows stop at, None for the end of the file
+
+    Yields: float32 DataFrame with nilmtk column levels and a UTC index
+    '''
+    columns = read_columns(filename)
+    names = ['timestamp'] + ['c' + str(i) for i in range(len(columns))]
+    dtype = dict((name, np.float32) for name in names[1:])
+    dtype['timestamp'] = np.int64
+
+    with open(filename, 'rb') as f:
+        if end is None:
+            end = os.fstat(f.fileno()).st_size
+        f.seek(start)
+        reader = pd.read_csv(io.BufferedReader(_FileRange(f, end)), header=None, skiprows=2 if start == 0 else 0,
+                             names=names, dtype=dtype, index_col=0, chunksize=chunksize,
+                             encoding='utf-8-sig' if start == 0 else 'utf-8')
+        for chunk in reader:
+            chunk.index = pd.to_datetime(chunk.index, unit='s', utc=True)
+            chunk.columns = columns
+            yield chunk
+
+
+def meter_to_h5(filename, h5_filename, key, chunksize=CHUNKSIZE, after=None, start=0, end=None):
+    '''Appends a meter#.csv to `key` of an h5 file chunk by chunk
+
+    Parameters
+    ----------
+    filename : meter#.csv path
+    h5_filename : h5 file to append to
+    key : h5 key of the meter
+    chunksize : number of rows held in memory at once
+    after : pd.Timestamp, only rows later than this are written
+    start, end : byte range of the rows parsed, see `read_meter_csv`
+
+    Returns: number of rows written
+    '''
+    rows = 0
+    with pd.HDFStore(h5_filename, 'a', complevel=COMPLEVEL, complib=COMPLIB) as store:
+        for chunk in read_meter_csv(filename, chunksize, start, end):
+            if after is not None:
+                chunk = chunk[chunk.index > after]
+            if len(chunk) == 0:
+                continue
+            store.append(key, chunk, format='table')
+            rows += len(chunk)
+    return rows
+
+
+def file_state(filename, offset=None, blocksize=2**20):
+    '''Returns where the complete rows of a csv end and the md5 of the file up to there
+
+    A last line still being written, without its newline, is left for the
+    next ingest. Hashing runs at disk speed, far faster than parsing.
+
+    Parameters
+    ----------
+    filename : meter#.csv path
+    offset : byte offset, e.g. the end of the last ingest, to also return
+        the md5 of the bytes before it
+    blocksize : bytes read at once
+
+    Returns: (end, md5 hex digest of the bytes before `end`, md5 hex digest
+        of the bytes before `offset`, None without an offset or if the
+        complete rows end before it)
+    '''
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        end = size
+        while end > 0:
+            f.seek(max(end - blocksize, 0))
+            block = f.read(end - max(end - blocksize, 0))
+            newline = block.rfind(b'\n')
+            if newline >= 0:
+                end = end - len(block) + newline + 1
+                break
+            end -= len(block)
+
+        f.seek(0)
+        md5, prefix, done = hashlib.md5(), None, 0
+        while done < end:
+            if offset is not None and prefix is None and done + blocksize > offset:
+                md5.update(f.read(offset - done))
+                done = offset
+                prefix = md5.hexdigest()
+            block = f.read(min(blocksize, end - done))
+            if not block:
+                break
+            md5.update(block)
+            done += len(block)
+        if offset is not None and prefix is None and offset == end:
+            prefix = md5.hexdigest()
+    return end, md5.hexdigest(), prefix
+
+
+def _parse_meters(csv_files, keys, afters, starts, ends, tmpdir, workers, chunksize):
+    '''Parses meter csvs in parallel, each into its own temporary h5 file
+
+    HDF5 can't take writes from several processes, so the workers never
+    touch the real store.
+
+    Returns: list of (temporary h5 file, rows written)
+    '''
+    tmp_files = [os.path.join(tmpdir, 'meter' + str(i) + '.h5') for i in range(len(keys))]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parsed = [pool.submit(meter_to_h5, f, tmp, key, chunksize, after, start, end)
+                  for f, tmp, key, after, start, end in zip(csv_files, tmp_files, keys, afters, starts, ends)]
+        return [(tmp, p.result()) for tmp, p in zip(tmp_files, parsed)]
 
-powerdata_filename = 'SeniorDataset/h5_files/96Hour_1TestSecond.h5'
-metadata_dir = 'SeniorDataset/metadata'
 
-for count, key in enumerate(keys):
-    df = pd.read_csv(pathBeg+key+'.csv', low_memory=False, dtype={'a': np.float32}, header=[0, 1], index_col=0)
-    df.index = pd.to_datetime(df.index, unit='s', utc=True)
-    df.columns.names = LEVEL_NAMES
+def _file_states(csv_files, offsets, workers):
+    '''Returns `file_state` of every csv, computed in parallel'''
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(file_state, csv_files, offsets))
+
+
+def _copy_meter(store, tmp, key, chunksize):
+    '''Appends the temporary table of meter `key` to `store` chunk by chunk
+
+    Returns: the first timestamp appended
+    '''
+    first = None
+    with pd.HDFStore(tmp, 'r') as tmpstore:
+        for chunk in tmpstore.select(key, chunksize=chunksize):
+            if first is None and len(chunk) > 0:
+                first = chunk.index[0]
+            store.append(key, chunk, format='table')
+    return first
+
+
+def _last_timestamp(store, key):
+    '''Returns the last timestamp of table `key`'''
+    nrows = store.get_storer(key).nrows
+    return store.select(key, start=nrows - 1).index[-1]
+
+
+def _record_state(store, key, offset, checksum):
+    '''Saves the ingest watermark, the csv bytes read and their checksum in the attrs of meter `key`'''
+    attrs = store.get_storer(key).attrs
+    attrs.ingest_watermark = int(_last_timestamp(store, key).value)
+    attrs.ingest_offset = int(offset)
+    attrs.ingest_checksum = checksum
+
+
+def _ingest_state(store, key):
+    '''Returns (watermark as a UTC pd.Timestamp, csv bytes read, their checksum) of meter `key`
+
+    Nones if it was never ingested, the offset and checksum are None for
+    files ingested before offsets were recorded.
+    '''
+    if key not in store:
+        return None, None, None
+    attrs = store.get_storer(key).attrs
+    watermark = getattr(attrs, 'ingest_watermark', None)
+    if watermark is None:
+        return _last_timestamp(store, key), None, None
+    return (pd.Timestamp(watermark, tz='UTC'), getattr(attrs, 'ingest_offset', None),
+            getattr(attrs, 'ingest_checksum', None))
+
+
+def csv_to_h5(csv_files, keys, h5_filename, workers=None, chunksize=CHUNKSIZE, periods=PERIODS,
+              metadata_dir=METADATA_DIR):
+    '''Builds a new nilmtk h5 file out of meter#.csv files
+
+    Every meter is parsed by its own worker into a temporary h5 file. The
+    temporary tables are then copied into `h5_filename` chunk by chunk, so
+    memory use only depends on `chunksize`. Finally the downsampling pyramid,
+    the good sections and the normalization stats of every meter are built,
+    see pyramid.py, goodSections.py and meterStats.py, and its ingest
+    watermark and the csv bytes read are recorded for `ingest`.
+
+    Parameters
+    ----------
+    csv_files : list of meter#.csv paths
+    keys : list of h5 keys, e.g. '/building1/elec/meter1', one per csv file
+    h5_filename : h5 file to create, it is overwritten
+    workers : number of meters parsed in parallel, defaults to the cpu count
+    chunksize : number of rows held in memory at once by each worker
+    periods : sample periods in seconds precomputed for every meter
+    metadata_dir : directory of meter_devices.yaml, its max_sample_period
+        splits the good sections
+
+    Returns: list with the number of rows written per key
+    '''
+    sample_period, max_sample_period = device_periods(metadata_dir)
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(h5_filename)))
+    try:
+        states = _file_states(csv_files, [None] * len(keys), workers)
+        ends = [end for end, _, _ in states]
+        parsed = _parse_meters(csv_files, keys, [None] * len(keys), [0] * len(keys), ends, tmpdir, workers,
+                               chunksize)
 
-    if(count == 0):
         # delete the existing h5 file before adding new appliances
-        df.to_hdf(powerdata_filename, key=key, mode='w', format='table')
-    else:
-        df.to_hdf(powerdata_filename, key=key, mode='a', format='table')
-    del df
+        with pd.HDFStore(h5_filename, 'w', complevel=COMPLEVEL, complib=COMPLIB) as store:
+            for (tmp, rows), (end, checksum, _), key in zip(parsed, states, keys):
+                if rows == 0:
+                    continue
+                _copy_meter(store, tmp, key, chunksize)
+                build_pyramid(store, key, periods, chunksize=chunksize)
+                build_sections(store, key, sample_period, max_sample_period, chunksize=chunksize)
+                build_stats(store, key, chunksize=chunksize)
+                _record_state(store, key, end, checksum)
+    finally:
+        shutil.rmtree(tmpdir)
+    return [rows for _, rows in parsed]
+
+
+def ingest(csv_files, keys, h5_filename, workers=None, chunksize=CHUNKSIZE, periods=PERIODS,
+           metadata_dir=METADATA_DIR):
+    '''Appends only the new rows of meter#.csv files to an existing h5 file
+
+    Every meter keeps a high-water timestamp, the number of bytes of its csv
+    read so far and their checksum. If those bytes are unchanged, i.e. rows
+    were only appended to the csv, parsing starts right after them, and a
+    csv that didn't grow is skipped. Otherwise the whole csv is parsed and
+    only rows later than the watermark are kept. The new rows are
+    appended, the pyramid levels are rebuilt from the first new bin on, the
+    last good section is extended over them and they are merged into the
+    stats. A nightly run therefore parses only the new data, not the whole
+    history. Rows older than the watermark are ignored, use `csv_to_h5` to
+    rebuild.
+
+    Parameters
+    ----------
+    see `csv_to_h5`. If `h5_filename` doesn't exist it is built from scratch.
+
+    Returns: list with the number of rows appended per key
+    '''
+    if not os.path.exists(h5_filename):
+        return csv_to_h5(csv_files, keys, h5_filename, workers, chunksize, periods, metadata_dir)
+    sample_period, max_sample_period = device_periods(metadata_dir)
+
+    with pd.HDFStore(h5_filename, 'r') as store:
+        states = [_ingest_state(store, key) for key in keys]
 
-convert_yaml_to_hdf5(metadata_dir, powerdata_filename) #will append metadata to hdf5 file
+    todo = []
+    files = _file_states(csv_files, [offset for _, offset, _ in states], workers)
+    for f, key, (end, checksum, prefix), (watermark, offset, last_checksum) in zip(csv_files, keys, files, states):
+        if offset is not None and prefix is not None and prefix == last_checksum:
+            if end == offset:
+                continue
+            start = offset
+        else:
+            # Never ingested, or the rows read before were changed: parse it all
+            start = 0
+        todo.append((f, key, watermark, start, end, checksum))
+    if not todo:
+        return [0] * len(keys)
 
-# data = DataSet(powerdata_filename)
-# print(data.buildings[1].elec.mains())
-# print(data.buildings[1].elec.submeters()['toaster'])
+    appended = dict((key, 0) for key in keys)
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(h5_filename)))
+    try:
+        files, todo_keys, afters, starts, ends, todo_checksums = zip(*todo)
+        parsed = _parse_meters(files, todo_keys, afters, starts, ends, tmpdir, workers, chunksize)
+
+        with pd.HDFStore(h5_filename, 'a', complevel=COMPLEVEL, complib=COMPLIB) as store:
+            for (tmp, rows), end, checksum, key in zip(parsed, ends, todo_checksums, todo_keys):
+                if rows > 0:
+                    first = _copy_meter(store, tmp, key, chunksize)
+                    build_pyramid(store, key, periods, start=first, chunksize=chunksize)
+                    build_sections(store, key, sample_period, max_sample_period, start=first, chunksize=chunksize)
+                    build_stats(store, key, start=first, chunksize=chunksize)
+                if key in store:
+                    _record_state(store, key, end, checksum)
+                appended[key] = rows
+    finally:
+        shutil.rmtree(tmpdir)
+    return [appended[key] for key in keys]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load meter csvs into a nilmtk h5 file')
+    parser.add_argument('--full', action='store_true',
+                        help='rebuild the h5 file from scratch instead of appending new rows')
+    args = parser.parse_args()
+
+    number = 1
+    keys = ['/building1/elec/meter1', '/building1/elec/meter2', '/building1/elec/meter3']#, '/building1/elec/meter4', '/building1/elec/meter5', '/building1/elec/meter6', '/building1/elec/meter7']
+    # keys = ['/96Hour_' + str(number) + 'Second/meter1', '/96Hour_' + str(number) + 'Second/meter2', '/96Hour_' + str(number) + 'Second/meter3', '/96Hour_' + str(number) + 'Second/meter4', '/96Hour_' + str(number) + 'Second/meter5', '/96Hour_' + str(number) + 'Second/meter6', '/96Hour_' + str(number) + 'Second/meter7']
+    pathBeg = 'SeniorDataset'
+
+    powerdata_filename = 'SeniorDataset/h5_files/96Hour_1TestSecond.h5'
+    metadata_dir = 'SeniorDataset/metadata'
+
+    csv_files = [pathBeg + key + '.csv' for key in keys]
+    if args.full:
+        csv_to_h5(csv_files, keys, powerdata_filename, metadata_dir=metadata_dir)
+    else:
+        ingest(csv_files, keys, powerdata_filename, metadata_dir=metadata_dir)
 
-# test_elec = data.buildings[1].elec
+    convert_yaml_to_hdf5(metadata_dir, powerdata_filename) #will append metadata to hdf5 file
 
-# df_fridge = next(test_elec['toaster'].load())
-# df_fridge.plot()
-# plt.savefig('test')
+    # data = DataSet(powerdata_filename)
+    # print(data.buildings[1].elec.mains())
+    # print(data.buildings[1].elec.submeters()['toaster'])
 
-# next(data.buildings[1].elec.mains().load()).plot()
-# plt.savefig('test')
-# plt.close()
+    # test_elec = data.buildings[1].elec
 
-# next(data.buildings[1].elec['toaster'].load()).plot()
-# plt.savefig('test')
-# plt.close()
+    # df_fridge = next(test_elec['toaster'].load())
+    # df_fridge.plot()
+    # plt.savefig('test')
 
-# # Save to HDF5
-# df.to_hdf(filename, 'data', mode='w', format='table')
-# del df    # allow df to be garbage collected
+    # next(data.buildings[1].elec.mains().load()).plot()
+    # plt.savefig('test')
+    # plt.close()
 
-# # Append more data
-# df2 = pd.DataFrame(np.arange(10).reshape((5,2))*10, columns=['A', 'B'])
-# df2.to_hdf(filename, 'data', append=True)
\ No newline at end of file
+    # next(data.buildings[1].elec['toaster'].load()).plot()
+    # plt.savefig('test')
+    # plt.close()
@@ -0,0 +1,168 @@
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Converts the raw Emporia exports in allCSV/<appliance>/ into the meter#.csv
+# form nilmtk wants (see README).  Replaces update_csv_JS.py: exports are parsed
+# in large chunks, averaged with reshape/mean instead of a python bucket loop,
+# there is no 10000 sample cap and every appliance folder runs in its own process.
+#
+# to run (from the repo root)
+# python SeniorDataset/emporiaToCSV.py SeniorDataset/allCSV --scale 15
+
+TIME_FORMAT = '%m/%d/%Y %H:%M:%S'
+EXPORT_TIMEZONE = 'America/Chicago'
+START = 1640995200   # Jan 1, 2022, the common start of every meter#.csv
+EPOCH = pd.Timestamp(0, tz='UTC')
+CHUNKSIZE = 1000000
+
+
+def find_exports(folder, date=None):
+    '''Returns the Emporia exports of one appliance folder
+
+    Parameters
+    ----------
+    folder : appliance folder, e.g. allCSV/fridge
+    date : mm-dd of a single export to use, all exports are used if None
+
+    Returns: list of csv paths ordered by export date
+    '''
+    name = os.path.basename(os.path.normpath(folder))
+    if date is not None:
+        return [os.path.join(folder, name + '(' + date + ').csv')]
+    files = [f for f in os.listdir(folder) if f.endswith('.csv')]
+    return [os.path.join(folder, f) for f in sorted(files)]
+
+
+def read_export(path, chunksize=CHUNKSIZE):
+    '''Reads an Emporia export in chunks
+
+    Parameters
+    ----------
+    path : csv with a "Time Bucket (America/Chicago)" and a "(kWatts)" column
+    chunksize : number of rows parsed at once
+
+    Yields: (epoch seconds as int64 array, kW as float64 array)
+    '''
+    reader = pd.read_csv(path, header=0, names=['time', 'kw'], chunksize=chunksize,
+                         dtype={'time': str, 'kw': np.float64}, encoding='utf-8-sig')
+    for chunk in reader:
+        # Rows inside a DST change can't be placed in time, they are dropped
+        stamps = pd.to_datetime(chunk['time'], format=TIME_FORMAT)
+        stamps = pd.DatetimeIndex(stamps).tz_localize(EXPORT_TIMEZONE, ambiguous='NaT', nonexistent='NaT')
+        valid = ~stamps.isna()
+        seconds = np.asarray((stamps[valid] - EPOCH) // pd.Timedelta(seconds=1), dtype=np.int64)
+        kw = chunk['kw'].values[valid]
+        yield seconds, np.nan_to_num(kw)
+
+
+def resample_exports(paths, scale=1, start=START, chunksize=CHUNKSIZE):
+    '''Averages every `scale` consecutive readings of the exports in `paths`
+
+    Readings that don't fill a whole bucket are carried over into the next
+    chunk, so chunk boundaries don't change the output.
+
+    Parameters
+    ----------
+    paths : Emporia exports of one appliance, in time order
+    scale : number of 1 second readings averaged into one sample
+    start : epoch of the first output sample. If None the export's own
+        timestamps are kept
+    chunksize : number of rows parsed at once
+
+    Yields: (epoch seconds, watts) arrays
+    '''
+    carry_t = np.empty(0, dtype=np.int64)
+    carry_kw = np.empty(0, dtype=np.float64)
+    n_out = 0
+    for path in paths:
+        for seconds, kw in read_export(path, chunksize):
+            seconds = np.concatenate([carry_t, seconds])
+            kw = np.concatenate([carry_kw, kw])
+            n = len(kw) - (len(kw) % scale)
+            carry_t, carry_kw = seconds[n:], kw[n:]
+            if n == 0:
+                continue
+
+            watts = kw[:n].reshape(-1, scale).mean(axis=1) * 1000
+            if start is None:
+                stamps = seconds[:n:scale]
+            else:
+                stamps = start + (n_out + np.arange(len(watts), dtype=np.int64)) * scale
+            n_out += len(watts)
+            yield stamps, watts
+
+
+def convert_folder(folder, outfile, scale=1, date=None, start=START, chunksize=CHUNKSIZE):
+    '''Converts the exports of one appliance folder into a meter#.csv
+
+    Parameters
+    ----------
+    folder : appliance folder, e.g. allCSV/fridge
+    outfile : meter#.csv to write
+    scale : number of 1 second readings averaged into one sample
+    date : mm-dd of a single export to use, all exports are used if None
+    start : epoch of the first output sample, None keeps the export's timestamps
+    chunksize : number of rows parsed at once
+
+    Returns: (outfile, number of samples written)
+    '''
+    rows = 0
+    with open(outfile, 'w', newline='') as csvfile:
+        csvfile.write('timestamp,power\n,apparent\n')
+        for stamps, watts in resample_exports(find_exports(folder, date), scale, start, chunksize):
+            df = pd.DataFrame({'timestamp': stamps, 'power': watts})
+            df.to_csv(csvfile, header=False, index=False, float_format='%.3f')
+            rows += len(df)
+    return outfile, rows
+
+
+def convert_all(path, outdir, scale=1, date=None, start=START, first_meter=2,
+                workers=None, chunksize=CHUNKSIZE):
+    '''Converts every appliance folder under `path` in a process pool
+
+    Folders holding csv files are numbered in name order from `first_meter`,
+    meter1 is left for the aggregate (see aggregateCSV.py).
+
+    Returns: list of (outfile, number of samples written)
+    '''
+    folders = []
+    for f in sorted(os.listdir(path)):
+        folder = os.path.join(path, f)
+        if os.path.isdir(folder) and any(x.endswith('.csv') for x in os.listdir(folder)):
+            folders.append(f)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    jobs = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for meter_num, folder in enumerate(folders, first_meter):
+            outfile = os.path.join(outdir, 'meter' + str(meter_num) + '.csv')
+            jobs.append(pool.submit(convert_folder, os.path.join(path, folder), outfile,
+                                    scale, date, start, chunksize))
+        return [job.result() for job in jobs]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert Emporia exports to meter#.csv files')
+    parser.add_argument('path', nargs='?', default='SeniorDataset/allCSV',
+                        help='directory holding one folder of exports per appliance')
+    parser.add_argument('--out', default='SeniorDataset/building1/elec')
+    parser.add_argument('--scale', type=int, default=1,
+                        help='seconds averaged into one sample')
+    parser.add_argument('--date', default=None, help='mm-dd of the exports to use, all if omitted')
+    parser.add_argument('--start', type=int, default=START,
+                        help='epoch of the first sample, keeps the export timestamps if negative')
+    parser.add_argument('--first-meter', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE)
+    args = parser.parse_args()
+
+    start = args.start if args.start >= 0 else None
+    results = convert_all(args.path, args.out, args.scale, args.date, start,
+                          args.first_meter, args.workers, args.chunksize)
+    for outfile, rows in results:
+        print(outfile + ": " + str(rows) + " samples")
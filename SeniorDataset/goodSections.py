@@ -0,0 +1,123 @@
+import os
+
+import yaml
+import numpy as np
+import pandas as pd
+
+# Good sections index for the nilmtk h5 files.  nilmtk finds the good
+# sections of a meter (the stretches without gaps longer than the device's
+# max_sample_period) by scanning the whole meter every time.  Here they are
+# found once at ingest from the timestamp diffs, stored next to the meter as
+# /building1/elec/meter1/good_sections (one start, end row per section) and
+# extended when new rows are appended, so reading them costs nothing.
+
+SECTIONS_NODE = 'good_sections'
+CHUNKSIZE = 500000
+METADATA_DIR = 'SeniorDataset/metadata'
+EPOCH = pd.Timestamp(0, tz='UTC')
+
+
+def sections_key(key):
+    '''Returns the key of the good sections table of meter `key`'''
+    return key + '/' + SECTIONS_NODE
+
+
+def device_periods(metadata_dir=METADATA_DIR, device_model=None):
+    '''Reads (sample_period, max_sample_period) in seconds from meter_devices.yaml
+
+    Parameters
+    ----------
+    metadata_dir : directory holding meter_devices.yaml
+    device_model : device to read, the first one in the file if None
+    '''
+    with open(os.path.join(metadata_dir, 'meter_devices.yaml')) as f:
+        devices = yaml.safe_load(f)
+    device = devices[device_model] if device_model is not None else next(iter(devices.values()))
+    return device['sample_period'], device['max_sample_period']
+
+
+def find_sections(stamps, max_gap, section_start=None, previous=None):
+    '''Splits sorted int64 nanosecond timestamps wherever they jump by more than `max_gap`
+
+    Parameters
+    ----------
+    stamps : sorted int64 epoch nanoseconds
+    max_gap : largest allowed nanoseconds between two samples of a section
+    section_start, previous : start of the section still open before
+        `stamps` and its last timestamp, None if there is none
+
+    Returns: (starts, lasts) of the sections closed by `stamps`, and the
+        (section_start, previous) still open after them
+    '''
+    if len(stamps) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), section_start, previous
+    if previous is None:
+        section_start, previous = stamps[0], stamps[0]
+
+    stamps = np.r_[previous, stamps]
+    gaps = np.flatnonzero(np.diff(stamps) > max_gap)
+    starts = np.r_[section_start, stamps[gaps + 1]].astype(np.int64)
+    lasts = np.r_[stamps[gaps], stamps[-1]].astype(np.int64)
+    return starts[:-1], lasts[:-1], starts[-1], lasts[-1]
+
+
+def _sections_frame(starts, lasts, sample_period):
+    '''The good sections table: start and end nanoseconds, the end is one period after the last sample'''
+    return pd.DataFrame({'start': starts, 'end': lasts + int(sample_period * 1e9)})
+
+
+def build_sections(store, key, sample_period, max_sample_period, start=None, chunksize=CHUNKSIZE):
+    '''Writes the good sections table of meter `key`
+
+    Parameters
+    ----------
+    store : pd.HDFStore opened for writing
+    key : meter table, e.g. '/building1/elec/meter1'
+    sample_period, max_sample_period : seconds, see meter_devices.yaml
+    start : pd.Timestamp of the first row appended since the table was last
+        built. Only those rows are read and the last section is extended,
+        None rebuilds the table from the whole meter
+    chunksize : number of rows of the meter table held in memory at once
+    '''
+    skey = sections_key(key)
+    max_gap = int(max_sample_period * 1e9)
+    section_start, previous = None, None
+    where = None
+    if start is not None and skey in store:
+        nrows = store.get_storer(skey).nrows
+        if nrows > 0:
+            last = store.select(skey, start=nrows - 1)
+            section_start = int(last['start'].iloc[0])
+            previous = int(last['end'].iloc[0]) - int(sample_period * 1e9)
+            store.remove(skey, start=nrows - 1, stop=nrows)
+            where = 'index >= start'
+    elif skey in store:
+        store.remove(skey)
+
+    for chunk in store.select(key, where=where, chunksize=chunksize):
+        index = chunk.dropna(how='all').index
+        stamps = np.asarray((index - EPOCH) // pd.Timedelta(1, 'ns'), dtype=np.int64)
+        if previous is not None:
+            stamps = stamps[stamps > previous]
+        starts, lasts, section_start, previous = find_sections(stamps, max_gap, section_start, previous)
+        if len(starts) > 0:
+            store.append(skey, _sections_frame(starts, lasts, sample_period), format='table', index=False)
+
+    if previous is not None:
+        store.append(skey, _sections_frame(np.array([section_start]), np.array([previous]), sample_period),
+                     format='table', index=False)
+    if skey in store:
+        store.get_storer(skey).attrs.max_sample_period = max_sample_period
+
+
+def load_sections(store, key):
+    '''Reads the good sections of meter `key`
+
+    Returns: list of (start, end) UTC pd.Timestamps, None if they weren't computed
+    '''
+    skey = sections_key(key)
+    if skey not in store:
+        return None
+    sections = store.select(skey)
+    return [(pd.Timestamp(s, unit='ns', tz='UTC'), pd.Timestamp(e, unit='ns', tz='UTC'))
+            for s, e in zip(sections['start'].values, sections['end'].values)]
@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+
+from columnStats import RESOLUTION, QUANTILES, MOMENTS, quantile_name, ColumnStats
+
+# Normalization statistics for the nilmtk h5 files.  The neural disaggregators
+# scale their inputs by the maximum of the mains, which they used to take from
+# the first chunk they read.  Here the count, min, max, mean, std and
+# quantiles of every column of a meter are computed in one pass at ingest and
+# stored next to the meter as /building1/elec/meter1/stats, with the
+# histogram the quantiles come from in .../stats_histogram.  The running
+# moments (count, mean and the sum of squared deviations) and the histogram
+# are merged with those of the new rows when rows are appended, so the stats
+# never need a second scan.  neural-disaggregator/*/normstats.py reads them,
+# ColumnStats itself is in columnStats.py.
+
+STATS_NODE = 'stats'
+HISTOGRAM_NODE = 'stats_histogram'
+CHUNKSIZE = 500000
+
+
+def stats_key(key):
+    '''Returns the key of the stats table of meter `key`'''
+    return key + '/' + STATS_NODE
+
+
+def histogram_key(key):
+    '''Returns the key of the histogram behind the quantiles of meter `key`'''
+    return key + '/' + HISTOGRAM_NODE
+
+
+def load_stats(store, key):
+    '''Reads the stats of meter `key`
+
+    Returns: pd.DataFrame with a row per statistic (rows, count, min, max,
+        mean, m2, std and the quantiles q0.01 ...) and a column per column
+        of the meter, None if they weren't computed
+    '''
+    skey = stats_key(key)
+    if skey not in store:
+        return None
+    return store[skey]
+
+
+def build_stats(store, key, start=None, resolution=RESOLUTION, chunksize=CHUNKSIZE):
+    '''Writes the stats of meter `key` in one pass over the table
+
+    Parameters
+    ----------
+    store : pd.HDFStore opened for writing
+    key : meter table, e.g. '/building1/elec/meter1'
+    start : pd.Timestamp of the first row appended since the stats were last
+        built. Only those rows are read and merged into the stored stats,
+        None rebuilds them from the whole meter
+    resolution : watts per histogram bin
+    chunksize : number of rows of the meter table held in memory at once
+    '''
+    skey, hkey = stats_key(key), histogram_key(key)
+    old = load_stats(store, key) if start is not None else None
+    where = None
+    if old is not None:
+        resolution = store.get_storer(skey).attrs.resolution
+        histograms = store[hkey]
+        columns, names = list(old.columns), old.columns.names
+        stats = [ColumnStats.from_summary(old[c], histograms[c].values, resolution) for c in columns]
+        where = 'index >= start'
+    else:
+        columns, names, stats = None, None, None
+
+    for chunk in store.select(key, where=where, chunksize=chunksize):
+        if stats is None:
+            columns, names = list(chunk.columns), chunk.columns.names
+            stats = [ColumnStats(resolution) for _ in columns]
+        for column, s in zip(columns, stats):
+            s.update(chunk[column].values)
+
+    for k in (skey, hkey):
+        if k in store:
+            store.remove(k)
+    if stats is None:
+        return
+
+    index = MOMENTS + [quantile_name(q) for q in QUANTILES]
+    rows = store.get_storer(key).nrows
+    table = pd.DataFrame(np.array([s.summary(rows) for s in stats]).T, index=index,
+                         columns=pd.MultiIndex.from_tuples(columns, names=names))
+    bins = max(len(s.histogram) for s in stats)
+    histogram = pd.DataFrame(np.array([np.r_[s.histogram, np.zeros(bins - len(s.histogram), dtype=np.int64)]
+                                       for s in stats]).T, columns=table.columns)
+    store.put(skey, table)
+    store.put(hkey, histogram)
+    store.get_storer(skey).attrs.resolution = resolution
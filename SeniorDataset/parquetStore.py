@@ -0,0 +1,340 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from nilmtk.datastore import DataStore, MAX_MEM_ALLOWANCE_IN_BYTES
+from nilmtk.measurement import LEVEL_NAMES
+from nilmtk.timeframe import TimeFrame
+from nilmtk.timeframegroup import TimeFrameGroup
+
+# A nilmtk DataStore on top of Parquet files, an alternative to HDFDataStore.
+# Every meter key keeps the h5 layout and is split into one directory per UTC day:
+#
+#   <root>/building1/elec/meter1/2022-01-01/part-00000.parquet
+#   <root>/metadata.yaml
+#
+# Day directories outside the `set_window` bounds are never opened and inside
+# a file the bounds are pushed down to the row groups (an hour each by default),
+# so a one hour window out of a year reads about one row group. Files are read
+# by a pool of threads.
+#
+# Usage:
+#   convert_h5('SeniorDataset/h5_files/test.h5', 'SeniorDataset/parquet/test')
+#   data = DataSet()
+#   data.import_metadata(ParquetDataStore('SeniorDataset/parquet/test'))
+#   data.set_window(start='2022-01-01 10:00', end='2022-01-01 11:00')
+
+ROW_GROUP_SIZE = 3600   # rows, one hour at 1 Hz
+METADATA_FILENAME = 'metadata.yaml'
+DAY_FORMAT = '%Y-%m-%d'
+
+
+def _column_name(column):
+    '''('power', 'apparent') -> 'power:apparent' '''
+    return ':'.join('' if level is None else str(level) for level in column)
+
+
+def _column_tuple(name):
+    '''Inverse of `_column_name`'''
+    return tuple(name.split(':'))
+
+
+def _utc(timestamp):
+    '''pd.Timestamp in UTC, naive timestamps are taken as UTC'''
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tzinfo is None:
+        return timestamp.tz_localize('UTC')
+    return timestamp.tz_convert('UTC')
+
+
+def _to_ns(timestamp):
+    '''Epoch nanoseconds of a timestamp, None stays None'''
+    if timestamp is None:
+        return None
+    return int((_utc(timestamp) - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(1, 'ns'))
+
+
+class ParquetDataStore(DataStore):
+    '''nilmtk DataStore keeping every meter as day-partitioned Parquet files
+
+    Attributes
+    ----------
+    root : directory of the store
+    threads : number of files read at the same time
+    row_group_size : rows per Parquet row group when writing
+    '''
+
+    def __init__(self, root, threads=None, row_group_size=ROW_GROUP_SIZE):
+        '''Opens, or creates, the store under `root`
+
+        Parameters
+        ----------
+        root : directory of the store
+        threads : number of files read at the same time, defaults to the cpu count
+        row_group_size : rows per Parquet row group when writing
+        '''
+        self.root = root
+        self.threads = threads or os.cpu_count()
+        self.row_group_size = row_group_size
+        if not os.path.exists(root):
+            os.makedirs(root)
+        super(ParquetDataStore, self).__init__()
+
+    def _path(self, key):
+        return os.path.join(self.root, *[k for k in key.split('/') if k])
+
+    def _day_dirs(self, key, start=None, end=None):
+        '''Day directories of `key` that overlap [start, end)'''
+        path = self._path(key)
+        if not os.path.isdir(path):
+            return []
+        days = sorted(d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)))
+        if start is not None:
+            first = _utc(start).strftime(DAY_FORMAT)
+            days = [d for d in days if d >= first]
+        if end is not None:
+            last = _utc(end).strftime(DAY_FORMAT)
+            days = [d for d in days if d <= last]
+        return [os.path.join(path, d) for d in days]
+
+    def _files(self, key, start=None, end=None):
+        files = []
+        for day in self._day_dirs(key, start, end):
+            files += [os.path.join(day, f) for f in sorted(os.listdir(day)) if f.endswith('.parquet')]
+        return files
+
+    def _read_file(self, filename, names, start, end):
+        '''Reads the rows of one file within [start, end) epoch nanoseconds'''
+        filters = []
+        if start is not None:
+            filters.append(('timestamp', '>=', start))
+        if end is not None:
+            filters.append(('timestamp', '<', end))
+        columns = None if names is None else ['timestamp'] + names
+        table = pq.read_table(filename, columns=columns, filters=filters or None, use_threads=True)
+        return table.to_pandas()
+
+    def _frame(self, df):
+        '''Turns the flat Parquet columns back into a nilmtk DataFrame'''
+        index = pd.to_datetime(df['timestamp'].values, unit='ns', utc=True)
+        df = df.drop(columns='timestamp')
+        df.index = index
+        df.columns = pd.MultiIndex.from_tuples([_column_tuple(c) for c in df.columns], names=LEVEL_NAMES)
+        return df
+
+    def _read(self, key, names, start, end):
+        '''Yields DataFrames of the files of `key` within [start, end), in time order
+
+        Up to `threads` files are read ahead by the thread pool.
+        '''
+        files = self._files(key, start, end)
+        start_ns, end_ns = _to_ns(start), _to_ns(end)
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            pending = []
+            for filename in files:
+                pending.append(pool.submit(self._read_file, filename, names, start_ns, end_ns))
+                if len(pending) > self.threads:
+                    yield pending.pop(0).result()
+            for job in pending:
+                yield job.result()
+
+    def load(self, key, columns=None, sections=None, n_look_ahead_rows=0,
+             chunksize=MAX_MEM_ALLOWANCE_IN_BYTES, verbose=False):
+        '''Loads `key` in chunks of at most `chunksize` rows, see nilmtk DataStore.load'''
+        key = '/' + key.strip('/')
+        sections = [TimeFrame()] if sections is None else sections
+        sections = TimeFrameGroup(sections)
+        chunksize = int(chunksize)
+        names = None if columns is None else [_column_name(c) for c in columns]
+
+        for section in sections:
+            window_intersect = self.window.intersection(section)
+            if window_intersect.empty:
+                data = pd.DataFrame(columns=columns)
+                data.timeframe = section
+                yield data
+                continue
+
+            buffer = []
+            buffered = 0
+            chunk_i = 0
+            frames = self._read(key, names, window_intersect.start, window_intersect.end)
+            exhausted = False
+            while True:
+                # Keep enough rows for the chunk and its look ahead
+                while not exhausted and buffered < chunksize + n_look_ahead_rows:
+                    try:
+                        df = next(frames)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if len(df) > 0:
+                        buffer.append(df)
+                        buffered += len(df)
+                if buffered == 0:
+                    if chunk_i == 0:
+                        data = pd.DataFrame(columns=columns)
+                        data.timeframe = window_intersect
+                        yield data
+                    break
+
+                rows = pd.concat(buffer) if len(buffer) > 1 else buffer[0]
+                data = self._frame(rows.iloc[:chunksize])
+                rest = rows.iloc[chunksize:]
+                buffer = [rest] if len(rest) > 0 else []
+                buffered = len(rest)
+
+                there_are_more_subchunks = buffered > 0 or not exhausted
+                if n_look_ahead_rows > 0:
+                    if buffered > 0:
+                        data.look_ahead = self._frame(rest.iloc[:n_look_ahead_rows])
+                    else:
+                        data.look_ahead = pd.DataFrame()
+                data.timeframe = self._timeframe_for_chunk(there_are_more_subchunks, chunk_i,
+                                                           window_intersect, data.index)
+                yield data
+                chunk_i += 1
+                if not there_are_more_subchunks:
+                    break
+
+    def _timeframe_for_chunk(self, there_are_more_subchunks, chunk_i, window_intersect, index):
+        '''Same rules as nilmtk's HDFDataStore: inner chunk edges come from the data'''
+        start = None
+        end = None
+        if there_are_more_subchunks:
+            if chunk_i == 0:
+                start = window_intersect.start
+        elif chunk_i > 0:
+            end = window_intersect.end
+        else:
+            start = window_intersect.start
+            end = window_intersect.end
+        if start is None:
+            start = index[0]
+        if end is None:
+            end = index[-1]
+        return TimeFrame(start, end)
+
+    def __getitem__(self, key):
+        frames = [self._frame(df) for df in self._read(key, None, None, None) if len(df) > 0]
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames)
+
+    def append(self, key, value):
+        '''Writes `value` as new part files of the days it covers
+
+        Parameters
+        ----------
+        key : e.g. '/building1/elec/meter1'
+        value : DataFrame with a tz-aware DatetimeIndex and nilmtk columns
+        '''
+        if len(value) == 0:
+            return
+        index = value.index.tz_convert('UTC')
+        flat = pd.DataFrame(dict((_column_name(c), np.asarray(value[c].values)) for c in value.columns))
+        flat.insert(0, 'timestamp', (index - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(1, 'ns'))
+        days = index.strftime(DAY_FORMAT)
+        bounds = np.flatnonzero(np.r_[True, days[1:] != days[:-1], True])
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            path = os.path.join(self._path(key), days[first])
+            if not os.path.exists(path):
+                os.makedirs(path)
+            part = len([f for f in os.listdir(path) if f.endswith('.parquet')])
+            table = pa.Table.from_pandas(flat.iloc[first:last], preserve_index=False)
+            pq.write_table(table, os.path.join(path, 'part-{:05d}.parquet'.format(part)),
+                           row_group_size=self.row_group_size)
+
+    def put(self, key, value):
+        self.remove(key)
+        self.append(key, value)
+
+    def remove(self, key):
+        path = self._path(key)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    def _load_all_metadata(self):
+        filename = os.path.join(self.root, METADATA_FILENAME)
+        if not os.path.exists(filename):
+            return {}
+        with open(filename, 'r') as f:
+            return yaml.safe_load(f) or {}
+
+    def load_metadata(self, key='/'):
+        if key != '/':
+            key = '/' + key.strip('/')
+        return self._load_all_metadata().get(key, {})
+
+    def save_metadata(self, key, metadata):
+        if key != '/':
+            key = '/' + key.strip('/')
+        all_metadata = self._load_all_metadata()
+        all_metadata[key] = metadata
+        with open(os.path.join(self.root, METADATA_FILENAME), 'w') as f:
+            yaml.safe_dump(all_metadata, f, default_flow_style=False)
+
+    def elements_below_key(self, key='/'):
+        path = self._path(key)
+        if not os.path.isdir(path):
+            return []
+        return sorted(d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)))
+
+    def get_timeframe(self, key):
+        '''Timeframe of the data of `key`, clipped to the window'''
+        files = self._files(key, self.window.start, self.window.end)
+        if not files:
+            return TimeFrame()
+        first = pq.read_table(files[0], columns=['timestamp'])['timestamp']
+        last = pq.read_table(files[-1], columns=['timestamp'])['timestamp']
+        start = pd.Timestamp(first[0].as_py(), unit='ns', tz='UTC')
+        end = pd.Timestamp(last[len(last) - 1].as_py(), unit='ns', tz='UTC')
+        return self.window.intersection(TimeFrame(start, end))
+
+    def close(self):
+        pass
+
+    def open(self, mode='a'):
+        pass
+
+
+def convert_h5(h5_filename, root, chunksize=500000, row_group_size=ROW_GROUP_SIZE):
+    '''Copies every meter table and the nilmtk metadata of an h5 file into a ParquetDataStore
+
+    Pyramid levels, good sections and stats (see pyramid.py, goodSections.py and
+    meterStats.py) are not copied.
+
+    Parameters
+    ----------
+    h5_filename : nilmtk h5 file, e.g. written by csvToH5.py
+    root : directory of the new store
+    chunksize : number of rows held in memory at once
+
+    Returns: ParquetDataStore
+    '''
+    store = ParquetDataStore(root, row_group_size=row_group_size)
+    with pd.HDFStore(h5_filename, 'r') as hdf:
+        # nilmtk keeps the dataset and building metadata in the node attrs
+        for name, node in [('', hdf.root)] + list(hdf.root._v_children.items()):
+            if 'metadata' in node._v_attrs:
+                store.save_metadata('/' + name, node._v_attrs.metadata)
+        for key in hdf.keys():
+            name = key.split('/')[-1]
+            if name.startswith('period') or name in ('good_sections', 'stats', 'stats_histogram'):
+                continue
+            store.remove(key)
+            # Only whole days are written, so every day gets a single part file
+            pending = None
+            for chunk in hdf.select(key, chunksize=chunksize):
+                pending = chunk if pending is None else pd.concat([pending, chunk])
+                last_day = pending.index[-1].tz_convert('UTC').floor('D')
+                store.append(key, pending[pending.index < last_day])
+                pending = pending[pending.index >= last_day]
+            if pending is not None:
+                store.append(key, pending)
+    return store
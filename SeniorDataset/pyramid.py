@@ -0,0 +1,195 @@
+import numpy as np
+import pandas as pd
+
+# Downsampling pyramid for the nilmtk h5 files.  Next to every meter table,
+# e.g. /building1/elec/meter1, the means over 8, 15, 30, 60 and 300 second bins
+# are stored as /building1/elec/meter1/period8, .../period15 and so on.  A load
+# at one of those sample periods reads the small precomputed table instead of
+# resampling the 1 second data again, which replaces the 96Hour_*Second csv trees.
+
+PERIODS = [8, 15, 30, 60, 300]   # seconds, the meter table itself is the 1 second level
+CHUNKSIZE = 500000
+EPOCH = pd.Timestamp(0, tz='UTC')
+
+
+def level_key(key, sample_period):
+    '''Returns the key of the `sample_period` level of meter `key`'''
+    return key + '/period' + str(int(sample_period))
+
+
+def _seconds(index):
+    '''Epoch seconds of a tz-aware DatetimeIndex as int64'''
+    return np.asarray((index - EPOCH) // pd.Timedelta(seconds=1), dtype=np.int64)
+
+
+def _floor(timestamp, period):
+    '''Start of the `period` second bin holding `timestamp`'''
+    seconds = (timestamp - EPOCH) // pd.Timedelta(seconds=1)
+    return pd.Timestamp(seconds - seconds % period, unit='s', tz='UTC')
+
+
+def _bin(seconds, values, period):
+    '''Sums and counts the non NaN values of every `period` second bin
+
+    Parameters
+    ----------
+    seconds : sorted int64 epoch seconds
+    values : float64 array of shape (len(seconds), columns)
+    period : bin width in seconds
+
+    Returns: (bin starts, sums, counts)
+    '''
+    bins = seconds - seconds % period
+    starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    valid = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(valid, values, 0), starts, axis=0)
+    counts = np.add.reduceat(valid.astype(np.int64), starts, axis=0)
+    return bins[starts], sums, counts
+
+
+def _level_frame(bins, sums, counts, columns):
+    '''Builds the float32 mean table of a level'''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    index = pd.to_datetime(bins, unit='s', utc=True)
+    return pd.DataFrame(means, index=index, columns=columns, dtype=np.float32)
+
+
+def build_pyramid(store, key, periods=PERIODS, start=None, chunksize=CHUNKSIZE):
+    '''Writes the downsampled levels of meter `key` in one pass over the table
+
+    A bin that straddles two chunks is carried into the next chunk, so the
+    result doesn't depend on `chunksize`.
+
+    Parameters
+    ----------
+    store : pd.HDFStore opened for writing
+    key : meter table, e.g. '/building1/elec/meter1'
+    periods : bin widths in seconds
+    start : pd.Timestamp. If given, only bins from the one holding `start`
+        onwards are rebuilt, used after appending new data to the meter
+    chunksize : number of rows of the meter table held in memory at once
+    '''
+    if start is None:
+        level_starts = dict((p, None) for p in periods)
+        read_from = None
+    else:
+        level_starts = dict((p, _floor(start, p)) for p in periods)
+        read_from = min(level_starts.values())
+
+    for p in periods:
+        lkey = level_key(key, p)
+        if lkey not in store:
+            continue
+        if level_starts[p] is None:
+            store.remove(lkey)
+        else:
+            bin_start = level_starts[p]
+            store.remove(lkey, where='index >= bin_start')
+
+    where = None if read_from is None else 'index >= read_from'
+    carry = dict((p, None) for p in periods)
+    columns = None
+    for chunk in store.select(key, where=where, chunksize=chunksize):
+        if len(chunk) == 0:
+            continue
+        columns = chunk.columns
+        seconds = _seconds(chunk.index)
+        values = chunk.values.astype(np.float64)
+        for p in periods:
+            first = 0
+            if level_starts[p] is not None:
+                first = np.searchsorted(seconds, (level_starts[p] - EPOCH) // pd.Timedelta(seconds=1))
+            if first == len(seconds):
+                continue
+            bins, sums, counts = _bin(seconds[first:], values[first:], p)
+
+            # Merge with the bin left open by the previous chunk
+            if carry[p] is not None:
+                cbin, csums, ccounts = carry[p]
+                if cbin == bins[0]:
+                    sums[0] += csums
+                    counts[0] += ccounts
+                else:
+                    bins = np.r_[cbin, bins]
+                    sums = np.vstack([csums, sums])
+                    counts = np.vstack([ccounts, counts])
+
+            # The last bin may continue in the next chunk
+            carry[p] = (bins[-1], sums[-1], counts[-1])
+            if len(bins) > 1:
+                store.append(level_key(key, p), _level_frame(bins[:-1], sums[:-1], counts[:-1], columns),
+                             format='table')
+
+    for p in periods:
+        if carry[p] is not None:
+            cbin, csums, ccounts = carry[p]
+            store.append(level_key(key, p),
+                         _level_frame(np.array([cbin]), np.array([csums]), np.array([ccounts]), columns),
+                         format='table')
+
+
+def load(store, key, sample_period=None, start=None, end=None, chunksize=CHUNKSIZE):
+    '''Loads meter `key` at `sample_period`
+
+    The precomputed level is read when there is one, otherwise the meter
+    table is resampled chunk by chunk into the same epoch aligned bins.
+
+    Parameters
+    ----------
+    store : pd.HDFStore
+    key : meter table, e.g. '/building1/elec/meter1'
+    sample_period : seconds, None or 1 reads the meter table as is
+    start, end : optional pd.Timestamps bounding the rows read
+    chunksize : number of rows held in memory at once
+
+    Yields: DataFrames at `sample_period`
+    '''
+    terms = []
+    if start is not None:
+        start = pd.Timestamp(start)
+        terms.append('index >= start')
+    if end is not None:
+        end = pd.Timestamp(end)
+        terms.append('index < end')
+    where = ' & '.join(terms) if terms else None
+
+    if sample_period is None or sample_period <= 1:
+        for chunk in store.select(key, where=where, chunksize=chunksize):
+            yield chunk
+    elif sample_period == int(sample_period) and level_key(key, sample_period) in store:
+        for chunk in store.select(level_key(key, sample_period), where=where, chunksize=chunksize):
+            yield chunk
+    else:
+        # The rows of the last bin of a chunk are held back and resampled
+        # with the next chunk, so a bin straddling two chunks comes out once
+        rule = pd.Timedelta(seconds=sample_period)
+        carry = None
+        for chunk in store.select(key, where=where, chunksize=chunksize):
+            if carry is not None:
+                chunk = pd.concat([carry, chunk])
+            if len(chunk) == 0:
+                continue
+            last = chunk.index[-1].floor(rule)
+            carry = chunk[chunk.index >= last]
+            done = chunk[chunk.index < last]
+            if len(done):
+                yield done.resample(rule, origin='epoch').mean()
+        if carry is not None and len(carry):
+            yield carry.resample(rule, origin='epoch').mean()
+
+
+def load_meter(meter, sample_period=None, chunksize=CHUNKSIZE):
+    '''Loads a nilmtk.ElecMeter at `sample_period`, honouring `DataSet.set_window`
+
+    Parameters
+    ----------
+    meter : nilmtk.ElecMeter stored in an h5 file
+    sample_period : seconds, see `load`
+    chunksize : number of rows held in memory at once
+
+    Yields: DataFrames at `sample_period`
+    '''
+    window = meter.store.window
+    return load(meter.store.store, meter.key, sample_period,
+                window.start, window.end, chunksize)
@@ -0,0 +1,409 @@
+import os
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+import numpy as np
+import pandas as pd
+from nilm_metadata import convert_yaml_to_hdf5
+from nilmtk.measurement import LEVEL_NAMES
+
+from emporiaToCSV import START, read_export
+from csvToH5 import CHUNKSIZE, COMPLEVEL, COMPLIB, _copy_meter
+from pyramid import PERIODS, build_pyramid
+from goodSections import METADATA_DIR, device_periods, build_sections
+
+# Synthesizes large multi-appliance datasets for scale testing.  Instead of
+# lining up the 96HourCSV recordings by hand and summing them with
+# aggregateAllCSV.py, the single appliance activations are cut out of every
+# recording in allCSV/ and 96HourCSV/ and scattered over weeks or months with
+# vectorized random scheduling, for as many buildings as asked.  Every
+# building is written straight into a nilmtk h5 file (1 second, float32,
+# meter1 is the aggregate) together with its metadata yaml.
+#
+# to run (from the repo root)
+# python SeniorDataset/syntheticHouseholds.py --buildings 200 --days 28 --out SeniorDataset/h5_files/synthetic.h5
+
+SOURCES = ['SeniorDataset/allCSV', 'SeniorDataset/96HourCSV']
+ON_POWER = 10   # watts, an appliance drawing less is off
+MIN_ON = 3      # seconds, shorter activations are dropped
+MIN_OFF = 30    # seconds, activations closer than this are merged
+BORDER = 2      # seconds of off samples kept around every activation
+
+# nilm_metadata appliance type of a recording, matched against its folder or file name
+APPLIANCE_NAMES = [('hairdryer', 'hair dryer'), ('slowcooker', 'slow cooker'), ('crockpot', 'slow cooker'),
+                   ('fridge', 'fridge'), ('microwave', 'microwave'), ('kettle', 'kettle'),
+                   ('toaster', 'toaster')]
+
+# Mean uses per day of a household, cyclic appliances run back to back all day
+USES_PER_DAY = {'microwave': 3.0, 'kettle': 4.0, 'toaster': 1.0, 'hair dryer': 0.7, 'slow cooker': 0.3}
+CYCLIC = ['fridge']
+
+# Relative chance of an appliance being switched on in every hour of the day
+DAILY_PROFILE = np.array([1, 0.5, 0.3, 0.3, 0.3, 0.5, 2, 4, 4, 3, 2, 2,
+                          3, 2, 2, 2, 3, 4, 6, 6, 5, 4, 3, 2], dtype=np.float64)
+
+
+def appliance_type(name):
+    '''Returns the nilm_metadata appliance type named in a folder or file name, None if unknown'''
+    name = ''.join(c for c in name.lower() if c.isalpha())
+    for keyword, appliance in APPLIANCE_NAMES:
+        if keyword in name:
+            return appliance
+    return None
+
+
+def _to_grid(seconds, watts):
+    '''Places timestamped readings on a 1 second grid, missing seconds are 0'''
+    grid = np.zeros(seconds[-1] - seconds[0] + 1)
+    grid[seconds - seconds[0]] = watts
+    return grid
+
+
+def read_recording(path):
+    '''Reads a single appliance recording as 1 second watts
+
+    Understands the three forms found in allCSV/ and 96HourCSV/: Emporia
+    exports in kW, meter#.csv files and csvs of watts under a
+    "power"/"apparent" header without timestamps.
+
+    Returns: float64 array of watts
+    '''
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        header = f.readline().strip()
+
+    if header.startswith('Time Bucket'):
+        parts = list(read_export(path))
+        seconds = np.concatenate([p[0] for p in parts])
+        return _to_grid(seconds, np.concatenate([p[1] for p in parts]) * 1000)
+
+    # The 96HourCSV meter#.csv files lose their timestamps part way through,
+    # their rows are 1 second apart so the values are read by position
+    column = 1 if header.startswith('timestamp') else 0
+    values = pd.read_csv(path, header=None, skiprows=2, usecols=[column], dtype=np.float64, encoding='utf-8-sig')
+    return np.nan_to_num(values.iloc[:, 0].values)
+
+
+def extract_activations(watts, on_power=ON_POWER, min_on=MIN_ON, min_off=MIN_OFF, border=BORDER):
+    '''Cuts the activations out of a 1 second recording
+
+    Parameters
+    ----------
+    watts : 1 second power of one appliance
+    on_power : watts above which the appliance is on
+    min_on : seconds, shorter activations are dropped
+    min_off : seconds, activations closer than this are merged into one
+    border : seconds of recording kept before and after every activation
+
+    Returns: (list of float32 activations, int array of off seconds between them)
+    '''
+    on = np.r_[False, watts >= on_power, False].astype(np.int8)
+    edges = np.diff(on)
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    if len(starts) == 0:
+        return [], np.empty(0, dtype=np.int64)
+
+    # Merge activations separated by short off periods
+    keep = np.r_[True, starts[1:] - ends[:-1] >= min_off]
+    starts = starts[keep]
+    ends = ends[np.r_[keep[1:], True]]
+
+    long_enough = ends - starts >= min_on
+    starts, ends = starts[long_enough], ends[long_enough]
+    gaps = starts[1:] - ends[:-1]
+
+    activations = [watts[max(s - border, 0):e + border].astype(np.float32) for s, e in zip(starts, ends)]
+    return activations, gaps
+
+
+def find_recordings(sources=SOURCES):
+    '''Returns (path, appliance type) of every recording under `sources`
+
+    Recordings sit either in an appliance folder (allCSV/fridge/*.csv) or
+    directly in the source folder with the appliance in the file name.
+    '''
+    recordings = []
+    for source in sources:
+        for f in sorted(os.listdir(source)):
+            path = os.path.join(source, f)
+            if os.path.isdir(path):
+                appliance = appliance_type(f)
+                if appliance is None:
+                    continue
+                recordings += [(os.path.join(path, x), appliance) for x in sorted(os.listdir(path))
+                               if x.endswith('.csv')]
+            elif f.endswith('.csv') and appliance_type(f) is not None:
+                recordings.append((path, appliance_type(f)))
+    return recordings
+
+
+class ActivationLibrary(object):
+    '''The activations of every appliance type, each type packed in one array
+
+    Attributes
+    ----------
+    values : dict of appliance -> float32 array of all its activations back to back
+    offsets : dict of appliance -> int64 start of every activation in `values`
+    lengths : dict of appliance -> int64 length of every activation
+    gaps : dict of appliance -> int64 off seconds seen between activations
+    '''
+
+    def __init__(self):
+        self.values = {}
+        self.offsets = {}
+        self.lengths = {}
+        self.gaps = {}
+
+    @property
+    def appliances(self):
+        return sorted(self.values)
+
+    def add(self, appliance, activations, gaps):
+        '''Adds activations of `appliance`, ones already in the library are skipped'''
+        seen = set()
+        old = []
+        if appliance in self.values:
+            old = [self.values[appliance][o:o + l] for o, l in zip(self.offsets[appliance], self.lengths[appliance])]
+            seen = set(a.tobytes() for a in old)
+        new = []
+        for a in activations:
+            if a.tobytes() not in seen:
+                seen.add(a.tobytes())
+                new.append(a)
+        if not old and not new:
+            return
+
+        everything = old + new
+        lengths = np.array([len(a) for a in everything], dtype=np.int64)
+        self.values[appliance] = np.concatenate(everything)
+        self.lengths[appliance] = lengths
+        self.offsets[appliance] = np.r_[0, np.cumsum(lengths)[:-1]].astype(np.int64)
+        self.gaps[appliance] = np.r_[self.gaps.get(appliance, np.empty(0, dtype=np.int64)), gaps]
+
+    def __len__(self):
+        return sum(len(l) for l in self.lengths.values())
+
+
+def build_library(sources=SOURCES, on_power=ON_POWER, min_on=MIN_ON, min_off=MIN_OFF, border=BORDER):
+    '''Extracts the activations of every recording under `sources`'''
+    library = ActivationLibrary()
+    for path, appliance in find_recordings(sources):
+        activations, gaps = extract_activations(read_recording(path), on_power, min_on, min_off, border)
+        library.add(appliance, activations, gaps)
+    return library
+
+
+def _start_times(rng, library, appliance, days, uses_per_day):
+    '''Draws the start second and activation of every use of `appliance`
+
+    Returns: (int64 start seconds, int64 activation numbers)
+    '''
+    lengths = library.lengths[appliance]
+    duration = days * 86400
+
+    if appliance in CYCLIC:
+        # Cycles follow each other, separated by off periods seen in the recordings
+        gaps = library.gaps[appliance]
+        if len(gaps) == 0:
+            gaps = np.array([int(lengths.mean())])
+        n = int(duration / (lengths.mean() + gaps.mean()) * 1.2) + 1
+        chosen = rng.integers(0, len(lengths), n)
+        steps = lengths[chosen] + rng.choice(gaps, n)
+        starts = np.r_[0, np.cumsum(steps)[:-1]] + rng.integers(0, int(steps[0]) + 1)
+        keep = starts < duration
+        return starts[keep], chosen[keep]
+
+    n = rng.poisson(uses_per_day * days)
+    day = rng.integers(0, days, n)
+    hour = rng.choice(24, n, p=DAILY_PROFILE / DAILY_PROFILE.sum())
+    starts = day * 86400 + hour * 3600 + rng.integers(0, 3600, n)
+    return np.sort(starts), rng.integers(0, len(lengths), n)
+
+
+def synthesize_appliance(rng, library, appliance, days, uses_per_day=None):
+    '''Builds `days` of 1 second power of one appliance out of its activations
+
+    Every activation is placed at once: the sample positions of all chosen
+    activations are laid out with np.repeat and summed onto the timeline
+    with np.bincount, there is no loop over activations.
+
+    Returns: float32 array of days * 86400 watts
+    '''
+    duration = days * 86400
+    if uses_per_day is None:
+        uses_per_day = USES_PER_DAY.get(appliance, 1.0)
+    starts, chosen = _start_times(rng, library, appliance, days, uses_per_day)
+    if len(starts) == 0:
+        return np.zeros(duration, dtype=np.float32)
+
+    lengths = library.lengths[appliance][chosen]
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    positions = np.repeat(starts, lengths) + within
+    values = library.values[appliance][np.repeat(library.offsets[appliance][chosen], lengths) + within]
+
+    inside = positions < duration
+    return np.bincount(positions[inside], weights=values[inside], minlength=duration).astype(np.float32)
+
+
+def synthesize_building(library, days, seed, min_appliances=2, base_load=(5, 60)):
+    '''Draws the appliances of one household and their power
+
+    Parameters
+    ----------
+    library : ActivationLibrary
+    days : length of the recording
+    seed : seed of the building's random generator, results are reproducible
+    min_appliances : smallest number of appliances a household has
+    base_load : (low, high) watts of constant always-on load added to the aggregate
+
+    Returns: (list of appliance types, float32 array of shape (days * 86400, 1 + appliances)),
+        column 0 is the aggregate
+    '''
+    rng = np.random.default_rng(seed)
+    appliances = library.appliances
+    n = rng.integers(min(min_appliances, len(appliances)), len(appliances) + 1)
+    appliances = sorted(str(a) for a in rng.choice(appliances, n, replace=False))
+
+    power = np.empty((days * 86400, len(appliances) + 1), dtype=np.float32)
+    for i, appliance in enumerate(appliances, 1):
+        # Households use their appliances more or less than average
+        uses = USES_PER_DAY.get(appliance, 1.0) * rng.lognormal(0, 0.5)
+        power[:, i] = synthesize_appliance(rng, library, appliance, days, uses)
+    power[:, 0] = power[:, 1:].sum(axis=1) + rng.uniform(*base_load)
+    return appliances, power
+
+
+def _write_building(library, building, days, seed, start, tmp, periods=PERIODS, device=None):
+    '''Synthesizes one building, its pyramid levels and good sections into a temporary h5 file
+
+    device : (sample_period, max_sample_period) of the meters, read from
+        meter_devices.yaml if None
+
+    Returns: list of appliance types, meter i + 2 is appliance i
+    '''
+    if device is None:
+        device = device_periods()
+    appliances, power = synthesize_building(library, days, seed)
+    index = pd.to_datetime(start + np.arange(len(power), dtype=np.int64), unit='s', utc=True)
+    columns = pd.MultiIndex.from_tuples([('power', 'apparent')], names=LEVEL_NAMES)
+    with pd.HDFStore(tmp, 'w', complevel=COMPLEVEL, complib=COMPLIB) as store:
+        for meter in range(power.shape[1]):
+            df = pd.DataFrame(power[:, meter], index=index, columns=columns)
+            key = '/building' + str(building) + '/elec/meter' + str(meter + 1)
+            store.append(key, df, format='table')
+            build_pyramid(store, key, periods)
+            build_sections(store, key, *device)
+    return appliances
+
+
+def building_metadata(building, appliances, device_model='Emporia Smart Plug'):
+    '''Returns the building#.yaml content of a synthetic building'''
+    elec_meters = {1: {'site_meter': True, 'device_model': device_model}}
+    appliance_list = []
+    for meter, appliance in enumerate(appliances, 2):
+        elec_meters[meter] = {'submeter_of': 1, 'device_model': device_model}
+        appliance_list.append({'type': appliance, 'instance': 1, 'meters': [meter]})
+    return {'instance': building, 'elec_meters': elec_meters, 'appliances': appliance_list}
+
+
+def write_metadata(metadata_dir, buildings, template_dir=METADATA_DIR):
+    '''Writes dataset.yaml, meter_devices.yaml and one building#.yaml per building
+
+    Parameters
+    ----------
+    metadata_dir : directory to write the yaml files to
+    buildings : dict of building number -> list of appliance types
+    template_dir : metadata of the real dataset, dataset.yaml and
+        meter_devices.yaml are based on it
+    '''
+    if not os.path.exists(metadata_dir):
+        os.makedirs(metadata_dir)
+    shutil.copy(os.path.join(template_dir, 'meter_devices.yaml'), metadata_dir)
+
+    with open(os.path.join(template_dir, 'dataset.yaml')) as f:
+        dataset = yaml.safe_load(f)
+    dataset['name'] = 'Synthetic Senior Design Dataset'
+    dataset['description'] = 'Synthetic households built from the activations of the Senior Design recordings'
+    dataset['number_of_buildings'] = len(buildings)
+    with open(os.path.join(metadata_dir, 'dataset.yaml'), 'w') as f:
+        yaml.safe_dump(dataset, f, default_flow_style=False, sort_keys=False)
+
+    for building, appliances in buildings.items():
+        with open(os.path.join(metadata_dir, 'building' + str(building) + '.yaml'), 'w') as f:
+            yaml.safe_dump(building_metadata(building, appliances), f, default_flow_style=False, sort_keys=False)
+
+
+def generate(h5_filename, metadata_dir, n_buildings, days, library=None, seed=0, start=START,
+             workers=None, chunksize=CHUNKSIZE, periods=PERIODS):
+    '''Writes a synthetic nilmtk dataset of `n_buildings` households
+
+    Buildings, their pyramid levels and good sections are synthesized by a process pool,
+    each into its own temporary h5 file, then copied into `h5_filename`
+    chunk by chunk the same way csvToH5.py does.
+
+    Parameters
+    ----------
+    h5_filename : h5 file to create, it is overwritten
+    metadata_dir : directory the metadata yaml files are written to
+    n_buildings : number of households
+    days : length of every household's recording
+    library : ActivationLibrary, built from SOURCES if None
+    seed : seed of the whole dataset, building i uses (seed, i)
+    start : epoch of the first sample
+    workers : number of buildings synthesized in parallel, defaults to the cpu count
+    chunksize : number of rows held in memory at once while copying
+    periods : sample periods in seconds precomputed for every meter, see pyramid.py
+
+    Returns: dict of building number -> list of appliance types
+    '''
+    if library is None:
+        library = build_library()
+
+    buildings = {}
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(h5_filename)))
+    try:
+        with pd.HDFStore(h5_filename, 'w', complevel=COMPLEVEL, complib=COMPLIB) as store, \
+                ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = {}
+            for building in range(1, n_buildings + 1):
+                tmp = os.path.join(tmpdir, 'building' + str(building) + '.h5')
+                jobs[building] = (tmp, pool.submit(_write_building, library, building, days,
+                                                   [seed, building], start, tmp, periods))
+
+            for building, (tmp, job) in jobs.items():
+                buildings[building] = job.result()
+                with pd.HDFStore(tmp, 'r') as tmpstore:
+                    keys = tmpstore.keys()
+                for key in keys:
+                    _copy_meter(store, tmp, key, chunksize)
+                os.remove(tmp)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    write_metadata(metadata_dir, buildings)
+    convert_yaml_to_hdf5(metadata_dir, h5_filename)
+    return buildings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthesize multi-appliance households from the recorded activations')
+    parser.add_argument('--buildings', type=int, default=100)
+    parser.add_argument('--days', type=int, default=28)
+    parser.add_argument('--out', default='SeniorDataset/h5_files/synthetic.h5')
+    parser.add_argument('--metadata', default='SeniorDataset/synthetic_metadata',
+                        help='directory the metadata yaml files are written to')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--no-pyramid', action='store_true', help="don't precompute the downsampled levels")
+    args = parser.parse_args()
+
+    library = build_library()
+    for appliance in library.appliances:
+        print(appliance + ': ' + str(len(library.lengths[appliance])) + ' activations')
+
+    periods = [] if args.no_pyramid else PERIODS
+    buildings = generate(args.out, args.metadata, args.buildings, args.days, library, args.seed,
+                         workers=args.workers, periods=periods)
+    print(args.out + ': ' + str(len(buildings)) + ' buildings of ' + str(args.days) + ' days')
@@ -0,0 +1,91 @@
+import numpy as np
+
+# Running statistics of a column of power values.  normstats.py reads them
+# from the tables SeniorDataset/meterStats.py stores next to every meter, or
+# computes them from the samples a model is trained on, so this has to match
+# SeniorDataset/columnStats.py, which meterStats.py writes them with.
+
+RESOLUTION = 1.0     # watts per histogram bin, the precision of the quantiles
+MAX_BINS = 2**20     # larger values are counted in the last bin
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 0.999]
+MOMENTS = ['rows', 'count', 'min', 'max', 'mean', 'm2', 'std']
+
+
+def quantile_name(q):
+    return 'q' + repr(q)
+
+
+class ColumnStats(object):
+    '''Count, min, max, mean, variance and histogram of one column, updated chunk by chunk
+
+    The moments are merged with Chan's parallel update, so the result is the
+    same as over the whole column at once. NaNs are skipped. The histogram
+    has `resolution` watt bins from 0, negative values count in the first.
+    '''
+
+    def __init__(self, resolution=RESOLUTION):
+        self.resolution = resolution
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.histogram = np.zeros(0, dtype=np.int64)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        chunk = ColumnStats(self.resolution)
+        chunk.count = len(values)
+        chunk.mean = values.mean()
+        chunk.m2 = np.square(values - chunk.mean).sum()
+        chunk.min, chunk.max = values.min(), values.max()
+        chunk.histogram = np.bincount(np.clip(values / self.resolution, 0, MAX_BINS - 1).astype(np.int64))
+        self.merge(chunk)
+
+    def merge(self, other):
+        '''Adds the values `other` was computed over, e.g. new rows or another building's'''
+        if other.count == 0:
+            return
+        delta = other.mean - self.mean
+        total = self.count + other.count
+        self.mean += delta * other.count / total
+        self.m2 += other.m2 + delta**2 * self.count * other.count / total
+        self.count = total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if len(other.histogram) > len(self.histogram):
+            self.histogram = np.r_[self.histogram, np.zeros(len(other.histogram) - len(self.histogram), dtype=np.int64)]
+        self.histogram[:len(other.histogram)] += other.histogram
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count) if self.count else np.nan
+
+    def quantile(self, q):
+        '''The `q` quantile, to within one histogram bin'''
+        if self.count == 0:
+            return np.nan
+        b = np.searchsorted(np.cumsum(self.histogram), q * self.count)
+        return float(np.clip((b + 0.5) * self.resolution, self.min, self.max))
+
+    def summary(self, rows=None):
+        '''The statistics as a list in the order of MOMENTS and QUANTILES, `rows` defaults to the count'''
+        values = [self.count if rows is None else rows, self.count, self.min, self.max, self.mean, self.m2, self.std]
+        return values + [self.quantile(q) for q in QUANTILES]
+
+    def as_dict(self):
+        '''dict of statistic name -> float, without 'rows' and 'm2', e.g. for a disaggregator's stats'''
+        names = MOMENTS + [quantile_name(q) for q in QUANTILES]
+        return dict((n, float(v)) for n, v in zip(names, self.summary()) if n not in ('rows', 'm2'))
+
+    @classmethod
+    def from_summary(cls, summary, histogram, resolution):
+        stats = cls(resolution)
+        stats.count = int(summary['count'])
+        stats.min, stats.max = summary['min'], summary['max']
+        stats.mean, stats.m2 = summary['mean'], summary['m2']
+        stats.histogram = np.array(histogram, dtype=np.int64)
+        return stats
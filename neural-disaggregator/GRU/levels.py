@@ -0,0 +1,89 @@
+from __future__ import print_function, division
+
+import numpy as np
+import pandas as pd
+
+from nilmtk.datastore import HDFDataStore
+from nilmtk.timeframe import TimeFrame
+
+# Reads the downsampled levels SeniorDataset/pyramid.py stores next to every
+# meter at ingest (/building1/elec/meter1/period60 etc.).  nilmtk's
+# power_series(sample_period=60) reads the 1 second table and resamples it on
+# every load; power_series() here reads the 60 second means instead when the
+# level is there, within the store's window and the sections asked for.
+
+LEVEL_NODE = 'period'
+AC_TYPES = ['active', 'apparent', 'reactive']   # the order nilmtk's power_series() prefers them in
+CHUNKSIZE = 500000
+# Keyword arguments of nilmtk's power_series() a level can be read with, others go through nilmtk
+LEVEL_KWARGS = set(['sample_period', 'sections', 'ac_type', 'physical_quantity', 'chunksize'])
+
+
+def power_column(columns, ac_type=None):
+    '''The power column nilmtk's power_series() reads out of a meter table's `columns`'''
+    power = [c for c in columns if c[0] == 'power']
+    types = [ac_type] if isinstance(ac_type, str) else AC_TYPES
+    for t in types:
+        if ('power', t) in power:
+            return ('power', t)
+    return power[0] if power else columns[0]
+
+
+def level_key(meter, sample_period):
+    '''Key of the `sample_period` level of a meter, None if it has none'''
+    store = getattr(meter, 'store', None)
+    key = getattr(meter, 'key', None)
+    if not isinstance(store, HDFDataStore) or key is None or not sample_period:
+        return None
+    if sample_period != int(sample_period):
+        return None
+    lkey = '/' + key.strip('/') + '/' + LEVEL_NODE + str(int(sample_period))
+    return lkey if lkey in store.store else None
+
+
+def power_series(meter, **load_kwargs):
+    '''Yields the chunks of `meter.power_series(**load_kwargs)`, from the stored level when there is one
+
+    Parameters
+    ----------
+    meter : nilmtk.ElecMeter or MeterGroup. A meter of an HDFDataStore
+        with a level at `sample_period` is read from it, everything else,
+        e.g. a MeterGroup of two mains, through `meter.power_series()`
+    **load_kwargs : keyword arguments of `meter.power_series()`
+
+    Yields: float32 pd.Series with a `timeframe`, as nilmtk's do
+    '''
+    lkey = level_key(meter, load_kwargs.get('sample_period'))
+    if (lkey is None or not set(load_kwargs) <= LEVEL_KWARGS
+            or load_kwargs.get('physical_quantity', 'power') != 'power'):
+        return meter.power_series(**load_kwargs)
+    return _read_level(meter, lkey, **load_kwargs)
+
+
+def _read_level(meter, lkey, sample_period, sections=None, ac_type=None, physical_quantity=None,
+                chunksize=CHUNKSIZE):
+    store = meter.store
+    period = pd.Timedelta(seconds=sample_period)
+    # The levels are indexed in UTC, nilmtk gives the timezone of the meter table
+    tz = store.store.select('/' + meter.key.strip('/'), start=0, stop=1).index.tz
+    column = power_column(list(store.store.select(lkey, start=0, stop=0).columns), ac_type)
+
+    frames = [store.window] if sections is None else [store.window.intersection(s) for s in sections]
+    for frame in frames:
+        if frame.empty:
+            continue
+        terms = []
+        start, end = frame.start, frame.end
+        if start is not None:
+            terms.append('index >= start')
+        if end is not None:
+            terms.append('index < end')
+        where = ' & '.join(terms) if terms else None
+        for chunk in store.store.select(lkey, where=where, chunksize=int(chunksize)):
+            if len(chunk) == 0:
+                continue
+            series = chunk[column].astype(np.float32)
+            if tz is not None:
+                series.index = series.index.tz_convert(tz)
+            series.timeframe = TimeFrame(series.index[0], series.index[-1] + period)
+            yield series
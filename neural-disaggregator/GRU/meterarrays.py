@@ -0,0 +1,150 @@
+from __future__ import print_function, division
+import struct
+
+import numpy as np
+import pandas as pd
+
+from levels import power_series
+
+# Contiguous float32 meter files that can be memory-mapped for training and
+# inference without going through nilmtk/pandas. A file is a 32 byte header
+# (magic, start in epoch nanoseconds, sample period in seconds, length)
+# followed by one little endian float32 per sample period. Gaps in the meter
+# are written as 0, the value the disaggregators fill NaNs with.
+
+MAGIC = b'NILMF32\x00'
+HEADER = struct.Struct('<8sqdq')
+EPOCH = pd.Timestamp(0, tz='UTC')
+
+
+def _write_header(f, start_ns, sample_period, length):
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, start_ns, sample_period, length))
+
+
+def export_series(chunks, filename, sample_period):
+    '''Writes chunks of a regularly sampled power series to a meter array file
+
+    Parameters
+    ----------
+    chunks : iterable of pd.Series with a tz-aware DatetimeIndex, in time order
+    filename : file to write
+    sample_period : seconds between samples
+
+    Returns: number of samples written
+    '''
+    period_ns = int(round(sample_period * 1e9))
+    start_ns = None
+    length = 0
+    with open(filename, 'wb') as f:
+        _write_header(f, 0, sample_period, 0)
+        for chunk in chunks:
+            chunk = chunk.dropna()
+            if len(chunk) == 0:
+                continue
+            stamps = np.asarray((chunk.index - EPOCH) // pd.Timedelta(1, 'ns'), dtype=np.int64)
+            if start_ns is None:
+                start_ns = int(stamps[0])
+            positions = (stamps - start_ns + period_ns // 2) // period_ns
+            keep = positions >= length
+            positions, values = positions[keep], chunk.values[keep]
+            if len(positions) == 0:
+                continue
+
+            # Everything from the last written sample up to this chunk's end,
+            # missing samples stay 0
+            block = np.zeros(positions[-1] + 1 - length, dtype='<f4')
+            block[positions - length] = values
+            f.write(block.tobytes())
+            length += len(block)
+
+        _write_header(f, 0 if start_ns is None else start_ns, sample_period, length)
+    return length
+
+
+def export_meter(meter, filename, sample_period, **load_kwargs):
+    '''Writes a nilmtk.ElecMeter to a meter array file
+
+    Parameters
+    ----------
+    meter : nilmtk.ElecMeter
+    filename : file to write
+    sample_period : seconds between samples, passed to `meter.power_series()`
+    **load_kwargs : keyword arguments passed to `meter.power_series()`
+
+    Returns: number of samples written
+    '''
+    load_kwargs['sample_period'] = sample_period
+    return export_series(power_series(meter, **load_kwargs), filename, sample_period)
+
+
+class MeterArray(object):
+    '''A meter array file mapped into memory
+
+    Attributes
+    ----------
+    values : read only np.memmap of float32 samples
+    start : pd.Timestamp of the first sample
+    sample_period : seconds between samples
+    '''
+
+    def __init__(self, filename, values=None, start=None, sample_period=None):
+        if values is None:
+            with open(filename, 'rb') as f:
+                magic, start_ns, sample_period, length = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError("{} is not a meter array file".format(filename))
+            values = np.memmap(filename, dtype='<f4', mode='r', offset=HEADER.size, shape=(length,))
+            start = pd.Timestamp(start_ns, unit='ns', tz='UTC')
+        self.filename = filename
+        self.values = values
+        self.start = start
+        self.sample_period = sample_period
+
+    def __len__(self):
+        return len(self.values)
+
+    def index_of(self, timestamp):
+        '''Position of the sample at or after `timestamp`'''
+        delta = (pd.Timestamp(timestamp) - self.start) / pd.Timedelta(seconds=self.sample_period)
+        return min(max(int(np.ceil(delta)), 0), len(self.values))
+
+    def window(self, start=None, end=None):
+        '''Returns a MeterArray viewing [start, end) of this one, no data is copied'''
+        first = 0 if start is None else self.index_of(start)
+        last = len(self.values) if end is None else self.index_of(end)
+        last = max(first, last)
+        return MeterArray(self.filename, self.values[first:last],
+                          self.start + pd.Timedelta(seconds=first * self.sample_period),
+                          self.sample_period)
+
+    def timestamps(self, first=0, last=None):
+        '''DatetimeIndex of samples [first, last)'''
+        last = len(self.values) if last is None else last
+        return pd.date_range(self.start + pd.Timedelta(seconds=first * self.sample_period),
+                             periods=last - first, freq=pd.Timedelta(seconds=self.sample_period))
+
+    def series(self, first=0, last=None):
+        '''pd.Series over samples [first, last), for `disaggregate_chunk`. The values aren't copied'''
+        last = len(self.values) if last is None else last
+        return pd.Series(self.values[first:last], index=self.timestamps(first, last), copy=False)
+
+
+def open_meter(filename):
+    '''Maps a meter array file written by `export_meter` into memory'''
+    return MeterArray(filename)
+
+
+def align(mains, meter):
+    '''Returns views of two MeterArrays over the time span they share
+
+    Both must have the same sample period and sample grid.
+    '''
+    assert mains.sample_period == meter.sample_period, "Meter arrays must share their sample period"
+    start = max(mains.start, meter.start)
+    end = min(mains.start + pd.Timedelta(seconds=len(mains) * mains.sample_period),
+              meter.start + pd.Timedelta(seconds=len(meter) * meter.sample_period))
+    mains, meter = mains.window(start, end), meter.window(start, end)
+    n = min(len(mains), len(meter))
+    return (MeterArray(mains.filename, mains.values[:n], mains.start, mains.sample_period),
+            MeterArray(meter.filename, meter.values[:n], meter.start, meter.sample_period))
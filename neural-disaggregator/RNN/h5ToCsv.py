@@ -1,29 +1,158 @@
 #!/usr/bin/env python3
 
+# Exports the tables of an h5 file (e.g. ukdale.h5) to one csv per key.
+# Tables are read in chunks with HDFStore.select and appended to the csv as
+# they come, so memory use only depends on --chunksize, and several keys
+# are exported in parallel worker processes.
+#
 # to run
-# python3 h5ToCsv.py ukdale.h5 > ukdale.csv
+# python3 h5ToCsv.py ukdale.h5
+# python3 h5ToCsv.py ukdale.h5 --building 1 --meter 1 --meter 5 --start 2014-01-01 --end 2014-02-01 --gzip
+import os
+import re
+import gzip
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
-import sys
-print('hello world')
-fpath = sys.argv[1]
-print(fpath)
-
-print('printing hdf keys')
-
-
-outpath = 'CSVFiles/UKDALE'
-with pd.HDFStore(fpath, 'r') as hdf:
-    # This prints a list of all group names:
-    print(hdf.keys())
-    print(len(hdf.keys()))
-    count = 0
-    for key in hdf.keys():  
-        if(count == 1):
-            break
-        print(count) 
-        df = pd.read_hdf(fpath, key=key)
-        print(df.head)
-        # df.astype({'physical_quantity'})
-        # print(df.dtypes)
-        df.to_csv(outpath+key+'.csv', index=True)
-        count += 1
\ No newline at end of file
+
+CHUNKSIZE = 1000000   # rows held in memory at once by each worker
+
+
+def select_keys(keys, buildings=None, meters=None):
+    '''Filters h5 keys like /building1/elec/meter1 by building and meter number
+
+    Parameters
+    ----------
+    keys : list of h5 keys
+    buildings : list of building numbers to keep, None keeps all
+    meters : list of meter numbers to keep, None keeps all
+
+    Returns: the matching keys, in their original order
+    '''
+    selected = []
+    for key in keys:
+        building = re.search(r'/building(\d+)(/|$)', key)
+        meter = re.search(r'/meter(\d+)$', key)
+        if buildings and (building is None or int(building.group(1)) not in buildings):
+            continue
+        if meters and (meter is None or int(meter.group(1)) not in meters):
+            continue
+        selected.append(key)
+    return selected
+
+
+def _localize(timestamp, tz):
+    '''pd.Timestamp of `timestamp`, a naive one is taken to be in timezone `tz` of the table'''
+    if timestamp is None:
+        return None
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tz is None and tz is not None:
+        timestamp = timestamp.tz_localize(tz)
+    return timestamp
+
+
+def _where(start, end):
+    '''Builds the HDFStore where clause for the window [start, end)'''
+    terms = []
+    if start is not None:
+        terms.append('index >= start')
+    if end is not None:
+        terms.append('index < end')
+    return ' & '.join(terms) if terms else None
+
+
+def export_key(h5_filename, key, outfile, start=None, end=None, chunksize=CHUNKSIZE, compress=False):
+    '''Writes one table of an h5 file to a csv chunk by chunk
+
+    Parameters
+    ----------
+    h5_filename : h5 file to read
+    key : table to export, e.g. '/building1/elec/meter1'
+    outfile : csv file to write
+    start, end : optional timestamps, only rows in [start, end) are exported
+    chunksize : number of rows held in memory at once
+    compress : write a gzip compressed csv
+
+    Returns: number of rows written
+    '''
+    rows = 0
+    opener = gzip.open if compress else open
+    with pd.HDFStore(h5_filename, 'r') as store, opener(outfile, 'wt', newline='') as csvfile:
+        tz = getattr(store.select(key, stop=1).index, 'tz', None)
+        start, end = _localize(start, tz), _localize(end, tz)
+        where = _where(start, end)
+        if store.get_storer(key).is_table:
+            chunks = store.select(key, where=where, chunksize=chunksize)
+        else:
+            # Fixed format tables can only be read whole
+            df = store.select(key)
+            if start is not None:
+                df = df[df.index >= start]
+            if end is not None:
+                df = df[df.index < end]
+            chunks = [df]
+
+        header = True
+        for chunk in chunks:
+            chunk.to_csv(csvfile, header=header, index=True)
+            header = False
+            rows += len(chunk)
+    return rows
+
+
+def export(h5_filename, outdir, keys=None, start=None, end=None, workers=None,
+           chunksize=CHUNKSIZE, compress=False):
+    '''Exports tables of an h5 file to <outdir><key>.csv, one worker per key
+
+    Parameters
+    ----------
+    h5_filename : h5 file to read
+    outdir : directory the csv tree is written to
+    keys : keys to export, defaults to every key of the file
+    start, end : optional timestamps, only rows in [start, end) are exported
+    workers : number of keys exported in parallel, defaults to the cpu count
+    chunksize : number of rows held in memory at once by each worker
+    compress : write gzip compressed csvs (.csv.gz)
+
+    Returns: dict of key -> number of rows written
+    '''
+    if keys is None:
+        with pd.HDFStore(h5_filename, 'r') as store:
+            keys = store.keys()
+
+    suffix = '.csv.gz' if compress else '.csv'
+    outfiles = [outdir + key + suffix for key in keys]
+    for outfile in outfiles:
+        os.makedirs(os.path.dirname(outfile), exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        exports = [pool.submit(export_key, h5_filename, key, outfile, start, end, chunksize, compress)
+                   for key, outfile in zip(keys, outfiles)]
+        return dict((key, e.result()) for key, e in zip(keys, exports))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the tables of an h5 file to csv files')
+    parser.add_argument('h5_filename')
+    parser.add_argument('--outdir', default='CSVFiles/UKDALE',
+                        help='the csv of key /building1/elec/meter1 is written to <outdir>/building1/elec/meter1.csv')
+    parser.add_argument('--building', type=int, action='append',
+                        help='only export this building, can be repeated')
+    parser.add_argument('--meter', type=int, action='append',
+                        help='only export this meter number, can be repeated')
+    parser.add_argument('--start', help='first timestamp exported, e.g. 2014-01-01')
+    parser.add_argument('--end', help='timestamp the export stops before')
+    parser.add_argument('--gzip', action='store_true', help='write compressed .csv.gz files')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE)
+    args = parser.parse_args()
+
+    with pd.HDFStore(args.h5_filename, 'r') as hdf:
+        keys = select_keys(hdf.keys(), args.building, args.meter)
+    print('exporting ' + str(len(keys)) + ' keys')
+
+    written = export(args.h5_filename, args.outdir, keys, args.start, args.end,
+                     args.workers, args.chunksize, args.gzip)
+    for key in keys:
+        print(key + ': ' + str(written[key]) + ' rows')
@@ -0,0 +1,170 @@
+from __future__ import print_function, division
+
+import numpy as np
+
+# ONNX export of the disaggregator models and an onnxruntime stand-in for the
+# keras model.  OnnxModel has the predict() of a keras model, so after
+# import_onnx() a disaggregator's disaggregate() and disaggregate_chunk() run
+# on onnxruntime unchanged, without importing keras or TensorFlow for the
+# prediction.  mmax and the window size travel in the ONNX file's metadata.
+# tf2onnx and TensorFlow are only needed by save_onnx(), onnxruntime only by
+# OnnxModel and quantize_onnx().  quantize_onnx() turns a saved model into an
+# int8 one, its activation ranges calibrated on windows of real mains, for
+# small CPUs near the meters.
+
+INPUT_NAME = 'mains'
+OPSET = 13
+BATCH_SIZE = 4096
+CALIBRATION_WINDOWS = 2000
+
+
+def save_onnx(model, filename, metadata):
+    '''Converts a keras model to an ONNX file
+
+    Parameters
+    ----------
+    model : keras model of a disaggregator
+    filename : .onnx file to write
+    metadata : dict of name -> value stored as metadata of the ONNX model,
+        values are written as strings
+    '''
+    import tensorflow as tf
+    import tf2onnx
+    import onnx
+
+    spec = (tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32, name=INPUT_NAME),)
+    # Converting a traced call instead of tf2onnx.convert.from_keras works
+    # for every Keras version
+    function = tf.function(lambda mains: model(mains, training=False), input_signature=spec)
+    proto, _ = tf2onnx.convert.from_function(function, input_signature=spec, opset=OPSET)
+    for key in metadata:
+        entry = proto.metadata_props.add()
+        entry.key, entry.value = key, str(metadata[key])
+    onnx.save(proto, filename)
+
+
+def calibration_windows(mains, window_size, count=CALIBRATION_WINDOWS, sequence=False, seed=0):
+    '''Random model inputs from normalized mains, to calibrate quantize_onnx() on
+
+    Parameters
+    ----------
+    mains : 1d array of normalized aggregate data
+    window_size : input length of the model, 1 for RNN and GRU
+    count : number of windows drawn
+    sequence : draw the non overlapping windows a DAE disaggregates
+        instead of windows starting at any sample
+    seed : seed of the random draw
+
+    Returns: float32 array of shape (count, window_size, 1)
+    '''
+    mains = np.nan_to_num(np.asarray(mains, dtype=np.float32))
+    if sequence:
+        starts = np.arange(0, len(mains) - window_size + 1, window_size)
+    else:
+        starts = np.arange(len(mains) - window_size + 1)
+    starts = np.random.RandomState(seed).choice(starts, min(count, len(starts)), replace=False)
+    return mains[starts[:, None] + np.arange(window_size)][:, :, None]
+
+
+def quantize_onnx(filename, quantized_filename, windows=None, batch_size=100, per_channel=False):
+    '''Writes an int8 copy of an ONNX file saved by save_onnx()
+
+    With calibration `windows` the weights and activations are quantized
+    statically (QDQ, ranges taken from running the windows through the
+    float model).  Without them only the weights are, the activations are
+    quantized on the fly (quantize_dynamic), which also covers the LSTM
+    and GRU of the RNN models.  The metadata is carried over.
+
+    Parameters
+    ----------
+    filename : .onnx file written by save_onnx()
+    quantized_filename : .onnx file to write
+    windows : model inputs to calibrate on, see calibration_windows(), or None
+    batch_size : number of windows run at once while calibrating
+    per_channel : quantize the weights per output channel instead of per tensor
+    '''
+    import onnx
+    from onnxruntime import quantization
+
+    if windows is None:
+        quantization.quantize_dynamic(filename, quantized_filename, weight_type=quantization.QuantType.QInt8,
+                                      per_channel=per_channel)
+    else:
+        class Windows(quantization.CalibrationDataReader):
+            def __init__(self):
+                self.batches = iter(range(0, len(windows), batch_size))
+
+            def get_next(self):
+                start = next(self.batches, None)
+                if start is None:
+                    return None
+                return {INPUT_NAME: np.asarray(windows[start:start+batch_size], dtype=np.float32)}
+
+        quantization.quantize_static(filename, quantized_filename, Windows(),
+                                     quant_format=quantization.QuantFormat.QDQ,
+                                     activation_type=quantization.QuantType.QUInt8,
+                                     weight_type=quantization.QuantType.QInt8,
+                                     per_channel=per_channel)
+
+    source, quantized = onnx.load(filename), onnx.load(quantized_filename)
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(source.metadata_props)
+    onnx.save(quantized, quantized_filename)
+
+
+class OnnxModel(object):
+    '''A model saved by save_onnx(), run by onnxruntime on the CPU
+
+    Attributes
+    ----------
+    session : onnxruntime.InferenceSession
+    metadata : dict of the strings stored by save_onnx()
+    input_shape, output_shape : shapes like those of the keras model,
+        None for the batch axis
+    batch_size : number of rows run at once when predict() gets none
+    '''
+
+    def __init__(self, filename, threads=None, batch_size=BATCH_SIZE):
+        '''Opens an ONNX file
+
+        Parameters
+        ----------
+        filename : .onnx file written by save_onnx()
+        threads : number of threads onnxruntime uses, its default if None
+        batch_size : number of rows run at once when predict() gets none
+        '''
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(filename, options, providers=['CPUExecutionProvider'])
+        self.metadata = dict(self.session.get_modelmeta().custom_metadata_map)
+        self.input_name = self.session.get_inputs()[0].name
+        self.input_shape = self._shape(self.session.get_inputs()[0].shape)
+        self.output_shape = self._shape(self.session.get_outputs()[0].shape)
+        self.batch_size = batch_size
+
+    def _shape(self, shape):
+        return tuple(d if isinstance(d, int) else None for d in shape)
+
+    def predict_on_batch(self, X):
+        return self.session.run(None, {self.input_name: np.asarray(X, dtype=np.float32)})[0]
+
+    def predict(self, X, batch_size=None, **kwargs):
+        '''Like keras' predict(): runs an array, or every batch of a keras Sequence
+
+        Parameters
+        ----------
+        X : array of model inputs, or a keras Sequence yielding them
+        batch_size : number of rows run at once, self.batch_size if None
+        **kwargs : other keras predict() arguments, ignored
+        '''
+        if not isinstance(X, np.ndarray):
+            outputs = [self.predict_on_batch(X[i]) for i in range(len(X))]
+        else:
+            step = batch_size or self.batch_size
+            outputs = [self.predict_on_batch(X[i:i+step]) for i in range(0, len(X), step)]
+        if not outputs:
+            return np.empty((0,) + tuple(d or 0 for d in self.output_shape[1:]), dtype=np.float32)
+        return np.concatenate(outputs)
@@ -0,0 +1,115 @@
+from __future__ import print_function, division
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Training input pipeline.  train() used to read a chunk from the h5 file,
+# normalize it, train on it and only then read the next one, so the model
+# waited for every read.  prefetch_chunks reads the next chunks in a
+# background thread and prepares them on a pool of worker threads while the
+# model trains on the current one.  Chunks are read by a single thread, in
+# order (HDF5 reads of one file don't run in parallel anyway), and at most
+# `size` prepared chunks wait in the queue, so memory stays bounded however
+# slow training is.
+
+WORKERS = 1
+PREFETCH = 2
+
+
+class _Failure(object):
+    '''An exception raised by the reader thread, re-raised in the training thread'''
+
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch_chunks(chunks, prepare, workers=WORKERS, size=PREFETCH):
+    '''Yields prepare(chunk) for every chunk of `chunks`, in order, read and prepared ahead
+
+    Parameters
+    ----------
+    chunks : iterator of chunks, e.g. zip() of power_series() generators
+    prepare : function applied to every chunk on the worker threads
+    workers : number of chunks prepared at the same time
+    size : number of chunks read and prepared ahead of the one in use
+    '''
+    ready = queue.Queue(maxsize=max(size, 1))
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=max(workers, 1))
+
+    def put(item):
+        # Gives up once the consumer is gone, so the thread can't hang on a full queue
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read():
+        try:
+            for chunk in chunks:
+                if not put(pool.submit(prepare, chunk)):
+                    return
+        except Exception as e:
+            put(_Failure(e))
+        put(None)
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            item = ready.get()
+            if item is None:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item.result()
+    finally:
+        stop.set()
+        pool.shutdown(wait=False)
+
+
+def aligned_arrays(mainchunk, meterchunk):
+    '''The samples of both chunks at their common timestamps as arrays, NaNs replaced with 0s
+
+    Parameters
+    ----------
+    mainchunk : pd.Series of the aggregate data
+    meterchunk : pd.Series of the appliance, or time x appliances pd.DataFrame
+
+    Returns: (mains, meter) np.arrays
+    '''
+    mainchunk = mainchunk.fillna(0)
+    meterchunk = meterchunk.fillna(0)
+    ix = mainchunk.index.intersection(meterchunk.index)
+    return np.array(mainchunk.loc[ix]), np.array(meterchunk.loc[ix])
+
+
+def live_buildings(mainchunks, meterchunks, weights=None):
+    '''The buildings of a zip_longest() chunk whose mains and meter haven't run out
+
+    A building with fewer chunks than the others is None in the chunks
+    after its last one, and is left out of those.
+
+    Parameters
+    ----------
+    mainchunks : list of the chunks of the aggregate data, None for a building that ran out
+    meterchunks : list of the chunks of the appliance, aligned with `mainchunks`
+    weights : None, 'equal' or one weight per building, see sampler.py
+
+    Returns: (mainchunks, meterchunks, weights) of the buildings left, the
+        weights cut to them if they are a list
+    '''
+    live = [i for i, (m1, m2) in enumerate(zip(mainchunks, meterchunks)) if m1 is not None and m2 is not None]
+    if weights is not None and not isinstance(weights, str):
+        weights = [weights[i] for i in live]
+    return [mainchunks[i] for i in live], [meterchunks[i] for i in live], weights
@@ -1,4 +1,5 @@
 from __future__ import print_function, division
+from itertools import zip_longest
 import random
 import sys
 
@@ -19,13 +20,27 @@ from nilmtk.feature_detectors import cluster
 from nilmtk.legacy.disaggregate import Disaggregator
 from nilmtk.datastore import HDFDataStore
 
+from meterarrays import align
+from goodsections import good_sections
+from levels import power_series
+from prefetch import prefetch_chunks, aligned_arrays, live_buildings, WORKERS, PREFETCH
+from normstats import meter_stats, combined_stats, array_stats, save_stats, read_stats
+from sampler import CrossBuildingSampler
+from onnxbackend import save_onnx, OnnxModel
+
 class RNNDisaggregator(Disaggregator):
     '''Attempt to create a RNN Disaggregator
 
     Attributes
     ----------
-    model : keras Sequential model
+    model : keras Sequential model, created on first use unless
+        import_model() loads one
     mmax : the maximum value of the aggregate data
+    stats : dict of the count, min, max, mean, std and quantiles (q0.5 ...)
+        of the aggregate data mmax was taken from, see normstats.py
+    lookup : the model's output for every step of `lookup_resolution`
+        watts from 0 to mmax, see compile_lookup(), or None
+    lookup_resolution : watts between two rows of `lookup`
 
     MIN_CHUNK_LENGTH : int
        the minimum length of an acceptable chunk
@@ -36,10 +51,28 @@ class RNNDisaggregator(Disaggregator):
         '''
         self.MODEL_NAME = "LSTM"
         self.mmax = None
+        self.stats = None
         self.MIN_CHUNK_LENGTH = 100
-        self.model = self._create_model()
-
-    def train(self, mains, meter, epochs=1, batch_size=128, **load_kwargs):
+        self.lookup = None
+        self.lookup_resolution = None
+        self._model = None
+
+    @property
+    def model(self):
+        '''The keras model, built and compiled the first time it is needed'''
+        if self._model is None:
+            self._model = self._create_model()
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+
+    def plot(self, to_file='model.png'):
+        '''Draws the model to `to_file`, needs pydot and graphviz'''
+        plot_model(self.model, to_file=to_file, show_shapes=True)
+
+    def train(self, mains, meter, epochs=1, batch_size=128, workers=WORKERS, prefetch=PREFETCH, **load_kwargs):
         '''Train
 
         Parameters
@@ -48,53 +81,78 @@ class RNNDisaggregator(Disaggregator):
         meter : a nilmtk.ElecMeter object for the meter data
         epochs : number of epochs to train
         batch_size : size of batch used for training
+        workers : number of threads preparing the upcoming chunks
+        prefetch : number of chunks read and prepared ahead, see prefetch.py
         **load_kwargs : keyword arguments passed to `meter.power_series()`
         '''
 
-        main_power_series = mains.power_series(**load_kwargs)
-        meter_power_series = meter.power_series(**load_kwargs)
+        chunks = zip(power_series(mains, **load_kwargs), power_series(meter, **load_kwargs))
 
-        # Train chunks
-        run = True
-        mainchunk = next(main_power_series)
-        meterchunk = next(meter_power_series)
+        # mmax is the maximum of the whole mains, from the stats stored next to the meter
         if self.mmax == None:
-            self.mmax = mainchunk.max()
+            self.stats = meter_stats(mains, **load_kwargs).as_dict()
+            self.mmax = self.stats['max']
 
-        while(run):
-            mainchunk = self._normalize(mainchunk, self.mmax)
-            meterchunk = self._normalize(meterchunk, self.mmax)
+        def prepare(chunk):
+            mainchunk, meterchunk = aligned_arrays(*chunk)
+            return self._normalize(mainchunk, self.mmax), self._normalize(meterchunk, self.mmax)
 
+        # Train chunks, the next ones are read and prepared meanwhile
+        for mainchunk, meterchunk in prefetch_chunks(chunks, prepare, workers, prefetch):
             self.train_on_chunk(mainchunk, meterchunk, epochs, batch_size)
-            try:
-                mainchunk = next(main_power_series)
-                meterchunk = next(meter_power_series)
-            except:
-                run = False
 
     def train_on_chunk(self, mainchunk, meterchunk, epochs, batch_size):
         '''Train using only one chunk
 
         Parameters
         ----------
-        mainchunk : chunk of site meter
+        mainchunk : chunk of site meter, a pd.Series or an np.array aligned with meterchunk
         meterchunk : chunk of appliance
         epochs : number of epochs for training
         batch_size : size of batch used for training
         '''
+        self.lookup = None
 
-        # Replace NaNs with 0s
-        mainchunk.fillna(0, inplace=True)
-        meterchunk.fillna(0, inplace=True)
-        ix = mainchunk.index.intersection(meterchunk.index)
-        mainchunk = np.array(mainchunk[ix])
-        meterchunk = np.array(meterchunk[ix])
+        if isinstance(mainchunk, pd.Series):
+            # Replace NaNs with 0s
+            mainchunk.fillna(0, inplace=True)
+            meterchunk.fillna(0, inplace=True)
+            ix = mainchunk.index.intersection(meterchunk.index)
+            mainchunk = np.array(mainchunk[ix])
+            meterchunk = np.array(meterchunk[ix])
 
         mainchunk = np.reshape(mainchunk, (mainchunk.shape[0],1,1))
 
         self.model.fit(mainchunk, meterchunk, epochs=epochs, batch_size=batch_size, shuffle=True)
 
-    def train_across_buildings(self, mainlist, meterlist, epochs=1, batch_size=128, **load_kwargs):
+    def train_from_arrays(self, mains, meter, epochs=1, batch_size=128, chunksize=2**20):
+        '''Train from memory-mapped meter arrays, see meterarrays.py
+
+        The arrays are sliced into chunks without copying, skipping the
+        pandas chunks `power_series()` would build.
+
+        Parameters
+        ----------
+        mains : meterarrays.MeterArray of the aggregate data
+        meter : meterarrays.MeterArray of the appliance
+        epochs : number of epochs to train
+        batch_size : size of batch used for training
+        chunksize : number of samples trained on at once
+        '''
+
+        mains, meter = align(mains, meter)
+        if self.mmax == None:
+            self.stats = array_stats(mains.values, chunksize).as_dict()
+            self.mmax = self.stats['max']
+
+        mmax = np.float32(self.mmax)
+        for start in range(0, len(mains), chunksize):
+            mainchunk = self._normalize(mains.values[start:start+chunksize], mmax)
+            meterchunk = self._normalize(meter.values[start:start+chunksize], mmax)
+            self.train_on_chunk(mainchunk, meterchunk, epochs, batch_size)
+
+    def train_across_buildings(self, mainlist, meterlist, epochs=1, batch_size=128, workers=WORKERS, prefetch=PREFETCH,
+                               weights=None, **load_kwargs):
         '''Train using data from multiple buildings
 
         Parameters
@@ -103,49 +161,37 @@ class RNNDisaggregator(Disaggregator):
         meterlist : a list of nilmtk.ElecMeter objects for the meter data of each building
         batch_size : size of batch used for training
         epochs : number of epochs to train
+        workers : number of threads preparing the upcoming chunks
+        prefetch : number of chunks read and prepared ahead, see prefetch.py
+        weights : None to train on every sample of every building, 'equal' or
+            one weight per building, see train_across_buildings_chunk()
         **load_kwargs : keyword arguments passed to `meter.power_series()`
         '''
 
         assert len(mainlist) == len(meterlist), "Number of main and meter channels should be equal"
         num_meters = len(mainlist)
 
-        mainps = [None] * num_meters
-        meterps = [None] * num_meters
-        mainchunks = [None] * num_meters
-        meterchunks = [None] * num_meters
-
-        # Get generators of timeseries
-        for i,m in enumerate(mainlist):
-            mainps[i] = m.power_series(**load_kwargs)
-
-        for i,m in enumerate(meterlist):
-            meterps[i] = m.power_series(**load_kwargs)
+        # Every chunk holds the mains of all buildings, then their meters. It is
+        # read until the longest building runs out, the others are None by then
+        chunks = zip_longest(*([power_series(m, **load_kwargs) for m in mainlist] +
+                               [power_series(m, **load_kwargs) for m in meterlist]))
 
-        # Get a chunk of data
-        for i in range(num_meters):
-            mainchunks[i] = next(mainps[i])
-            meterchunks[i] = next(meterps[i])
+        # mmax is the maximum of the mains of all buildings, see normstats.py
         if self.mmax == None:
-            self.mmax = max([m.max() for m in mainchunks])
+            self.stats = combined_stats(mainlist, **load_kwargs).as_dict()
+            self.mmax = self.stats['max']
 
+        def prepare(chunk):
+            mainchunks, meterchunks, live_weights = live_buildings(chunk[:num_meters], chunk[num_meters:], weights)
+            return ([self._normalize(m, self.mmax) for m in mainchunks],
+                    [self._normalize(m, self.mmax) for m in meterchunks], live_weights)
 
-        run = True
-        while(run):
-            # Normalize and train
-            mainchunks = [self._normalize(m, self.mmax) for m in mainchunks]
-            meterchunks = [self._normalize(m, self.mmax) for m in meterchunks]
+        # Normalize and train, the next chunks are read and prepared meanwhile
+        for mainchunks, meterchunks, live_weights in prefetch_chunks(chunks, prepare, workers, prefetch):
+            if mainchunks:
+                self.train_across_buildings_chunk(mainchunks, meterchunks, epochs, batch_size, live_weights)
 
-            self.train_across_buildings_chunk(mainchunks, meterchunks, epochs, batch_size)
-
-            # If more chunks, repeat
-            try:
-                for i in range(num_meters):
-                    mainchunks[i] = next(mainps[i])
-                    meterchunks[i] = next(meterps[i])
-            except:
-                run = False
-
-    def train_across_buildings_chunk(self, mainchunks, meterchunks, epochs, batch_size):
+    def train_across_buildings_chunk(self, mainchunks, meterchunks, epochs, batch_size, weights=None):
         '''Train using only one chunk of data. This chunk consists of data from
         all buildings.
 
@@ -155,53 +201,27 @@ class RNNDisaggregator(Disaggregator):
         meterchunk : chunk of appliance
         epochs : number of epochs for training
         batch_size : size of batch used for training
+        weights : None to train on every sample of every building once per
+            epoch, 'equal' or one weight per building to draw the buildings
+            in those proportions, see sampler.py
+        '''
+        self.lookup = None
+
+        # Common parts of timeseries, gathered from all buildings at once
+        chunks = [aligned_arrays(m1, m2) for m1, m2 in zip(mainchunks, meterchunks)]
+        self._sampler([m for m, _ in chunks], [m for _, m in chunks], batch_size, weights).fit(self.model, epochs)
+
+    def _sampler(self, mains, meters, batch_size, weights=None):
+        '''The CrossBuildingSampler of this model over aligned normalized arrays, see sampler.py
+
+        Parameters
+        ----------
+        mains : list of 1d arrays of the aggregate data, one per building
+        meters : list of 1d arrays of the appliance aligned with `mains`
+        batch_size : size of batch used for training
+        weights : see train_across_buildings_chunk()
         '''
-        num_meters = len(mainchunks)
-        batch_size = int(batch_size/num_meters)
-        num_of_batches = [None] * num_meters
-
-        # Find common parts of timeseries
-        for i in range(num_meters):
-            mainchunks[i].fillna(0, inplace=True)
-            meterchunks[i].fillna(0, inplace=True)
-            ix = mainchunks[i].index.intersection(meterchunks[i].index)
-            m1 = mainchunks[i]
-            m2 = meterchunks[i]
-            mainchunks[i] = m1[ix]
-            meterchunks[i] = m2[ix]
-
-            num_of_batches[i] = int(len(ix)/batch_size) - 1
-
-        for e in range(epochs): # Iterate for every epoch
-            print(e)
-            batch_indexes = list(range(min(num_of_batches)))
-            random.shuffle(batch_indexes)
-
-            for bi, b in enumerate(batch_indexes): # Iterate for every batch
-                print("Batch {} of {}".format(bi,num_of_batches), end="\r")
-                sys.stdout.flush()
-                X_batch = np.empty((batch_size*num_meters, 1, 1))
-                Y_batch = np.empty((batch_size*num_meters, 1))
-
-                # Create a batch out of data from all buildings
-                for i in range(num_meters):
-                    mainpart = mainchunks[i]
-                    meterpart = meterchunks[i]
-                    mainpart = mainpart[b*batch_size:(b+1)*batch_size]
-                    meterpart = meterpart[b*batch_size:(b+1)*batch_size]
-                    X = np.reshape(mainpart, (batch_size, 1, 1))
-                    Y = np.reshape(meterpart, (batch_size, 1))
-
-                    X_batch[i*batch_size:(i+1)*batch_size] = np.array(X)
-                    Y_batch[i*batch_size:(i+1)*batch_size] = np.array(Y)
-
-                # Shuffle data
-                p = np.random.permutation(len(X_batch))
-                X_batch, Y_batch = X_batch[p], Y_batch[p]
-
-                # Train model
-                self.model.train_on_batch(X_batch, Y_batch)
-            print("\n")
+        return CrossBuildingSampler(mains, meters, 1, batch_size, weights=weights)
 
     def disaggregate(self, mains, output_datastore, meter_metadata, **load_kwargs):
         '''Disaggregate mains according to the model learnt previously.
@@ -219,14 +239,14 @@ class RNNDisaggregator(Disaggregator):
         load_kwargs = self._pre_disaggregation_checks(load_kwargs)
 
         load_kwargs.setdefault('sample_period', 60)
-        load_kwargs.setdefault('sections', mains.good_sections())   #this is failing
+        load_kwargs.setdefault('sections', good_sections(mains))
 
         timeframes = []
         building_path = '/building{}'.format(mains.building())
         mains_data_location = building_path + '/elec/meter1'
         data_is_available = False
 
-        for chunk in mains.power_series(**load_kwargs):
+        for chunk in power_series(mains, **load_kwargs):
             if len(chunk) < self.MIN_CHUNK_LENGTH:
                 continue
             print("New sensible chunk: {}".format(len(chunk)))
@@ -281,9 +301,8 @@ class RNNDisaggregator(Disaggregator):
         mains.fillna(0, inplace=True)
 
         X_batch = np.array(mains)
-        X_batch = np.reshape(X_batch, (X_batch.shape[0],1,1))
 
-        pred = self.model.predict(X_batch, batch_size=128)
+        pred = self._predict(X_batch)
         pred = np.reshape(pred, (len(pred)))
         column = pd.Series(pred, index=mains.index[:len(X_batch)], name=0)
 
@@ -292,6 +311,50 @@ class RNNDisaggregator(Disaggregator):
         appliance_powers = pd.DataFrame(appliance_powers_dict)
         return appliance_powers
 
+    def compile_lookup(self, resolution=1.0):
+        '''Tabulates the model over the aggregate range for disaggregate_chunk
+
+        The model sees one sample at a time, so its output is a function
+        of a single number. It is computed once for every `resolution`
+        watts from 0 to mmax and disaggregate_chunk interpolates the table
+        instead of running the model. Samples falling on the grid (every
+        integer watt for resolution=1) get exactly the model's output,
+        samples outside [0, mmax] still go through the model.
+
+        Parameters
+        ----------
+        resolution : watts between two rows of the table
+        '''
+        steps = int(np.ceil(self.mmax / resolution)) + 1
+        grid = np.arange(steps) * resolution
+        X = self._normalize(grid, self.mmax).reshape(steps, 1, 1)
+        # Tabulated by the model itself, not by an older table
+        self.lookup = None
+        self.lookup = self._predict(X).reshape(steps, -1)
+        self.lookup_resolution = resolution
+
+    def _predict(self, X):
+        '''Model output for the normalized aggregate samples `X`, from the lookup table if there is one
+
+        Returns: array of shape (len(X), outputs)
+        '''
+        X = np.asarray(X, dtype=np.float32).reshape(-1)
+        if self.lookup is None:
+            return self.model.predict(X.reshape(len(X), 1, 1), batch_size=128).reshape(len(X), -1)
+
+        # Position of every sample in the table, in rows
+        position = self._denormalize(X, self.mmax) / self.lookup_resolution
+        rows = np.arange(len(self.lookup))
+        inside = (position >= 0) & (position <= rows[-1])
+        pred = np.empty((len(X), self.lookup.shape[1]), dtype=np.float32)
+        for i in range(self.lookup.shape[1]):
+            pred[inside, i] = np.interp(position[inside], rows, self.lookup[:, i])
+        if not inside.all():
+            outside = X[~inside]
+            pred[~inside] = self.model.predict(outside.reshape(len(outside), 1, 1),
+                                               batch_size=128).reshape(len(outside), -1)
+        return pred
+
     def import_model(self, filename):
         '''Loads keras model from h5
 
@@ -302,9 +365,14 @@ class RNNDisaggregator(Disaggregator):
         Returns: Keras model
         '''
         self.model = load_model(filename)
-        with h5py.File(filename, 'a') as hf:
+        with h5py.File(filename, 'r') as hf:
             ds = hf.get('disaggregator-data').get('mmax')
             self.mmax = np.array(ds)[0]
+            self.stats = read_stats(hf['disaggregator-data'])
+            self.lookup, self.lookup_resolution = None, None
+            if 'lookup' in hf['disaggregator-data']:
+                self.lookup = np.array(hf['disaggregator-data/lookup'])
+                self.lookup_resolution = np.array(hf['disaggregator-data/lookup_resolution'])[0]
 
     def export_model(self, filename):
         '''Saves keras model to h5
@@ -317,6 +385,33 @@ class RNNDisaggregator(Disaggregator):
         with h5py.File(filename, 'a') as hf:
             gr = hf.create_group('disaggregator-data')
             gr.create_dataset('mmax', data = [self.mmax])
+            if self.stats is not None:
+                save_stats(gr, self.stats)
+            if self.lookup is not None:
+                gr.create_dataset('lookup', data = self.lookup)
+                gr.create_dataset('lookup_resolution', data = [self.lookup_resolution])
+
+    def export_onnx(self, filename):
+        '''Saves the model to an ONNX file for import_onnx(), needs tf2onnx
+
+        Parameters
+        ----------
+        filename : filename for .onnx file, mmax are stored in its metadata
+        '''
+        save_onnx(self.model, filename, {'mmax': self.mmax})
+
+    def import_onnx(self, filename, threads=None):
+        '''Loads a model saved by export_onnx(), disaggregate() then runs on
+        onnxruntime. The loaded model can't be trained.
+
+        Parameters
+        ----------
+        filename : filename for .onnx file
+        threads : number of threads onnxruntime uses, its default if None
+        '''
+        self.model = OnnxModel(filename, threads)
+        self.mmax = float(self.model.metadata['mmax'])
+        self.lookup, self.lookup_resolution = None, None
 
     def _normalize(self, chunk, mmax):
         '''Normalizes timeseries
@@ -362,6 +457,5 @@ class RNNDisaggregator(Disaggregator):
         model.add(Dense(1, activation='linear'))
 
         model.compile(loss='mse', optimizer='adam', run_eagerly=True)
-        plot_model(model, to_file='model.png', show_shapes=True)
 
         return model
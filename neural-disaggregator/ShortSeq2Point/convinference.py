@@ -0,0 +1,130 @@
+from __future__ import print_function, division
+
+import numpy as np
+
+from keras.models import Model
+from keras.layers import Input, Conv1D, Flatten
+
+from windowing import sliding_windows
+
+# Inference for a trained ShortSeq2Point model that doesn't run the conv stack
+# once per overlapping window.  With "same" padding the features of a window
+# position only depend on the window's zero padding when the position is
+# closer to an edge than the stack's reach (13 samples on the left, 16 on the
+# right for kernels 10, 8, 6, 5, 5).  All other positions see exactly the
+# features of the same samples in a single conv pass over the whole chunk, so
+# that pass is done once and its rows are gathered per window.  The edge
+# positions are recomputed from short segments of reach-left + reach-right
+# samples, one segment serving the left edge of one window and the right
+# edge of another.
+#
+# How much is saved: the conv stack runs once per sample instead of
+# window_size times per sample (exact=False), or over about (reach + 1)
+# positions per window (exact=True).  The Flatten->Dense(1024) head still
+# runs once per window and costs about as much as the whole conv stack did,
+# and the edge segments of exact=True cost about as much again, so only
+# exact=False is reliably faster than `model.predict`.  Its price is at the
+# edges: the first 13 and last 16 positions of a window see the neighbouring
+# samples of the chunk where the trained model saw zero padding, so its
+# predictions differ from `model.predict` on every window (check the
+# metrics.py scores on a held-out meter before using it).
+# exact=True gives the same output as `model.predict`.
+
+
+def conv_reach(layers):
+    '''Returns (left, right) number of samples the "same" padded Conv1D `layers` see around a position'''
+    left, right = 0, 0
+    for layer in layers:
+        if not isinstance(layer, Conv1D):
+            continue
+        if layer.strides[0] != 1 or layer.padding != 'same':
+            raise ValueError("Only stride 1 'same' convolutions can be reused across windows")
+        span = layer.dilation_rate[0] * (layer.kernel_size[0] - 1)
+        left += span // 2
+        right += span - span // 2
+    return left, right
+
+
+class ConvInference(object):
+    '''Runs a trained ShortSeq2Point model with its conv trunk applied once per chunk
+
+    Attributes
+    ----------
+    model : the keras Sequential model it was built from
+    window_size : input length of the model
+    exact : recompute the window edges, the output then matches
+        `model.predict` on every window up to float rounding, but isn't
+        faster than it. Without, the edges see the neighbouring samples
+        instead of the zero padding
+    trunk : keras Model of the layers before Flatten, for any input length
+    head : keras Model of Flatten and the layers after it
+    '''
+
+    def __init__(self, model, window_size, exact=False, batch_size=1024):
+        '''Splits `model` into its conv trunk and its fully connected head
+
+        Parameters
+        ----------
+        model : trained keras Sequential model of ShortSeq2PointDisaggregator
+        window_size : input length of the model
+        exact : recompute the features of window edge positions, see above
+        batch_size : number of windows sent through the head at once
+        '''
+        self.model = model
+        self.window_size = window_size
+        self.exact = exact
+        self.batch_size = batch_size
+
+        layers = model.layers
+        flat = [i for i, layer in enumerate(layers) if isinstance(layer, Flatten)][0]
+        self.left, self.right = conv_reach(layers[:flat])
+
+        # The trained layers are called again, so both models share the weights
+        x = inputs = Input(shape=(None, 1))
+        for layer in layers[:flat]:
+            x = layer(x)
+        self.trunk = Model(inputs, x)
+
+        y = features = Input(shape=(window_size, self.trunk.output_shape[-1]))
+        for layer in layers[flat:]:
+            y = layer(y)
+        self.head = Model(features, y)
+
+        # Windows shorter than the edges have no interior to share
+        if window_size < self.left + self.right + 1:
+            self.exact = None
+
+    def predict(self, mains):
+        '''Predicts the appliance at the last sample of every window of `mains`
+
+        Parameters
+        ----------
+        mains : 1d array of normalized aggregate data
+
+        Returns: array of shape (len(mains) - window_size + 1, 1), like
+            `model.predict` on every window
+        '''
+        mains = np.ascontiguousarray(mains, dtype=np.float32)
+        w = self.window_size
+        num_windows = len(mains) - w + 1
+        if num_windows <= 0:
+            return np.empty((0, 1), dtype=np.float32)
+        if self.exact is None:
+            return self.model.predict(sliding_windows(mains, w), batch_size=self.batch_size)
+
+        features = self.trunk.predict(mains[None, :, None])[0]
+        edge = self.left + self.right
+        outputs = []
+        for a in range(0, num_windows, self.batch_size):
+            b = min(a + self.batch_size, num_windows)
+            rows = np.arange(a, b)[:, None] + np.arange(w)[None, :]
+            X = features[rows]
+            if self.exact:
+                # Segment j covers samples j..j+edge-1: its first `left`
+                # positions are the left edge of window j, its last `right`
+                # positions the right edge of window j - (w - edge)
+                segments = self.trunk.predict(sliding_windows(mains[a:b+w-1], edge), batch_size=self.batch_size)
+                X[:, :self.left] = segments[:b-a, :self.left]
+                X[:, w-self.right:] = segments[w-edge:w-edge+b-a, self.left:]
+            outputs.append(self.head.predict(X, batch_size=self.batch_size))
+        return np.concatenate(outputs)
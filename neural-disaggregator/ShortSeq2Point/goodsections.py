@@ -0,0 +1,41 @@
+from __future__ import print_function, division
+
+import pandas as pd
+
+from nilmtk.datastore import HDFDataStore
+from nilmtk.timeframe import TimeFrame
+from nilmtk.timeframegroup import TimeFrameGroup
+
+# Reads the good sections that SeniorDataset/goodSections.py stores next to
+# every meter at ingest (/building1/elec/meter1/good_sections), instead of
+# letting nilmtk scan the whole meter to find its gaps.
+
+SECTIONS_NODE = 'good_sections'
+
+
+def good_sections(meter):
+    '''Returns the good sections of a meter, from the cached table when there is one
+
+    Parameters
+    ----------
+    meter : nilmtk.ElecMeter or MeterGroup. Meters without a good sections
+        table, e.g. from a dataset not built by csvToH5.py, fall back to
+        `meter.good_sections()`
+
+    Returns: nilmtk.TimeFrameGroup clipped to the store's window
+    '''
+    store = getattr(meter, 'store', None)
+    key = getattr(meter, 'key', None)
+    if isinstance(store, HDFDataStore) and key is not None:
+        skey = '/' + key.strip('/') + '/' + SECTIONS_NODE
+        if skey in store.store:
+            table = store.store.select(skey)
+            sections = []
+            for start, end in zip(table['start'].values, table['end'].values):
+                section = TimeFrame(pd.Timestamp(start, unit='ns', tz='UTC'),
+                                    pd.Timestamp(end, unit='ns', tz='UTC'))
+                section = store.window.intersection(section)
+                if not section.empty:
+                    sections.append(section)
+            return TimeFrameGroup(sections)
+    return meter.good_sections()
@@ -0,0 +1,68 @@
+from __future__ import print_function, division
+import os
+import time
+
+from nilmtk import DataSet, HDFDataStore
+from shortseq2pointdisaggregator import ShortSeq2PointDisaggregator
+from onnxbackend import calibration_windows, quantize_onnx
+import metrics
+
+# Compares an int8 copy of a model exported by ukdale-test.py with the float
+# model, both run on onnxruntime: file size, disaggregation time and the
+# metrics.py scores on the test window.  The int8 activations are
+# calibrated on mains of the training window.
+
+print("========== OPEN DATASETS ============")
+train = DataSet('ukdale.h5')
+test = DataSet('ukdale.h5')
+
+train.set_window(start="13-4-2013", end="1-1-2014")
+test.set_window(start="1-1-2014", end="30-3-2014")
+
+train_building = 1
+test_building = 1
+sample_period = 6
+meter_key = 'kettle'
+model_filename = "UKDALE-RNN-h{}-{}-15epochs.h5".format(train_building, meter_key)
+float_filename = "UKDALE-RNN-h{}-{}.onnx".format(train_building, meter_key)
+int8_filename = "UKDALE-RNN-h{}-{}-int8.onnx".format(train_building, meter_key)
+train_mains = train.buildings[train_building].elec.mains()
+test_elec = test.buildings[test_building].elec
+test_mains = test_elec.mains()
+
+print("========== QUANTIZE ============")
+disaggregator = ShortSeq2PointDisaggregator()
+disaggregator.import_model(model_filename)
+disaggregator.export_onnx(float_filename)
+
+chunk = next(train_mains.power_series(sample_period=sample_period))
+chunk = disaggregator._normalize(chunk.fillna(0), disaggregator.mmax)
+windows = calibration_windows(chunk.values, disaggregator.window_size)
+quantize_onnx(float_filename, int8_filename, windows)
+
+results = {}
+for name, filename in [('float32', float_filename), ('int8', int8_filename)]:
+    print("========== DISAGGREGATE {} ============".format(name))
+    disaggregator = ShortSeq2PointDisaggregator()
+    disaggregator.import_onnx(filename)
+    disag_filename = "disag-out-{}.h5".format(name)
+    output = HDFDataStore(disag_filename, 'w')
+    start = time.time()
+    disaggregator.disaggregate(test_mains, output, test_elec[meter_key], sample_period=sample_period)
+    seconds = time.time() - start
+    output.close()
+
+    result = DataSet(disag_filename)
+    res_elec = result.buildings[test_building].elec
+    rpaf = metrics.recall_precision_accuracy_f1(res_elec[meter_key], test_elec[meter_key])
+    results[name] = [os.path.getsize(filename) / 2**20, seconds, rpaf[3],
+                     metrics.relative_error_total_energy(res_elec[meter_key], test_elec[meter_key]),
+                     metrics.mean_absolute_error(res_elec[meter_key], test_elec[meter_key])]
+    result.store.close()
+
+print("========== RESULTS ============")
+names = ["Size(in MB)", "Disaggregation time(in seconds)", "F1 Score",
+         "Relative error in total energy", "Mean absolute error(in Watts)"]
+for i, name in enumerate(names):
+    print("============ {}: float32 {}, int8 {}, delta {}".format(
+        name, results['float32'][i], results['int8'][i], results['int8'][i] - results['float32'][i]))
@@ -1,4 +1,5 @@
 from __future__ import print_function, division
+from itertools import zip_longest
 import random
 import sys
 
@@ -19,28 +20,75 @@ from nilmtk.feature_detectors import cluster
 from nilmtk.legacy.disaggregate import Disaggregator
 from nilmtk.datastore import HDFDataStore
 
+from meterarrays import align
+from goodsections import good_sections
+from levels import power_series
+from prefetch import prefetch_chunks, aligned_arrays, live_buildings, WORKERS, PREFETCH
+from normstats import meter_stats, combined_stats, array_stats, save_stats, read_stats
+from sampler import CrossBuildingSampler
+from onnxbackend import save_onnx, OnnxModel
+from windowing import WindowSequence, sliding_windows, window_starts, merge_windows
+from convinference import ConvInference
+
 class ShortSeq2PointDisaggregator(Disaggregator):
     '''Attempt to create a RNN Disaggregator
 
     Attributes
     ----------
-    model : keras Sequential model
+    model : keras Sequential model, created on first use unless
+        import_model() loads one
     mmax : the maximum value of the aggregate data
+    stats : dict of the count, min, max, mean, std and quantiles (q0.5 ...)
+        of the aggregate data mmax was taken from, see normstats.py
+    seq2seq : the model outputs the appliance over its whole window
+        instead of at the window's last sample, so disaggregate_chunk only
+        predicts windows `stride` samples apart
+    stride : samples between the windows disaggregate_chunk predicts in
+        seq2seq mode, window_size if None. Overlapping outputs are averaged
+    conv_inference : run the conv layers once per chunk in `disaggregate_chunk`,
+        see convinference.py
+    conv_exact : with conv_inference, recompute the features of the window
+        edges so the output matches the model's. That is about as slow as
+        running the model on every window. Without it, the first 13 and
+        last 16 positions of every window see the neighbouring samples
+        instead of the zero padding the model was trained with, which
+        changes its output
 
     MIN_CHUNK_LENGTH : int
        the minimum length of an acceptable chunk
     '''
 
-    def __init__(self, window_size=100):
+    def __init__(self, window_size=100, conv_inference=False, seq2seq=False, stride=None, conv_exact=False):
         '''Initialize disaggregator
         '''
         self.MODEL_NAME = "WindowGRU"
         self.mmax = None
+        self.stats = None
         self.MIN_CHUNK_LENGTH = window_size
         self.window_size = window_size
-        self.model = self._create_model()
-
-    def train(self, mains, meter, epochs=1, batch_size=128, **load_kwargs):
+        self.seq2seq = seq2seq
+        self.stride = stride
+        self.conv_inference = conv_inference
+        self.conv_exact = conv_exact
+        self._inference = None
+        self._model = None
+
+    @property
+    def model(self):
+        '''The keras model, built and compiled the first time it is needed'''
+        if self._model is None:
+            self._model = self._create_model()
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+
+    def plot(self, to_file='model.png'):
+        '''Draws the model to `to_file`, needs pydot and graphviz'''
+        plot_model(self.model, to_file=to_file, show_shapes=True)
+
+    def train(self, mains, meter, epochs=1, batch_size=128, workers=WORKERS, prefetch=PREFETCH, **load_kwargs):
         '''Train
 
         Parameters
@@ -49,56 +97,78 @@ class ShortSeq2PointDisaggregator(Disaggregator):
         meter : a nilmtk.ElecMeter object for the meter data
         epochs : number of epochs to train
         batch_size : size of batch used for training
+        workers : number of threads preparing the upcoming chunks
+        prefetch : number of chunks read and prepared ahead, see prefetch.py
         **load_kwargs : keyword arguments passed to `meter.power_series()`
         '''
 
-        main_power_series = mains.power_series(**load_kwargs)
-        meter_power_series = meter.power_series(**load_kwargs)
+        chunks = zip(power_series(mains, **load_kwargs), power_series(meter, **load_kwargs))
 
-        # Train chunks
-        run = True
-        mainchunk = next(main_power_series)
-        meterchunk = next(meter_power_series)
+        # mmax is the maximum of the whole mains, from the stats stored next to the meter
         if self.mmax == None:
-            self.mmax = mainchunk.max()
+            self.stats = meter_stats(mains, **load_kwargs).as_dict()
+            self.mmax = self.stats['max']
 
-        while(run):
-            mainchunk = self._normalize(mainchunk, self.mmax)
-            meterchunk = self._normalize(meterchunk, self.mmax)
+        def prepare(chunk):
+            mainchunk, meterchunk = aligned_arrays(*chunk)
+            return self._normalize(mainchunk, self.mmax), self._normalize(meterchunk, self.mmax)
 
+        # Train chunks, the next ones are read and prepared meanwhile
+        for mainchunk, meterchunk in prefetch_chunks(chunks, prepare, workers, prefetch):
             self.train_on_chunk(mainchunk, meterchunk, epochs, batch_size)
-            try:
-                mainchunk = next(main_power_series)
-                meterchunk = next(meter_power_series)
-            except:
-                run = False
 
     def train_on_chunk(self, mainchunk, meterchunk, epochs, batch_size):
         '''Train using only one chunk
 
         Parameters
         ----------
-        mainchunk : chunk of site meter
+        mainchunk : chunk of site meter, a pd.Series or an np.array aligned with meterchunk
         meterchunk : chunk of appliance
         epochs : number of epochs for training
         batch_size : size of batch used for training
         '''
 
-        # Replace NaNs with 0s
-        mainchunk.fillna(0, inplace=True)
-        meterchunk.fillna(0, inplace=True)
-        ix = mainchunk.index.intersection(meterchunk.index)
-        mainchunk = np.array(mainchunk[ix])
-        meterchunk = np.array(meterchunk[ix])
+        if isinstance(mainchunk, pd.Series):
+            # Replace NaNs with 0s
+            mainchunk.fillna(0, inplace=True)
+            meterchunk.fillna(0, inplace=True)
+            ix = mainchunk.index.intersection(meterchunk.index)
+            mainchunk = np.array(mainchunk[ix])
+            meterchunk = np.array(meterchunk[ix])
 
-        indexer = np.arange(self.window_size)[None, :] + np.arange(len(mainchunk)-self.window_size+1)[:, None]
-        mainchunk = mainchunk[indexer]
-        meterchunk = meterchunk[self.window_size-1:]
-        mainchunk = np.reshape(mainchunk, (mainchunk.shape[0], mainchunk.shape[1],1))
+        # Windows are cut out of the chunk one batch at a time, see windowing.py
+        batches = WindowSequence([mainchunk], [meterchunk], self.window_size, batch_size,
+                                 sequence=self.seq2seq)
+        self.model.fit(batches, epochs=epochs)
 
-        self.model.fit(mainchunk, meterchunk, epochs=epochs, batch_size=batch_size, shuffle=True)
+    def train_from_arrays(self, mains, meter, epochs=1, batch_size=128, chunksize=2**20):
+        '''Train from memory-mapped meter arrays, see meterarrays.py
 
-    def train_across_buildings(self, mainlist, meterlist, epochs=1, batch_size=128, **load_kwargs):
+        The arrays are sliced into chunks without copying, skipping the
+        pandas chunks `power_series()` would build.
+
+        Parameters
+        ----------
+        mains : meterarrays.MeterArray of the aggregate data
+        meter : meterarrays.MeterArray of the appliance
+        epochs : number of epochs to train
+        batch_size : size of batch used for training
+        chunksize : number of samples trained on at once
+        '''
+
+        mains, meter = align(mains, meter)
+        if self.mmax == None:
+            self.stats = array_stats(mains.values, chunksize).as_dict()
+            self.mmax = self.stats['max']
+
+        mmax = np.float32(self.mmax)
+        for start in range(0, len(mains), chunksize):
+            mainchunk = self._normalize(mains.values[start:start+chunksize], mmax)
+            meterchunk = self._normalize(meter.values[start:start+chunksize], mmax)
+            self.train_on_chunk(mainchunk, meterchunk, epochs, batch_size)
+
+    def train_across_buildings(self, mainlist, meterlist, epochs=1, batch_size=128, workers=WORKERS, prefetch=PREFETCH,
+                               weights=None, **load_kwargs):
         '''Train using data from multiple buildings
 
         Parameters
@@ -107,49 +177,37 @@ class ShortSeq2PointDisaggregator(Disaggregator):
         meterlist : a list of nilmtk.ElecMeter objects for the meter data of each building
         batch_size : size of batch used for training
         epochs : number of epochs to train
+        workers : number of threads preparing the upcoming chunks
+        prefetch : number of chunks read and prepared ahead, see prefetch.py
+        weights : None to train on every sample of every building, 'equal' or
+            one weight per building, see train_across_buildings_chunk()
         **load_kwargs : keyword arguments passed to `meter.power_series()`
         '''
 
         assert len(mainlist) == len(meterlist), "Number of main and meter channels should be equal"
         num_meters = len(mainlist)
 
-        mainps = [None] * num_meters
-        meterps = [None] * num_meters
-        mainchunks = [None] * num_meters
-        meterchunks = [None] * num_meters
-
-        # Get generators of timeseries
-        for i,m in enumerate(mainlist):
-            mainps[i] = m.power_series(**load_kwargs)
-
-        for i,m in enumerate(meterlist):
-            meterps[i] = m.power_series(**load_kwargs)
+        # Every chunk holds the mains of all buildings, then their meters. It is
+        # read until the longest building runs out, the others are None by then
+        chunks = zip_longest(*([power_series(m, **load_kwargs) for m in mainlist] +
+                               [power_series(m, **load_kwargs) for m in meterlist]))
 
-        # Get a chunk of data
-        for i in range(num_meters):
-            mainchunks[i] = next(mainps[i])
-            meterchunks[i] = next(meterps[i])
+        # mmax is the maximum of the mains of all buildings, see normstats.py
         if self.mmax == None:
-            self.mmax = max([m.max() for m in mainchunks])
+            self.stats = combined_stats(mainlist, **load_kwargs).as_dict()
+            self.mmax = self.stats['max']
 
+        def prepare(chunk):
+            mainchunks, meterchunks, live_weights = live_buildings(chunk[:num_meters], chunk[num_meters:], weights)
+            return ([self._normalize(m, self.mmax) for m in mainchunks],
+                    [self._normalize(m, self.mmax) for m in meterchunks], live_weights)
 
-        run = True
-        while(run):
-            # Normalize and train
-            mainchunks = [self._normalize(m, self.mmax) for m in mainchunks]
-            meterchunks = [self._normalize(m, self.mmax) for m in meterchunks]
+        # Normalize and train, the next chunks are read and prepared meanwhile
+        for mainchunks, meterchunks, live_weights in prefetch_chunks(chunks, prepare, workers, prefetch):
+            if mainchunks:
+                self.train_across_buildings_chunk(mainchunks, meterchunks, epochs, batch_size, live_weights)
 
-            self.train_across_buildings_chunk(mainchunks, meterchunks, epochs, batch_size)
-
-            # If more chunks, repeat
-            try:
-                for i in range(num_meters):
-                    mainchunks[i] = next(mainps[i])
-                    meterchunks[i] = next(meterps[i])
-            except:
-                run = False
-
-    def train_across_buildings_chunk(self, mainchunks, meterchunks, epochs, batch_size):
+    def train_across_buildings_chunk(self, mainchunks, meterchunks, epochs, batch_size, weights=None):
         '''Train using only one chunk of data. This chunk consists of data from
         all buildings.
 
@@ -159,57 +217,26 @@ class ShortSeq2PointDisaggregator(Disaggregator):
         meterchunk : chunk of appliance
         epochs : number of epochs for training
         batch_size : size of batch used for training
+        weights : None to train on every sample of every building once per
+            epoch, 'equal' or one weight per building to draw the buildings
+            in those proportions, see sampler.py
+        '''
+        # Common parts of timeseries, gathered from all buildings at once
+        chunks = [aligned_arrays(m1, m2) for m1, m2 in zip(mainchunks, meterchunks)]
+        self._sampler([m for m, _ in chunks], [m for _, m in chunks], batch_size, weights).fit(self.model, epochs)
+
+    def _sampler(self, mains, meters, batch_size, weights=None):
+        '''The CrossBuildingSampler of this model over aligned normalized arrays, see sampler.py
+
+        Parameters
+        ----------
+        mains : list of 1d arrays of the aggregate data, one per building
+        meters : list of 1d arrays of the appliance aligned with `mains`
+        batch_size : size of batch used for training
+        weights : see train_across_buildings_chunk()
         '''
-        num_meters = len(mainchunks)
-        batch_size = int(batch_size/num_meters)
-        num_of_batches = [None] * num_meters
-
-        # Find common parts of timeseries
-        for i in range(num_meters):
-            mainchunks[i].fillna(0, inplace=True)
-            meterchunks[i].fillna(0, inplace=True)
-            ix = mainchunks[i].index.intersection(meterchunks[i].index)
-            m1 = mainchunks[i]
-            m2 = meterchunks[i]
-            mainchunks[i] = m1[ix]
-            meterchunks[i] = m2[ix]
-
-            indexer = np.arange(self.window_size)[None, :] + np.arange(len(mainchunks[i].values)-self.window_size+1)[:, None]
-            mainchunks[i] = mainchunks[i].values[indexer]
-            meterchunks[i] = meterchunks[i].values[self.window_size-1:]
-
-            num_of_batches[i] = int(len(ix)/batch_size) - 1
-
-        for e in range(epochs): # Iterate for every epoch
-            print(e)
-            batch_indexes = list(range(min(num_of_batches)))
-            random.shuffle(batch_indexes)
-
-            for bi, b in enumerate(batch_indexes): # Iterate for every batch
-                print("Batch {} of {}".format(bi,min(num_of_batches)), end="\r")
-                sys.stdout.flush()
-                X_batch = np.empty((batch_size*num_meters, self.window_size, 1))
-                Y_batch = np.empty((batch_size*num_meters, 1))
-
-                # Create a batch out of data from all buildings
-                for i in range(num_meters):
-                    mainpart = mainchunks[i]
-                    meterpart = meterchunks[i]
-                    mainpart = mainpart[b*batch_size:(b+1)*batch_size]
-                    meterpart = meterpart[b*batch_size:(b+1)*batch_size]
-                    X = np.reshape(mainpart, (batch_size, self.window_size, 1))
-                    Y = np.reshape(meterpart, (batch_size, 1))
-
-                    X_batch[i*batch_size:(i+1)*batch_size] = np.array(X)
-                    Y_batch[i*batch_size:(i+1)*batch_size] = np.array(Y)
-
-                # Shuffle data
-                p = np.random.permutation(len(X_batch))
-                X_batch, Y_batch = X_batch[p], Y_batch[p]
-
-                # Train model
-                self.model.train_on_batch(X_batch, Y_batch)
-            print("\n")
+        return CrossBuildingSampler(mains, meters, self.window_size, batch_size, sequence=self.seq2seq,
+                                    weights=weights)
 
     def disaggregate(self, mains, output_datastore, meter_metadata, **load_kwargs):
         '''Disaggregate mains according to the model learnt previously.
@@ -227,14 +254,14 @@ class ShortSeq2PointDisaggregator(Disaggregator):
         load_kwargs = self._pre_disaggregation_checks(load_kwargs)
 
         load_kwargs.setdefault('sample_period', 60)
-        load_kwargs.setdefault('sections', mains.good_sections())
+        load_kwargs.setdefault('sections', good_sections(mains))
 
         timeframes = []
         building_path = '/building{}'.format(mains.building())
         mains_data_location = building_path + '/elec/meter1'
         data_is_available = False
 
-        for chunk in mains.power_series(**load_kwargs):
+        for chunk in power_series(mains, **load_kwargs):
             if len(chunk) < self.MIN_CHUNK_LENGTH:
                 continue
             print("New sensible chunk: {}".format(len(chunk)))
@@ -290,11 +317,18 @@ class ShortSeq2PointDisaggregator(Disaggregator):
 
         X_batch = np.array(mains)
         Y_len = len(X_batch)
-        indexer = np.arange(self.window_size)[None, :] + np.arange(len(X_batch)-self.window_size+1)[:, None]
-        X_batch = X_batch[indexer]
-        X_batch = np.reshape(X_batch, (X_batch.shape[0],X_batch.shape[1],1))
-
-        pred = self.model.predict(X_batch, batch_size=128)
+        if self.seq2seq:
+            pred = self._predict_sequences(X_batch)
+            return pd.DataFrame({0: pd.Series(pred, index=mains.index, name=0)})
+
+        if self.conv_inference and not isinstance(self.model, OnnxModel):
+            # Rebuilt whenever the model is replaced, e.g. by import_model
+            if self._inference is None or self._inference.model is not self.model:
+                self._inference = ConvInference(self.model, self.window_size, self.conv_exact)
+            pred = self._inference.predict(X_batch)
+        else:
+            batches = WindowSequence([X_batch], None, self.window_size, 128, shuffle=False)
+            pred = self.model.predict(batches)
         pred = np.reshape(pred, (len(pred)))
         column = pd.Series(pred, index=mains.index[self.window_size-1:Y_len], name=0)
 
@@ -303,6 +337,22 @@ class ShortSeq2PointDisaggregator(Disaggregator):
         appliance_powers = pd.DataFrame(appliance_powers_dict)
         return appliance_powers
 
+    def _predict_sequences(self, mains):
+        '''Runs a seq2seq model over windows `stride` apart and averages their overlapping outputs
+
+        Parameters
+        ----------
+        mains : 1d array of normalized aggregate data
+
+        Returns: 1d array with the appliance at every sample of `mains`
+        '''
+        w = self.window_size
+        length = len(mains)
+        mains = np.r_[mains, np.zeros(max(w - length, 0))].astype(np.float32)
+        starts = window_starts(len(mains), w, self.stride or w)
+        pred = self.model.predict(sliding_windows(mains, w)[starts], batch_size=128)
+        return merge_windows(np.reshape(pred, (len(starts), w)), starts, len(mains))[:length]
+
     def import_model(self, filename):
         '''Loads keras model from h5
 
@@ -313,9 +363,14 @@ class ShortSeq2PointDisaggregator(Disaggregator):
         Returns: Keras model
         '''
         self.model = load_model(filename)
-        with h5py.File(filename, 'a') as hf:
+        with h5py.File(filename, 'r') as hf:
             ds = hf.get('disaggregator-data').get('mmax')
             self.mmax = np.array(ds)[0]
+            self.stats = read_stats(hf['disaggregator-data'])
+            gr = hf.get('disaggregator-data')
+            self.seq2seq = 'seq2seq' in gr and bool(np.array(gr['seq2seq'])[0])
+            self.stride = int(np.array(gr['stride'])[0]) if 'stride' in gr else 0
+            self.stride = self.stride or None
 
     def export_model(self, filename):
         '''Saves keras model to h5
@@ -328,6 +383,37 @@ class ShortSeq2PointDisaggregator(Disaggregator):
         with h5py.File(filename, 'a') as hf:
             gr = hf.create_group('disaggregator-data')
             gr.create_dataset('mmax', data = [self.mmax])
+            if self.stats is not None:
+                save_stats(gr, self.stats)
+            gr.create_dataset('seq2seq', data = [int(self.seq2seq)])
+            gr.create_dataset('stride', data = [self.stride or 0])
+
+    def export_onnx(self, filename):
+        '''Saves the model to an ONNX file for import_onnx(), needs tf2onnx
+
+        Parameters
+        ----------
+        filename : filename for .onnx file, mmax, window_size, seq2seq and
+            stride are stored in its metadata
+        '''
+        save_onnx(self.model, filename, {'mmax': self.mmax, 'window_size': self.window_size,
+                                         'seq2seq': int(self.seq2seq), 'stride': self.stride or 0})
+
+    def import_onnx(self, filename, threads=None):
+        '''Loads a model saved by export_onnx(), disaggregate() then runs on
+        onnxruntime. The loaded model can't be trained.
+
+        Parameters
+        ----------
+        filename : filename for .onnx file
+        threads : number of threads onnxruntime uses, its default if None
+        '''
+        self.model = OnnxModel(filename, threads)
+        self.mmax = float(self.model.metadata['mmax'])
+        self.window_size = int(self.model.metadata['window_size'])
+        self.MIN_CHUNK_LENGTH = self.window_size
+        self.seq2seq = bool(int(self.model.metadata.get('seq2seq', 0)))
+        self.stride = int(self.model.metadata.get('stride', 0)) or None
 
     def _normalize(self, chunk, mmax):
         '''Normalizes timeseries
@@ -377,10 +463,10 @@ class ShortSeq2PointDisaggregator(Disaggregator):
         model.add(Flatten())
         model.add(Dense(1024, activation='relu'))
         model.add(Dropout(0.5))
-        model.add(Dense(1, activation='linear'))
+        # A seq2seq model outputs the appliance at every sample of the window
+        model.add(Dense(self.window_size if self.seq2seq else 1, activation='linear'))
 
         model.compile(loss='mse', optimizer='adam')
         print(model.summary())
-        plot_model(model, to_file='model.png', show_shapes=True)
 
         return model
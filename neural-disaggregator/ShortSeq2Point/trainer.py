@@ -0,0 +1,195 @@
+from __future__ import print_function, division
+import os
+import time
+import warnings
+from itertools import islice, zip_longest
+
+import h5py
+from keras.callbacks import Callback
+
+from prefetch import prefetch_chunks, aligned_arrays, live_buildings, WORKERS, PREFETCH
+from levels import power_series
+from normstats import combined_stats
+
+# Epoch-level training over all chunks of all buildings.  train() calls
+# train_on_chunk() for every chunk, which runs model.fit for all epochs on
+# that chunk before moving to the next, so the first chunk is trained
+# `epochs` times before the model sees the second.  StreamingTrainer runs one
+# model.fit per epoch over a generator that streams every chunk of every
+# building (read and prepared ahead, see prefetch.py), so every epoch covers
+# the whole data once.  With a checkpoint it saves the model and its place
+# (epoch, chunks done) every few chunks and picks up from there after a
+# restart.  The place is stored in the attributes of the model's .h5 file,
+# so one rename replaces both and they can't get out of step.
+#
+# trainer = StreamingTrainer(disaggregator, [mains1, mains2], [meter1, meter2],
+#                            checkpoint='fridge-training', sample_period=6)
+# trainer.train(epochs=10)
+
+PROGRESS_GROUP = 'trainer-progress'
+
+
+def read_progress(filename):
+    '''The progress StreamingTrainer saved in the checkpoint `filename`
+
+    Returns: dict of 'epoch', 'chunk', 'batch_size' and 'saved', None if
+        there is no such file or it isn't a checkpoint
+    '''
+    if not os.path.exists(filename):
+        return None
+    with h5py.File(filename, 'r') as hf:
+        if PROGRESS_GROUP not in hf:
+            return None
+        return dict((name, value.item()) for name, value in hf[PROGRESS_GROUP].attrs.items())
+
+
+class _Progress(Callback):
+    '''Counts the batches keras trained, so the trainer knows the chunks that are done'''
+
+    def __init__(self, trainer, boundaries):
+        super(_Progress, self).__init__()
+        self.trainer = trainer
+        self.boundaries = boundaries
+        self.batches = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.batches += 1
+        # The generator runs ahead of training, a chunk is done once its last batch is trained
+        while self.boundaries and self.batches >= self.boundaries[0]:
+            self.boundaries.pop(0)
+            self.trainer.chunk += 1
+            if self.trainer.chunk % self.trainer.checkpoint_every == 0:
+                # Reading the callback's model copies back the weights the JAX
+                # backend trains outside of it, before the model is saved
+                self.model
+                self.trainer.save()
+
+
+class StreamingTrainer(object):
+    '''Trains a disaggregator with one model.fit per epoch over all its data
+
+    Attributes
+    ----------
+    disaggregator : DAE, RNN, GRU, WindowGRU or ShortSeq2Point disaggregator
+    epoch : number of epochs done
+    chunk : number of chunks of the current epoch done
+    checkpoint : path the state is saved to (checkpoint.h5 from
+        export_model(), with the progress in its PROGRESS_GROUP
+        attributes), None to not save it
+    '''
+
+    def __init__(self, disaggregator, mains, meters, batch_size=128, weights=None, checkpoint=None,
+                 checkpoint_every=1, workers=WORKERS, prefetch=PREFETCH, **load_kwargs):
+        '''Sets up training, resuming from `checkpoint` if it was saved before
+
+        Parameters
+        ----------
+        disaggregator : the disaggregator to train, it is replaced by the
+            saved model when resuming
+        mains : a nilmtk.ElecMeter for the aggregate data, or a list of them,
+            one per building
+        meters : a nilmtk.ElecMeter for the appliance, or a list of them
+            aligned with `mains`
+        batch_size : size of batch used for training
+        weights : None to train on every sample of every building, 'equal'
+            or one weight per building, see sampler.py
+        checkpoint : path the model and progress are saved to, without
+            extension, None to not save them
+        checkpoint_every : number of chunks between saves, the end of every
+            epoch is always saved
+        workers : number of threads preparing the upcoming chunks
+        prefetch : number of chunks read and prepared ahead, see prefetch.py
+        **load_kwargs : keyword arguments passed to `meter.power_series()`
+        '''
+        if hasattr(disaggregator, 'appliances'):
+            raise TypeError("StreamingTrainer trains single appliance disaggregators, "
+                            "use train_across_buildings() of a multi-appliance one")
+        self.mainlist = list(mains) if isinstance(mains, (list, tuple)) else [mains]
+        self.meterlist = list(meters) if isinstance(meters, (list, tuple)) else [meters]
+        assert len(self.mainlist) == len(self.meterlist), "Number of main and meter channels should be equal"
+        self.disaggregator = disaggregator
+        self.batch_size = batch_size
+        self.weights = weights
+        self.checkpoint = checkpoint
+        self.checkpoint_every = max(checkpoint_every, 1)
+        self.workers = workers
+        self.prefetch = prefetch
+        self.load_kwargs = load_kwargs
+        self.epoch = 0
+        self.chunk = 0
+        if checkpoint is not None and read_progress(checkpoint + '.h5') is not None:
+            self.resume()
+
+    def batches(self, skip, boundaries):
+        '''Yields the (X, Y) batches of one epoch, chunk by chunk
+
+        Parameters
+        ----------
+        skip : number of chunks at the start left out, those done before a restart
+        boundaries : list the number of batches yielded is appended to after every chunk
+        '''
+        d = self.disaggregator
+        n = len(self.mainlist)
+        # A building with fewer chunks is left out once it runs out
+        chunks = zip_longest(*([power_series(m, **self.load_kwargs) for m in self.mainlist] +
+                       [power_series(m, **self.load_kwargs) for m in self.meterlist]))
+
+        def prepare(chunk):
+            mainchunks, meterchunks, weights = live_buildings(list(chunk[:n]), list(chunk[n:]), self.weights)
+            if not mainchunks:
+                return None
+            arrays = [aligned_arrays(m1, m2) for m1, m2 in zip(mainchunks, meterchunks)]
+            return d._sampler([d._normalize(m, d.mmax) for m, _ in arrays],
+                              [d._normalize(m, d.mmax) for _, m in arrays], self.batch_size, weights)
+
+        yielded = 0
+        for sampler in prefetch_chunks(islice(chunks, skip, None), prepare, self.workers, self.prefetch):
+            for X, Y in (sampler.batches() if sampler is not None else []):
+                # keras may hold on to a batch while the next is gathered,
+                # so it gets copies of the sampler's buffers
+                yield X.copy(), Y.copy()
+                yielded += 1
+            boundaries.append(yielded)
+
+    def train(self, epochs):
+        '''Trains until `epochs` epochs are done, counting those done before a restart'''
+        d = self.disaggregator
+        if d.mmax == None:
+            d.stats = combined_stats(self.mainlist, **self.load_kwargs).as_dict()
+            d.mmax = d.stats['max']
+        if hasattr(d, 'lookup'):
+            d.lookup = None
+
+        while self.epoch < epochs:
+            boundaries = []
+            start = time.time()
+            with warnings.catch_warnings():
+                # Keras warns whenever a generator of unknown length ends, which is how every epoch ends here
+                warnings.filterwarnings('ignore', message='Your input ran out of data')
+                d.model.fit(self.batches(self.chunk, boundaries), epochs=self.epoch + 1, initial_epoch=self.epoch,
+                            callbacks=[_Progress(self, boundaries)])
+            print("Epoch {} done in {:.0f}s".format(self.epoch + 1, time.time() - start))
+            self.epoch += 1
+            self.chunk = 0
+            self.save()
+
+    def save(self):
+        '''Writes the model and the progress to the checkpoint, replacing the last one'''
+        if self.checkpoint is None:
+            return
+        # Written next to the checkpoint and renamed, so a crash mid-write keeps the last one
+        self.disaggregator.export_model(self.checkpoint + '.tmp.h5')
+        with h5py.File(self.checkpoint + '.tmp.h5', 'a') as hf:
+            progress = hf.create_group(PROGRESS_GROUP)
+            progress.attrs['epoch'] = self.epoch
+            progress.attrs['chunk'] = self.chunk
+            progress.attrs['batch_size'] = self.batch_size
+            progress.attrs['saved'] = time.time()
+        os.replace(self.checkpoint + '.tmp.h5', self.checkpoint + '.h5')
+
+    def resume(self):
+        '''Loads the model and the progress saved to the checkpoint'''
+        state = read_progress(self.checkpoint + '.h5')
+        self.disaggregator.import_model(self.checkpoint + '.h5')
+        self.epoch, self.chunk = state['epoch'], state['chunk']
+        print("Resuming from epoch {}, chunk {}".format(self.epoch + 1, self.chunk))
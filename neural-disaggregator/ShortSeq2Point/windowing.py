@@ -0,0 +1,124 @@
+from __future__ import print_function, division
+import math
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from keras.utils import Sequence
+
+# Sliding windows without the (N, window_size) copy of the fancy indexer.
+# `sliding_windows` is a read only strided view over the chunk, and
+# WindowSequence hands Keras one batch of windows at a time, so training and
+# prediction keep the chunk plus one batch in memory instead of the chunk
+# times window_size.  For the seq2seq models, which output a whole window,
+# window_starts and merge_windows pick the strided windows to predict and
+# average their overlapping outputs back into one value per sample.
+
+
+def sliding_windows(series, window_size):
+    '''Every window of `series` as a read only view, no data is copied
+
+    Parameters
+    ----------
+    series : 1d float32 array
+    window_size : length of a window
+
+    Returns: array of shape (len(series) - window_size + 1, window_size, 1)
+    '''
+    stride = series.strides[0]
+    count = max(len(series) - window_size + 1, 0)
+    return as_strided(series, shape=(count, window_size, 1), strides=(stride, stride, stride),
+                      writeable=False)
+
+
+def window_starts(length, window_size, stride):
+    '''First samples of windows `stride` apart covering a series of `length` >= window_size samples
+
+    The last window ends at the last sample, even if that breaks the stride.
+    '''
+    starts = np.arange(0, length - window_size + 1, stride)
+    if starts[-1] != length - window_size:
+        starts = np.r_[starts, length - window_size]
+    return starts
+
+
+def merge_windows(pred, starts, length):
+    '''Averages overlapping window outputs into one value per sample
+
+    Parameters
+    ----------
+    pred : array of shape (len(starts), window_size), the output of every window
+    starts : first sample of every window
+    length : number of samples of the series
+
+    Returns: 1d array of `length` values
+    '''
+    positions = (starts[:, None] + np.arange(pred.shape[1])[None, :]).ravel()
+    sums = np.bincount(positions, weights=pred.ravel(), minlength=length)
+    counts = np.bincount(positions, minlength=length)
+    return sums / np.maximum(counts, 1)
+
+
+class WindowSequence(Sequence):
+    '''Batches of sliding windows of one or more buildings, for `model.fit` and `model.predict`
+
+    Window i of a building is mains[i:i+window_size] and its target is the
+    appliance at the window's last sample, meter[i+window_size-1], or the
+    whole window meter[i:i+window_size] with `sequence`. Every
+    batch holds batch_size/len(mains) windows of each building, so all
+    buildings weigh the same.
+
+    Parameters
+    ----------
+    mains : list of 1d arrays of normalized aggregate data, one per building
+    meters : list of arrays of the normalized appliance aligned with
+        `mains`, 1d or time x appliances, or None to only yield windows
+        (prediction)
+    window_size : length of a window
+    batch_size : number of windows per batch, over all buildings
+    shuffle : draw the windows of every epoch in a new random order
+    sequence : target the appliance over the whole window (seq2seq models),
+        meters must then be 1d
+    '''
+
+    def __init__(self, mains, meters, window_size, batch_size, shuffle=True, sequence=False):
+        super(WindowSequence, self).__init__()
+        self.mains = [np.ascontiguousarray(m, dtype=np.float32) for m in mains]
+        self.windows = [sliding_windows(m, window_size) for m in self.mains]
+        self.targets = None
+        if meters is not None and sequence:
+            targets = [np.ascontiguousarray(m, dtype=np.float32) for m in meters]
+            self.targets = [sliding_windows(t, window_size)[:, :, 0] for t in targets]
+        elif meters is not None:
+            targets = [np.asarray(m, dtype=np.float32)[window_size-1:] for m in meters]
+            self.targets = [t.reshape(len(t), -1) for t in targets]
+        self.batch_size = max(int(batch_size / len(mains)), 1)
+        self.shuffle = shuffle
+        self.length = min(len(w) for w in self.windows)
+        self.orders = None
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(math.ceil(self.length / self.batch_size))
+
+    def __getitem__(self, idx):
+        X, Y = [], []
+        for i, windows in enumerate(self.windows):
+            if self.orders is None:
+                rows = slice(idx*self.batch_size, min((idx+1)*self.batch_size, self.length))
+            else:
+                rows = self.orders[i][idx*self.batch_size:(idx+1)*self.batch_size]
+            # Only the batch is copied out of the strided view
+            X.append(windows[rows])
+            if self.targets is not None:
+                Y.append(self.targets[i][rows])
+
+        X = X[0] if len(X) == 1 else np.concatenate(X)
+        if self.targets is None:
+            return X
+        Y = Y[0] if len(Y) == 1 else np.concatenate(Y)
+        return X, Y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.orders = [np.random.permutation(len(w))[:self.length] for w in self.windows]
@@ -0,0 +1,320 @@
+from __future__ import print_function, division
+from itertools import zip_longest
+
+import pandas as pd
+import numpy as np
+
+from keras.models import Model
+from keras.layers import Input, Dense, Conv1D, GRU, Bidirectional, Dropout, Concatenate
+
+from windowgrudisaggregator import WindowGRUDisaggregator
+from meterarrays import align
+from goodsections import good_sections
+from levels import power_series
+from prefetch import prefetch_chunks, aligned_arrays, WORKERS, PREFETCH
+from normstats import meter_stats, combined_stats, array_stats
+from windowing import WindowSequence
+
+class MultiWindowGRUDisaggregator(WindowGRUDisaggregator):
+    '''Window GRU disaggregator with one output per appliance
+
+    The layers up to the second bidirectional GRU are shared by all appliances, each
+    appliance gets its own head after them. The model is trained against a
+    time x appliances target matrix and one forward pass over the mains
+    predicts every appliance, instead of one model, training and pass per
+    appliance.
+
+    Attributes
+    ----------
+    model : keras Model, its last axis holds one output per appliance
+    appliances : number of appliances
+    mmax : the maximum value of the aggregate data
+    '''
+
+    def __init__(self, appliances, window_size=100):
+        '''Initialize disaggregator
+
+        Parameters
+        ----------
+        appliances : number of appliances disaggregated
+        window_size : the size of window to use on the aggregate data
+        '''
+        self.appliances = appliances
+        super(MultiWindowGRUDisaggregator, self).__init__(window_size)
+        self.MODEL_NAME = "Multi" + self.MODEL_NAME
+
+    def train(self, mains, meters, epochs=1, batch_size=128, workers=WORKERS, prefetch=PREFETCH, **load_kwargs):
+        '''Train
+
+        Parameters
+        ----------
+        mains : a nilmtk.ElecMeter object for the aggregate data
+        meters : a list of nilmtk.ElecMeter objects, one per appliance, in output order
+        epochs : number of epochs to train
+        batch_size : size of batch used for training
+        workers : number of threads preparing the upcoming chunks
+        prefetch : number of chunks read and prepared ahead, see prefetch.py
+        **load_kwargs : keyword arguments passed to `meter.power_series()`
+        '''
+        assert len(meters) == self.appliances, "One meter per appliance is needed"
+
+        chunks = zip(power_series(mains, **load_kwargs), *[power_series(m, **load_kwargs) for m in meters])
+
+        # mmax is the maximum of the whole mains, from the stats stored next to the meter
+        if self.mmax == None:
+            self.stats = meter_stats(mains, **load_kwargs).as_dict()
+            self.mmax = self.stats['max']
+
+        def prepare(chunk):
+            mainchunk, meterchunk = aligned_arrays(chunk[0], self._target_matrix(list(chunk[1:])))
+            return self._normalize(mainchunk, self.mmax), self._normalize(meterchunk, self.mmax)
+
+        # Train chunks, the next ones are read and prepared meanwhile
+        for mainchunk, meterchunk in prefetch_chunks(chunks, prepare, workers, prefetch):
+            self.train_on_chunk(mainchunk, meterchunk, epochs, batch_size)
+
+    def train_on_chunk(self, mainchunk, meterchunk, epochs, batch_size):
+        '''Train using only one chunk
+
+        Parameters
+        ----------
+        mainchunk : chunk of site meter, a pd.Series or an np.array aligned with meterchunk
+        meterchunk : time x appliances pd.DataFrame, or np.array aligned with mainchunk
+        epochs : number of epochs for training
+        batch_size : size of batch used for training
+        '''
+
+        if isinstance(mainchunk, pd.Series):
+            # Replace NaNs with 0s
+            mainchunk.fillna(0, inplace=True)
+            meterchunk = meterchunk.fillna(0)
+            ix = mainchunk.index.intersection(meterchunk.index)
+            mainchunk = np.array(mainchunk[ix])
+            meterchunk = np.array(meterchunk.loc[ix])
+
+        # Windows are cut out of the chunk one batch at a time, see windowing.py
+        batches = WindowSequence([mainchunk], [meterchunk], self.window_size, batch_size)
+        self.model.fit(batches, epochs=epochs)
+
+    def train_from_arrays(self, mains, meters, epochs=1, batch_size=128, chunksize=2**20):
+        '''Train from memory-mapped meter arrays, see meterarrays.py
+
+        Parameters
+        ----------
+        mains : meterarrays.MeterArray of the aggregate data
+        meters : list of meterarrays.MeterArray, one per appliance, in output order
+        epochs : number of epochs to train
+        batch_size : size of batch used for training
+        chunksize : number of samples trained on at once
+        '''
+
+        # Cut everything to the span all meters share
+        for meter in meters:
+            mains, _ = align(mains, meter)
+        meters = [align(mains, meter)[1] for meter in meters]
+        if self.mmax == None:
+            self.stats = array_stats(mains.values, chunksize).as_dict()
+            self.mmax = self.stats['max']
+
+        mmax = np.float32(self.mmax)
+        for start in range(0, len(mains), chunksize):
+            mainchunk = self._normalize(mains.values[start:start+chunksize], mmax)
+            meterchunk = np.stack([m.values[start:start+chunksize] for m in meters], axis=1)
+            meterchunk = self._normalize(meterchunk, mmax)
+            self.train_on_chunk(mainchunk, meterchunk, epochs, batch_size)
+
+    def train_across_buildings(self, mainlist, meterlist, epochs=1, batch_size=128, workers=WORKERS, prefetch=PREFETCH,
+                               **load_kwargs):
+        '''Train on several buildings, one chunk of every building at a time
+
+        Parameters
+        ----------
+        mainlist : list of nilmtk.ElecMeter objects for the aggregate data, one per building
+        meterlist : list with the appliance meters of every building, each a
+            list of nilmtk.ElecMeter objects, one per appliance, in output order
+        epochs : number of epochs to train on every chunk
+        batch_size : size of batch used for training
+        workers : number of threads preparing the upcoming chunks
+        prefetch : number of chunks read and prepared ahead, see prefetch.py
+        **load_kwargs : keyword arguments passed to `meter.power_series()`
+        '''
+        assert len(mainlist) == len(meterlist), "Number of main and meter channels should be equal"
+        for meters in meterlist:
+            assert len(meters) == self.appliances, "One meter per appliance is needed"
+        num_meters = len(mainlist)
+
+        # Every chunk holds the mains of all buildings, then the appliance chunks of every
+        # building. A building whose data ran out is None and left out of the chunk
+        chunks = zip_longest(*([power_series(m, **load_kwargs) for m in mainlist] +
+                               [zip(*[power_series(m, **load_kwargs) for m in meters]) for meters in meterlist]))
+
+        # mmax is the maximum of the mains of all buildings, see normstats.py
+        if self.mmax == None:
+            self.stats = combined_stats(mainlist, **load_kwargs).as_dict()
+            self.mmax = self.stats['max']
+
+        def prepare(chunk):
+            arrays = [aligned_arrays(mainchunk, self._target_matrix(list(meterchunks)))
+                      for mainchunk, meterchunks in zip(chunk[:num_meters], chunk[num_meters:])
+                      if mainchunk is not None and meterchunks is not None]
+            return ([self._normalize(m, self.mmax) for m, _ in arrays],
+                    [self._normalize(m, self.mmax) for _, m in arrays])
+
+        # Normalize and train, the next chunks are read and prepared meanwhile
+        for mainchunks, meterchunks in prefetch_chunks(chunks, prepare, workers, prefetch):
+            if mainchunks:
+                self.train_across_buildings_chunk(mainchunks, meterchunks, epochs, batch_size)
+
+    def train_across_buildings_chunk(self, mainchunks, meterchunks, epochs, batch_size):
+        '''Train using one chunk of every building
+
+        Parameters
+        ----------
+        mainchunks : list of normalized arrays of the aggregate data, one per building
+        meterchunks : list of normalized time x appliances arrays aligned with `mainchunks`
+        epochs : number of epochs for training
+        batch_size : size of batch used for training
+        '''
+        # Windows are cut out of every building separately, see windowing.py
+        batches = WindowSequence(mainchunks, meterchunks, self.window_size, batch_size)
+        self.model.fit(batches, epochs=epochs)
+
+    def disaggregate(self, mains, output_datastore, meters_metadata, **load_kwargs):
+        '''Disaggregate every appliance in one pass over the mains
+
+        Parameters
+        ----------
+        mains : a nilmtk.ElecMeter of aggregate data
+        output_datastore : instance of nilmtk.DataStore subclass
+            For storing power predictions from disaggregation algorithm.
+        meters_metadata : list of nilmtk.ElecMeter, the observed meters of
+            the appliances in output order, used for storing the metadata
+        **load_kwargs : key word arguments
+            Passed to `mains.power_series(**kwargs)`
+        '''
+        assert len(meters_metadata) == self.appliances, "One meter per appliance is needed"
+
+        load_kwargs = self._pre_disaggregation_checks(load_kwargs)
+
+        load_kwargs.setdefault('sample_period', 60)
+        load_kwargs.setdefault('sections', good_sections(mains))
+
+        timeframes = []
+        building_path = '/building{}'.format(mains.building())
+        mains_data_location = building_path + '/elec/meter1'
+        data_is_available = False
+
+        for chunk in power_series(mains, **load_kwargs):
+            if len(chunk) < self.MIN_CHUNK_LENGTH:
+                continue
+            print("New sensible chunk: {}".format(len(chunk)))
+
+            timeframes.append(chunk.timeframe)
+            measurement = chunk.name
+            chunk2 = self._normalize(chunk, self.mmax)
+
+            appliance_powers = self.disaggregate_chunk(chunk2)
+            appliance_powers[appliance_powers < 0] = 0
+            appliance_powers = self._denormalize(appliance_powers, self.mmax)
+
+            # Append every prediction to output
+            data_is_available = True
+            cols = pd.MultiIndex.from_tuples([chunk.name])
+            for i, meter_metadata in enumerate(meters_metadata):
+                df = pd.DataFrame(
+                    appliance_powers[i].values, index=appliance_powers.index,
+                    columns=cols, dtype="float32")
+                key = '{}/elec/meter{}'.format(building_path, meter_metadata.instance())
+                output_datastore.append(key, df)
+
+            # Append aggregate data to output
+            mains_df = pd.DataFrame(chunk, columns=cols, dtype="float32")
+            output_datastore.append(key=mains_data_location, value=mains_df)
+
+        # Save metadata to output
+        if data_is_available:
+            self._save_metadata_for_disaggregation(
+                output_datastore=output_datastore,
+                sample_period=load_kwargs['sample_period'],
+                measurement=measurement,
+                timeframes=timeframes,
+                building=mains.building(),
+                meters=meters_metadata
+            )
+
+    def disaggregate_chunk(self, mains):
+        '''In-memory disaggregation.
+
+        Parameters
+        ----------
+        mains : pd.Series of aggregate data
+        Returns
+        -------
+        appliance_powers : pd.DataFrame where each column represents a
+            disaggregated appliance.  Column i is output i of `self.model`.
+        '''
+        mains.fillna(0, inplace=True)
+
+        X_batch = np.array(mains)
+        Y_len = len(X_batch)
+        batches = WindowSequence([X_batch], None, self.window_size, 128, shuffle=False)
+
+        pred = self.model.predict(batches)
+        return pd.DataFrame(pred, index=mains.index[self.window_size-1:Y_len], columns=range(self.appliances))
+
+    def import_model(self, filename):
+        '''Loads keras model from h5, the number of appliances is read from its output
+
+        Parameters
+        ----------
+        filename : filename for .h5 file
+        '''
+        super(MultiWindowGRUDisaggregator, self).import_model(filename)
+        self.appliances = self.model.output_shape[-1]
+
+    def import_onnx(self, filename, threads=None):
+        '''Loads a model saved by export_onnx(), the number of appliances is read from its output
+
+        Parameters
+        ----------
+        filename : filename for .onnx file
+        threads : number of threads onnxruntime uses, its default if None
+        '''
+        super(MultiWindowGRUDisaggregator, self).import_onnx(filename, threads)
+        self.appliances = self.model.output_shape[-1]
+
+    def _target_matrix(self, meterchunks):
+        '''Joins one chunk per appliance into a time x appliances pd.DataFrame'''
+        return pd.concat(meterchunks, axis=1, keys=range(self.appliances))
+
+    def _heads(self, x, head):
+        '''Applies a new `head` to the shared output `x` for every appliance and joins them on the last axis'''
+        outputs = [head(x) for _ in range(self.appliances)]
+        return outputs[0] if self.appliances == 1 else Concatenate()(outputs)
+
+    def _create_model(self):
+        '''Creates the GRU architecture described in the paper, with the
+        fully connected layers repeated for every appliance
+        '''
+        inputs = Input(shape=(self.window_size, 1))
+
+        # 1D Conv
+        x = Conv1D(16, 4, activation='relu', padding="same", strides=1)(inputs)
+
+        #Bi-directional GRUs
+        x = Bidirectional(GRU(64, activation='relu', return_sequences=True), merge_mode='concat')(x)
+        x = Dropout(0.5)(x)
+        x = Bidirectional(GRU(128, activation='relu', return_sequences=False), merge_mode='concat')(x)
+        x = Dropout(0.5)(x)
+
+        # Fully Connected Layers
+        def head(x):
+            x = Dense(128, activation='relu')(x)
+            x = Dropout(0.5)(x)
+            return Dense(1, activation='linear')(x)
+
+        model = Model(inputs, self._heads(x, head))
+        model.compile(loss='mse', optimizer='adam')
+        print(model.summary())
+
+        return model
@@ -0,0 +1,158 @@
+from __future__ import print_function, division
+
+import numpy as np
+import pandas as pd
+
+from nilmtk.datastore import HDFDataStore
+
+from levels import power_series, level_key, power_column, LEVEL_KWARGS
+from columnstats import RESOLUTION, QUANTILES, MOMENTS, quantile_name, ColumnStats
+
+# Normalization statistics of the mains.  train() used to scale the data by
+# the maximum of the first chunk it read, so a larger peak later in the meter
+# went past 1.  meter_stats() gives the count, min, max, mean, std and
+# quantiles of the samples a model is trained on, computed in one pass over
+# their chunks.  Those of a whole meter, or of one of its pyramid levels, are
+# read from the table SeniorDataset/meterStats.py stores next to it at ingest
+# (/building1/elec/meter1/stats); a table without one gets it computed and
+# stored there, so the next training doesn't scan it again.
+
+STATS_NODE = 'stats'
+HISTOGRAM_NODE = 'stats_histogram'
+CHUNKSIZE = 500000
+
+
+def load_stats(store, key):
+    '''Reads the stats of table `key` of a pd.HDFStore
+
+    Returns: (stats table, histogram table, resolution), None if there are
+        none or rows were appended to the table since they were computed
+    '''
+    skey, hkey = key + '/' + STATS_NODE, key + '/' + HISTOGRAM_NODE
+    if skey not in store or hkey not in store:
+        return None
+    table = store[skey]
+    if int(table.loc['rows'].iloc[0]) != store.get_storer(key).nrows:
+        return None
+    return table, store[hkey], store.get_storer(skey).attrs.resolution
+
+
+def build_stats(store, key, resolution=RESOLUTION, chunksize=CHUNKSIZE):
+    '''Computes the stats of every column of table `key` in one pass and stores them next to it
+
+    They are returned even if the store can't be written.
+
+    Returns: (stats table, histogram table, resolution)
+    '''
+    columns, names, stats = None, None, None
+    for chunk in store.select(key, chunksize=chunksize):
+        if stats is None:
+            columns, names = list(chunk.columns), chunk.columns.names
+            stats = [ColumnStats(resolution) for _ in columns]
+        for column, s in zip(columns, stats):
+            s.update(chunk[column].values)
+    if stats is None:
+        return None
+
+    index = MOMENTS + [quantile_name(q) for q in QUANTILES]
+    rows = store.get_storer(key).nrows
+    table = pd.DataFrame(np.array([s.summary(rows) for s in stats]).T, index=index,
+                         columns=pd.MultiIndex.from_tuples(columns, names=names))
+    bins = max(len(s.histogram) for s in stats)
+    histogram = pd.DataFrame(np.array([np.r_[s.histogram, np.zeros(bins - len(s.histogram), dtype=np.int64)]
+                                       for s in stats]).T, columns=table.columns)
+    try:
+        store.put(key + '/' + STATS_NODE, table)
+        store.put(key + '/' + HISTOGRAM_NODE, histogram)
+        store.get_storer(key + '/' + STATS_NODE).attrs.resolution = resolution
+    except (ValueError, IOError):
+        # A store opened read only keeps computing them on every call
+        pass
+    return table, histogram, resolution
+
+
+def meter_stats(meter, **load_kwargs):
+    '''Statistics of the power `meter.power_series(**load_kwargs)` yields
+
+    Parameters
+    ----------
+    meter : nilmtk.ElecMeter or MeterGroup. Without a window on its store
+        and without sections, the stats of a meter of an HDFDataStore, or
+        of its pyramid level at `sample_period` (see levels.py), are those
+        stored next to the table, or stored there after a single pass over
+        it. Everything else, e.g. a window set for a train/test split or a
+        MeterGroup of two mains, is read once through `power_series()`, so
+        the stats never include samples the model isn't trained on
+    **load_kwargs : keyword arguments passed to `meter.power_series()`
+
+    Returns: ColumnStats
+    '''
+    key = _stats_table(meter, load_kwargs)
+    if key is not None:
+        store = meter.store.store
+        cached = load_stats(store, key)
+        if cached is None:
+            cached = build_stats(store, key)
+        if cached is not None:
+            table, histogram, resolution = cached
+            column = power_column(list(table.columns), load_kwargs.get('ac_type'))
+            return ColumnStats.from_summary(table[column], histogram[column].values, resolution)
+
+    stats = ColumnStats()
+    for chunk in power_series(meter, **load_kwargs):
+        stats.update(chunk.values)
+    return stats
+
+
+def _stats_table(meter, load_kwargs):
+    '''Key of the h5 table holding exactly the samples `meter.power_series(**load_kwargs)` yields, None if there is none'''
+    store = getattr(meter, 'store', None)
+    key = getattr(meter, 'key', None)
+    if not isinstance(store, HDFDataStore) or key is None:
+        return None
+    window = store.window
+    if window.start is not None or window.end is not None or load_kwargs.get('sections') is not None:
+        return None
+    if not set(load_kwargs) <= LEVEL_KWARGS or load_kwargs.get('physical_quantity', 'power') != 'power':
+        return None
+    if not load_kwargs.get('sample_period'):
+        return '/' + key.strip('/')
+    return level_key(meter, load_kwargs['sample_period'])
+
+
+def combined_stats(meters, **load_kwargs):
+    '''meter_stats() of several meters, e.g. the mains of every training building, merged
+
+    Returns: ColumnStats
+    '''
+    stats = ColumnStats()
+    for meter in meters:
+        stats.merge(meter_stats(meter, **load_kwargs))
+    return stats
+
+
+def array_stats(values, chunksize=CHUNKSIZE):
+    '''Statistics of an array, e.g. a MeterArray's memory map, read chunk by chunk
+
+    Returns: ColumnStats
+    '''
+    stats = ColumnStats()
+    for start in range(0, len(values), chunksize):
+        stats.update(values[start:start+chunksize])
+    return stats
+
+
+def save_stats(group, stats):
+    '''Writes a disaggregator's stats dict to the h5py group of its exported model'''
+    names = sorted(stats)
+    ds = group.create_dataset('stats', data = [stats[n] for n in names])
+    ds.attrs['names'] = names
+
+
+def read_stats(group):
+    '''Reads the stats dict save_stats() wrote, None for models exported without one'''
+    if 'stats' not in group:
+        return None
+    ds = group['stats']
+    names = [n.decode() if isinstance(n, bytes) else str(n) for n in ds.attrs['names']]
+    return dict(zip(names, [float(v) for v in np.array(ds)]))
@@ -0,0 +1,50 @@
+from __future__ import print_function, division
+import time
+
+import numpy as np
+
+from nilmtk import DataSet
+from windowgrudisaggregator import WindowGRUDisaggregator
+
+# Checks the onnxruntime backend against keras on a model exported by
+# ukdale-test.py: both disaggregate the same test chunk, the outputs must
+# match and the time each takes is compared.
+
+print("========== OPEN DATASETS ============")
+test = DataSet('ukdale.h5')
+test.set_window(start="1-1-2014", end="30-3-2014")
+
+test_building = 1
+sample_period = 6
+meter_key = 'kettle'
+model_filename = "UKDALE-RNN-h1-{}-15epochs.h5".format(meter_key)
+onnx_filename = "UKDALE-RNN-h1-{}.onnx".format(meter_key)
+test_mains = test.buildings[test_building].elec.mains()
+
+print("========== EXPORT ============")
+keras_disaggregator = WindowGRUDisaggregator()
+keras_disaggregator.import_model(model_filename)
+keras_disaggregator.export_onnx(onnx_filename)
+onnx_disaggregator = WindowGRUDisaggregator()
+onnx_disaggregator.import_onnx(onnx_filename)
+mmax = keras_disaggregator.mmax
+
+print("========== DISAGGREGATE ============")
+chunk = next(test_mains.power_series(sample_period=sample_period))
+chunk = keras_disaggregator._normalize(chunk, mmax)
+print("Chunk of {} samples".format(len(chunk)))
+
+results = {}
+for name, disaggregator in [('keras', keras_disaggregator), ('onnxruntime', onnx_disaggregator)]:
+    # The first call pays for setting up the graph
+    disaggregator.disaggregate_chunk(chunk[:10000].copy())
+    start = time.time()
+    results[name] = disaggregator.disaggregate_chunk(chunk.copy())
+    seconds = time.time() - start
+    print("{} = {} seconds, {} samples per second".format(name, seconds, len(chunk) / seconds))
+
+print("========== RESULTS ============")
+difference = np.abs(results['keras'].values - results['onnxruntime'].values) * mmax
+print("============ Max absolute difference(in Watts): {}".format(difference.max()))
+print("============ Mean absolute difference(in Watts): {}".format(difference.mean()))
+assert difference.max() < 1, "onnxruntime output differs from keras"
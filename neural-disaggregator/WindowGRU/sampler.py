@@ -0,0 +1,124 @@
+from __future__ import print_function, division
+import sys
+import time
+
+import numpy as np
+
+# Batches for training across buildings.  The chunks of all buildings are
+# joined into one float32 array, every training example is the position of
+# its window in that array, and a batch is gathered with one np.take over a
+# block of positions into buffers allocated once.  An epoch goes through
+# every example of every building once in random order, so a larger
+# building isn't cut to the length of the smallest one, or, with weights,
+# draws examples so that every building contributes its share.
+
+
+class CrossBuildingSampler(object):
+    '''Training batches drawn from the aligned chunks of several buildings
+
+    Attributes
+    ----------
+    starts : first sample of every example's window in the joined array
+    building : building of every example
+    examples_per_second : training rate of the last epoch of fit()
+
+    Parameters
+    ----------
+    mains : list of 1d arrays of normalized aggregate data, one per building
+    meters : list of 1d arrays of the normalized appliance aligned with `mains`
+    window_size : number of samples the model sees, 1 for RNN and GRU
+    batch_size : number of examples per batch, over all buildings
+    stride : samples between the windows of a building, window_size for
+        the consecutive windows of the DAE
+    sequence : target the appliance over the whole window instead of at
+        its last sample
+    channel : give sequence targets a last axis of 1, the (batch, window, 1)
+        output of the DAE
+    weights : None to use every example once per epoch, 'equal' to give
+        all buildings the same weight, or a list of one weight per
+        building. With weights the examples of an epoch are drawn with
+        replacement, a building is drawn in proportion to its weight
+    '''
+
+    def __init__(self, mains, meters, window_size, batch_size, stride=1, sequence=False, channel=False,
+                 weights=None):
+        lengths = [min(len(m), len(t)) for m, t in zip(mains, meters)]
+        self.mains = np.concatenate([np.asarray(m[:n], dtype=np.float32) for m, n in zip(mains, lengths)])
+        self.meters = np.concatenate([np.asarray(t[:n], dtype=np.float32) for t, n in zip(meters, lengths)])
+        self.window_size = window_size
+        self.batch_size = batch_size
+        self.sequence = sequence
+        self.channel = channel
+
+        # Windows don't cross from one building into the next
+        offsets = np.r_[0, np.cumsum(lengths)[:-1]]
+        starts = [o + np.arange(0, n - window_size + 1, stride) for o, n in zip(offsets, lengths)]
+        self.building = np.concatenate([np.full(len(s), i) for i, s in enumerate(starts)])
+        self.starts = np.concatenate(starts).astype(np.int64)
+        self.probabilities = self._probabilities(weights, [len(s) for s in starts])
+        self.examples_per_second = None
+
+        # Buffers reused by every batch
+        self._window = np.arange(window_size)
+        self._index = np.empty((batch_size, window_size), dtype=np.int64)
+        self._X = np.empty((batch_size, window_size), dtype=np.float32)
+        self._Y = np.empty((batch_size, window_size if sequence else 1), dtype=np.float32)
+
+    def _probabilities(self, weights, counts):
+        '''Probability of drawing every example, None to use each once'''
+        if weights is None:
+            return None
+        if weights == 'equal':
+            weights = np.ones(len(counts))
+        weights = np.asarray(weights, dtype=np.float64)
+        counts = np.asarray(counts, dtype=np.float64)
+        per_example = np.where(counts > 0, weights / np.maximum(counts, 1), 0)[self.building]
+        return per_example / per_example.sum()
+
+    def __len__(self):
+        return int(np.ceil(len(self.starts) / self.batch_size))
+
+    def batches(self):
+        '''Yields the (X, Y) batches of one epoch
+
+        X has shape (batch, window_size, 1), Y (batch, 1), or (batch,
+        window_size) with `sequence` and (batch, window_size, 1) with
+        `channel`, in the shapes of the model. Both are views of the
+        sampler's buffers, overwritten by the next batch.
+        '''
+        if self.probabilities is None:
+            order = self.starts[np.random.permutation(len(self.starts))]
+        else:
+            order = self.starts[np.random.choice(len(self.starts), len(self.starts), p=self.probabilities)]
+
+        for b in range(0, len(order), self.batch_size):
+            starts = order[b:b+self.batch_size]
+            n = len(starts)
+            index, X, Y = self._index[:n], self._X[:n], self._Y[:n]
+            np.add(starts[:, None], self._window, out=index)
+            np.take(self.mains, index, out=X, mode='clip')
+            if self.sequence:
+                np.take(self.meters, index, out=Y, mode='clip')
+            else:
+                np.take(self.meters, index[:, -1:], out=Y, mode='clip')
+            yield X[:, :, None], (Y[:, :, None] if self.channel else Y)
+
+    def fit(self, model, epochs=1):
+        '''Trains `model` with train_on_batch for `epochs` epochs and prints the examples per second
+
+        Parameters
+        ----------
+        model : keras model
+        epochs : number of epochs
+        '''
+        for e in range(epochs):
+            start = time.time()
+            examples = 0
+            for bi, (X, Y) in enumerate(self.batches()):
+                print("Batch {} of {}".format(bi, len(self)), end="\r")
+                sys.stdout.flush()
+                model.train_on_batch(X, Y)
+                examples += len(X)
+            seconds = time.time() - start
+            self.examples_per_second = examples / seconds if seconds > 0 else None
+            print("Epoch {}: {} examples, {:.0f} examples/s".format(e, examples, examples / max(seconds, 1e-9)))
@@ -0,0 +1,321 @@
+from __future__ import print_function, division
+
+# Local HTTP service around the models exported by the disaggregators of this
+# folder, so scripts don't pay for the process start, the TensorFlow import
+# and import_model() on every run.  Loaded models stay in memory keyed by
+# their file and its modification time (a retrained export is picked up on
+# the next request).  Requests for the same model that arrive while a
+# prediction runs are joined into the next model.predict batch, and the
+# predictions run on a thread pool so the event loop keeps accepting
+# requests.  The windows of a request are a view of its mains, they are only
+# copied out MAX_ROWS at a time for the model, so a long request to a window
+# model doesn't need len(mains) * window_size floats at once.
+#
+# POST /disaggregate  {"model": "WindowGRU/fridge.h5", "mains": [watts, ...]}
+#   -> {"model": ..., "estimates": [[watts of appliance 0, ...], ...]}
+#      one estimate per mains sample, NaN mains are taken as 0
+# GET /stats          requests, batches and latency percentiles per model
+#
+# to run
+# python3 disaggserver.py --root . --port 8765
+# curl -d '{"model": "WindowGRU/fridge.h5", "mains": [120, 130, 2100]}' localhost:8765/disaggregate
+
+import os
+import json
+import time
+import asyncio
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from streaming import LoadedModel
+
+HOST = '127.0.0.1'
+PORT = 8765
+COALESCE_DELAY = 0.002   # seconds the first request of a batch waits for others
+LATENCIES = 10000        # latencies kept per model for the percentiles
+MAX_BODY = 64 * 2**20
+MAX_ROWS = 8192           # model inputs predicted at once
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super(RequestError, self).__init__(message)
+        self.status = status
+
+
+def model_rows(model, mains):
+    '''The model inputs covering every sample of `mains`
+
+    A window model gets the window ending at every sample, the samples
+    before the first one taken as 0 like in streaming.py.  A sequence
+    model (DAE) gets consecutive windows, the last one padded with 0.
+
+    Returns: array of shape (rows, window_size) in watts, the windows of
+        a window model are a read only view of `mains`
+    '''
+    w = model.window_size
+    if model.sequence:
+        padded = np.r_[mains, np.zeros(-len(mains) % w, dtype=np.float32)]
+        return padded.reshape(-1, w)
+    return sliding_window_view(np.r_[np.zeros(w - 1, dtype=np.float32), mains], w)
+
+
+def row_blocks(requests, max_rows):
+    '''Splits the rows of the `requests` into blocks of at most `max_rows` rows
+
+    Parameters
+    ----------
+    requests : list of the model_rows() of every request
+
+    Yields: lists of (request, first row, end row) making up a block
+    '''
+    block, size = [], 0
+    for i, rows in enumerate(requests):
+        start = 0
+        while start < len(rows):
+            end = min(len(rows), start + max_rows - size)
+            block.append((i, start, end))
+            size += end - start
+            start = end
+            if size == max_rows:
+                yield block
+                block, size = [], 0
+    if block:
+        yield block
+
+
+def model_estimates(model, pred, samples):
+    '''Inverse of model_rows(): the (samples, appliances) estimates of one request'''
+    if model.sequence:
+        return pred.reshape(-1, model.appliances)[:samples]
+    return pred
+
+
+class ModelQueue(object):
+    '''Requests waiting for one loaded model, predicted together
+
+    Attributes
+    ----------
+    model : streaming.LoadedModel
+    pending : list of (rows, future) not yet sent to the model
+    latencies : deque of the last seconds from request to estimates
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        self.pending = []
+        self.running = False
+        self.requests = 0
+        self.batches = 0
+        self.rows = 0
+        self.latencies = deque(maxlen=LATENCIES)
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        percentiles = np.percentile(latencies, [50, 90, 99]) if len(latencies) else [None] * 3
+        return {'requests': self.requests, 'batches': self.batches,
+                'mean_batch_rows': self.rows / self.batches if self.batches else None,
+                'latency_ms': dict(zip(['p50', 'p90', 'p99'], percentiles)),
+                'window_size': int(self.model.window_size), 'appliances': int(self.model.appliances)}
+
+
+class DisaggregationServer(object):
+    '''asyncio HTTP server keeping the models warm and coalescing their predictions
+
+    Attributes
+    ----------
+    root : directory the model paths of the requests are relative to,
+        models outside of it are refused
+    queues : dict of (path, mtime) -> ModelQueue of every loaded model
+    executor : thread pool running model loads and predictions
+    coalesce_delay : seconds the first request of a batch waits for others
+    max_rows : model inputs sent to model.predict at once, longer batches
+        are predicted in blocks of that many
+    '''
+
+    def __init__(self, root='.', workers=None, coalesce_delay=COALESCE_DELAY, max_rows=MAX_ROWS):
+        self.root = os.path.realpath(root)
+        self.queues = {}
+        self.loading = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.coalesce_delay = coalesce_delay
+        self.max_rows = max(max_rows, 1)
+        self.started = time.time()
+
+    async def model_queue(self, path):
+        '''The ModelQueue of model file `path`, loaded on first use or when the file changed'''
+        filename = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, filename]) != self.root:
+            raise RequestError(400, 'model is outside of the server root')
+        if not os.path.isfile(filename):
+            raise RequestError(404, 'no model ' + path)
+        key = (filename, os.path.getmtime(filename))
+        if key in self.queues:
+            return self.queues[key]
+
+        # Concurrent first requests wait for the same load
+        if key not in self.loading:
+            loop = asyncio.get_running_loop()
+            self.loading[key] = loop.run_in_executor(self.executor, LoadedModel, filename)
+        try:
+            model = await self.loading[key]
+        finally:
+            self.loading.pop(key, None)
+        if key not in self.queues:
+            for old in [k for k in self.queues if k[0] == filename]:
+                del self.queues[old]
+            self.queues[key] = ModelQueue(model)
+        return self.queues[key]
+
+    async def disaggregate(self, path, mains):
+        '''Estimates of every appliance of model `path` at every sample of `mains`
+
+        Returns: array of shape (len(mains), appliances) in watts
+        '''
+        arrival = time.time()
+        queue = await self.model_queue(path)
+        mains = np.nan_to_num(np.asarray(mains, dtype=np.float32))
+        if len(mains) == 0:
+            return np.empty((0, queue.model.appliances), dtype=np.float32)
+
+        future = asyncio.get_running_loop().create_future()
+        queue.pending.append((model_rows(queue.model, mains), future))
+        queue.requests += 1
+        if not queue.running:
+            queue.running = True
+            asyncio.ensure_future(self._predict(queue))
+        pred = await future
+        queue.latencies.append(time.time() - arrival)
+        return model_estimates(queue.model, pred, len(mains))
+
+    async def _predict(self, queue):
+        '''Sends the waiting requests of `queue` to the model, until none are left
+
+        Requests arriving while a batch is predicted make up the next one.
+        A batch is predicted `max_rows` rows at a time.
+        '''
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.sleep(self.coalesce_delay)
+            while queue.pending:
+                batch, queue.pending = queue.pending, []
+                parts = [[] for _ in batch]
+                try:
+                    for block in row_blocks([r for r, _ in batch], self.max_rows):
+                        rows = np.concatenate([batch[i][0][a:b] for i, a, b in block])
+                        pred = await loop.run_in_executor(self.executor, queue.model.predict, rows, False)
+                        queue.batches += 1
+                        queue.rows += len(rows)
+                        start = 0
+                        for i, a, b in block:
+                            parts[i].append(pred[start:start+b-a])
+                            start += b - a
+                except Exception as e:
+                    for _, future in batch:
+                        future.set_exception(e)
+                    continue
+                for (_, future), part in zip(batch, parts):
+                    future.set_result(np.concatenate(part))
+        finally:
+            queue.running = False
+
+    def stats(self):
+        return {'uptime_s': time.time() - self.started,
+                'models': dict(('{} ({})'.format(os.path.relpath(f, self.root), time.ctime(m)), q.stats())
+                               for (f, m), q in self.queues.items())}
+
+    async def handle(self, reader, writer):
+        '''Serves the HTTP/1.1 requests of one connection'''
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode('latin-1').split()
+                except ValueError:
+                    await self._respond(writer, 400, {'error': 'bad request line'}, False)
+                    break
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+
+                try:
+                    length = int(headers.get('content-length', 0))
+                    if length > MAX_BODY:
+                        raise RequestError(413, 'request body too large')
+                    body = await reader.readexactly(length) if length else b''
+                    status, result = 200, await self.route(method, target, body)
+                except RequestError as e:
+                    status, result = e.status, {'error': str(e)}
+                except Exception as e:
+                    status, result = 500, {'error': repr(e)}
+                await self._respond(writer, status, result, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, target, body):
+        path = target.split('?', 1)[0]
+        if path == '/stats':
+            return self.stats()
+        if path != '/disaggregate':
+            raise RequestError(404, 'no such endpoint ' + path)
+        if method != 'POST':
+            raise RequestError(405, 'use POST')
+        try:
+            request = json.loads(body.decode('utf-8'))
+            model, mains = request['model'], request['mains']
+        except (ValueError, KeyError, TypeError):
+            raise RequestError(400, 'expected {"model": ..., "mains": [...]}')
+        mains = [np.nan if m is None else m for m in mains]
+        estimates = await self.disaggregate(model, mains)
+        return {'model': model, 'estimates': estimates.T.tolist()}
+
+    async def _respond(self, writer, status, result, keep_alive):
+        body = json.dumps(result).encode('utf-8')
+        head = ['HTTP/1.1 {} {}'.format(status, REASONS[status]),
+                'Content-Type: application/json',
+                'Content-Length: {}'.format(len(body)),
+                'Connection: ' + ('keep-alive' if keep_alive else 'close')]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def serve(self, host=HOST, port=PORT):
+        server = await asyncio.start_server(self.handle, host, port)
+        print('serving models under {} on http://{}:{}'.format(self.root, host, port))
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve exported disaggregator models over HTTP')
+    parser.add_argument('--root', default='.', help='directory the model paths are relative to')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=None, help='prediction threads')
+    parser.add_argument('--coalesce-delay', type=float, default=COALESCE_DELAY,
+                        help='seconds a request waits for others to the same model')
+    parser.add_argument('--max-rows', type=int, default=MAX_ROWS, help='model inputs predicted at once')
+    args = parser.parse_args()
+
+    server = DisaggregationServer(args.root, args.workers, args.coalesce_delay, args.max_rows)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,251 @@
+from __future__ import print_function, division
+
+# Distills a trained disaggregator (the teacher, an .h5 file from
+# export_model()) into a much smaller network (the student).  The teacher
+# disaggregates our mains, its outputs are the student's training targets,
+# so no appliance meter is needed and any amount of mains can be used.  The
+# student has the teacher's input and output shapes and is saved in the same
+# .h5 format with the teacher's mmax, so import_model() of the teacher's
+# disaggregator loads it and disaggregate() runs it unchanged.  compare()
+# measures both models' size, throughput and disagreement, and their error
+# against a real appliance meter if one is given.
+#
+# to run
+# python3 distillation.py WindowGRU/UKDALE-RNN-h1-kettle-15epochs.h5 kettle-student.h5 \
+#     --h5 ukdale.h5 --key /building1/elec/meter1 --meter-key /building1/elec/meter10 --units 16
+
+import os
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+import h5py
+from numpy.lib.stride_tricks import sliding_window_view
+
+from keras.models import Model, load_model
+from keras.layers import Input, Dense, Conv1D, GRU, Flatten
+
+UNITS = 32
+SAMPLE_PERIOD = 6
+CHUNKSIZE = 2**18
+PREDICT_BATCH = 1024
+
+
+class Teacher(object):
+    '''A model exported by a disaggregator and its mmax
+
+    Attributes
+    ----------
+    model : keras model
+    mmax : the maximum value of the aggregate data it was trained on
+    window_size : number of samples the model sees
+    sequence : the model outputs a value for every sample of its window
+        (DAE, or a seq2seq WindowGRU or ShortSeq2Point)
+    seq2seq : the model was exported by a seq2seq WindowGRU or ShortSeq2Point
+    appliances : number of appliances the model outputs
+    '''
+
+    def __init__(self, filename):
+        self.model = load_model(filename, compile=False)
+        with h5py.File(filename, 'r') as hf:
+            data = hf['disaggregator-data']
+            self.mmax = np.array(data['mmax'])[0]
+            self.seq2seq = 'seq2seq' in data and bool(np.array(data['seq2seq'])[0])
+        self.window_size = self.model.input_shape[1]
+        self.sequence = len(self.model.output_shape) == 3 or self.seq2seq
+        self.appliances = 1 if self.seq2seq else self.model.output_shape[-1]
+
+    def windows(self, mains):
+        '''Model inputs for the normalized 1d `mains`: the window ending at
+        every sample, or consecutive windows for a sequence model'''
+        w = self.window_size
+        mains = np.asarray(mains, dtype=np.float32)
+        if self.sequence:
+            return mains[:len(mains) - len(mains) % w].reshape(-1, w, 1)
+        return sliding_window_view(mains, w)[:, :, None]
+
+
+def student_model(teacher, units=UNITS):
+    '''A small model with the input and output shapes of `teacher`
+
+    RNN and GRU teachers (one sample in) get two Dense layers, sequence
+    teachers (DAE) two narrow same-padded convolutions, window teachers
+    (WindowGRU, ShortSeq2Point) a narrow convolution and a GRU.
+
+    Parameters
+    ----------
+    teacher : Teacher
+    units : width of the student's layers
+    '''
+    inputs = Input(shape=(teacher.window_size, 1))
+    if teacher.sequence:
+        x = Conv1D(units, 5, activation='relu', padding='same')(inputs)
+        x = Conv1D(units, 5, activation='relu', padding='same')(x)
+        outputs = Conv1D(teacher.appliances, 1, activation='linear')(x)
+    elif teacher.window_size == 1:
+        x = Flatten()(inputs)
+        x = Dense(units, activation='relu')(x)
+        x = Dense(units, activation='relu')(x)
+        outputs = Dense(teacher.appliances, activation='linear')(x)
+    else:
+        x = Conv1D(units // 2, 4, activation='relu', padding='same')(inputs)
+        x = GRU(units)(x)
+        outputs = Dense(teacher.appliances, activation='linear')(x)
+
+    model = Model(inputs, outputs)
+    model.compile(loss='mse', optimizer='adam')
+    return model
+
+
+def read_meter(h5_filename, key, sample_period=SAMPLE_PERIOD, chunksize=CHUNKSIZE):
+    '''Yields the first column of meter `key` resampled to `sample_period` seconds, chunk by chunk, as pd.Series
+
+    The rows of the last bin of a chunk are held back and resampled with the
+    next chunk, so a bin straddling two chunks comes out once.
+    '''
+    rule = pd.Timedelta(seconds=sample_period)
+    carry = None
+    with pd.HDFStore(h5_filename, 'r') as store:
+        for chunk in store.select(key, chunksize=chunksize):
+            series = chunk.iloc[:, 0].astype(np.float32)
+            if carry is not None:
+                series = pd.concat([carry, series])
+            if len(series) == 0:
+                continue
+            last = series.index[-1].floor(rule)
+            carry = series[series.index >= last]
+            done = series[series.index < last]
+            if len(done):
+                yield done.resample(rule, origin='epoch').mean()
+    if carry is not None and len(carry):
+        yield carry.resample(rule, origin='epoch').mean()
+
+
+def distill(teacher, mains, units=UNITS, epochs=5, batch_size=256, student=None):
+    '''Trains a student on the outputs of `teacher` over `mains`
+
+    Parameters
+    ----------
+    teacher : Teacher or .h5 filename written by export_model()
+    mains : iterable of chunks of aggregate watts (1d arrays or pd.Series),
+        e.g. read_meter() or an ElecMeter's power_series()
+    units : width of the student's layers
+    epochs : epochs trained on every chunk
+    batch_size : size of batch used for training
+    student : keras model to keep training, a new student_model() if None
+
+    Returns: the student keras model
+    '''
+    if not isinstance(teacher, Teacher):
+        teacher = Teacher(teacher)
+    if student is None:
+        student = student_model(teacher, units)
+
+    for chunk in mains:
+        chunk = np.nan_to_num(np.asarray(chunk, dtype=np.float32)) / teacher.mmax
+        X = teacher.windows(chunk)
+        if len(X) == 0:
+            continue
+        # The soft targets: what the teacher makes of these windows
+        Y = teacher.model.predict(X, batch_size=PREDICT_BATCH, verbose=0)
+        Y = Y.reshape((len(Y),) + tuple(student.output_shape[1:]))
+        student.fit(X, Y, epochs=epochs, batch_size=batch_size, shuffle=True)
+    return student
+
+
+def export_student(student, teacher, filename):
+    '''Saves the student like export_model() does, with the teacher's mmax'''
+    student.save(filename)
+    with h5py.File(filename, 'a') as hf:
+        gr = hf.create_group('disaggregator-data')
+        gr.create_dataset('mmax', data = [teacher.mmax])
+        if teacher.seq2seq:
+            gr.create_dataset('seq2seq', data = [1])
+
+
+def _throughput(model, X, sequence, repeats=3):
+    '''Best samples per second of model.predict over the windows `X`
+
+    `sequence` is Teacher.sequence of the model being distilled, true if
+    every window estimates all its samples. It is the teacher's for both
+    models, as a seq2seq teacher outputs (None, w) and its student
+    (None, w, 1), and so they are measured over the same samples.
+    '''
+    model.predict(X[:PREDICT_BATCH], batch_size=PREDICT_BATCH, verbose=0)
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        model.predict(X, batch_size=PREDICT_BATCH, verbose=0)
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    samples = X.shape[0] * (X.shape[1] if sequence else 1)
+    return samples / best
+
+
+def compare(teacher_filename, student_filename, mains, meter=None):
+    '''Size, speed and accuracy of a student next to its teacher
+
+    Parameters
+    ----------
+    teacher_filename, student_filename : .h5 files of the two models
+    mains : 1d array of aggregate watts to run both models on
+    meter : 1d array of the appliance's watts aligned with `mains`, or None
+
+    Returns: dict of 'teacher' and 'student' -> dict of measurements.
+        'mae_to_teacher' and 'mae' (against `meter`) are in watts at the
+        samples both models predict
+    '''
+    teacher = Teacher(teacher_filename)
+    X = teacher.windows(np.nan_to_num(np.asarray(mains, dtype=np.float32)) / teacher.mmax)
+    report, predictions = {}, {}
+    for name, filename in [('teacher', teacher_filename), ('student', student_filename)]:
+        model = teacher.model if name == 'teacher' else Teacher(filename).model
+        pred = model.predict(X, batch_size=PREDICT_BATCH, verbose=0).reshape(-1, teacher.appliances)
+        predictions[name] = np.maximum(pred, 0) * teacher.mmax
+        report[name] = {'parameters': int(model.count_params()),
+                        'weights_mb': sum(w.nbytes for w in model.get_weights()) / 2**20,
+                        'file_mb': os.path.getsize(filename) / 2**20,
+                        'samples_per_second': _throughput(model, X, teacher.sequence)}
+
+    # The estimates are for the last sample of every window, or for every
+    # sample of the consecutive windows of a sequence model
+    offset = 0 if teacher.sequence else teacher.window_size - 1
+    for name in report:
+        report[name]['mae_to_teacher'] = float(np.abs(predictions[name] - predictions['teacher']).mean())
+        if meter is not None:
+            truth = np.nan_to_num(np.asarray(meter, dtype=np.float32))[offset:offset + len(predictions[name])]
+            report[name]['mae'] = float(np.abs(predictions[name][:, 0] - truth).mean())
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Distill an exported disaggregator into a small student model')
+    parser.add_argument('teacher', help='.h5 file written by export_model()')
+    parser.add_argument('student', help='.h5 file the student is written to')
+    parser.add_argument('--h5', required=True, help='nilmtk h5 file with the mains')
+    parser.add_argument('--key', default='/building1/elec/meter1', help='mains meter to distill on')
+    parser.add_argument('--meter-key', help='appliance meter the accuracy is measured against')
+    parser.add_argument('--units', type=int, default=UNITS, help='width of the student layers')
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--sample-period', type=int, default=SAMPLE_PERIOD, help='seconds')
+    parser.add_argument('--holdout', type=int, default=2**16,
+                        help='samples at the end kept out of training for the comparison')
+    args = parser.parse_args()
+
+    teacher = Teacher(args.teacher)
+    mains = pd.concat(list(read_meter(args.h5, args.key, args.sample_period)))
+    train, held = mains.iloc[:-args.holdout], mains.iloc[-args.holdout:]
+    chunks = [train.iloc[i:i+CHUNKSIZE] for i in range(0, len(train), CHUNKSIZE)]
+
+    student = distill(teacher, chunks, args.units, args.epochs)
+    export_student(student, teacher, args.student)
+
+    meter = None
+    if args.meter_key:
+        meter = pd.concat(list(read_meter(args.h5, args.meter_key, args.sample_period)))
+        meter = meter.reindex(held.index).values
+    report = compare(args.teacher, args.student, held.values, meter)
+    for measurement in report['teacher']:
+        print('{:20} teacher {:>14.4f}   student {:>14.4f}'.format(
+            measurement, report['teacher'][measurement], report['student'][measurement]))
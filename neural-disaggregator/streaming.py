@@ -0,0 +1,352 @@
+from __future__ import print_function, division
+
+# Live disaggregation of 1 Hz feeds with the models exported by the
+# disaggregators of this folder (export_model(), the .h5 file with its
+# disaggregator-data/mmax).  disaggregate() of the disaggregators reads whole
+# chunks of an ElecMeter, here samples are pushed one at a time as they
+# arrive.  Every household keeps a ring buffer of its last window_size
+# samples, each pushed sample queues the window ending at it, and a worker
+# thread sends the queued windows of all households through the model in
+# one batch once max_batch of them are waiting or the oldest has waited
+# max_delay seconds.  An estimate is so emitted at most max_delay plus one
+# prediction after its sample arrived.  If samples arrive faster than the
+# model keeps up with, at most max_pending windows wait and the oldest are
+# dropped; an error of the model stops the worker and is raised to the
+# callers.
+#
+# to run, with "household,timestamp,watts" lines on stdin
+# python3 streaming.py fridge=WindowGRU/fridge.h5 kettle=ShortSeq2Point/kettle.h5 < feed.csv
+
+import sys
+import time
+import threading
+import argparse
+from collections import OrderedDict, deque
+
+import numpy as np
+import h5py
+
+from keras.models import load_model
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+MAX_BATCH = 256
+MAX_DELAY = 0.5     # seconds
+MAX_PENDING = 65536
+
+
+class LoadedModel(object):
+    '''A model exported by one of the disaggregators, ready for prediction
+
+    The model's input shape tells how it is fed: (1, 1) for RNN and GRU,
+    (window_size, 1) for the window models.  A model whose output is a
+    sequence (DAE, or WindowGRU and ShortSeq2Point exported with seq2seq)
+    is read at its last position, the one of the newest sample.
+
+    Attributes
+    ----------
+    model : keras model
+    mmax : the maximum value of the aggregate data the model was trained on
+    window_size : number of samples the model sees
+    appliances : number of appliances the model outputs
+    lookup, lookup_resolution : lookup table of RNN and GRU models, see
+        compile_lookup() of their disaggregators, or None
+    '''
+
+    def __init__(self, filename):
+        '''Loads the model and its mmax from an exported .h5 file
+
+        Parameters
+        ----------
+        filename : .h5 file written by export_model()
+        '''
+        self.model = load_model(filename, compile=False)
+        self.lookup, self.lookup_resolution = None, None
+        with h5py.File(filename, 'r') as hf:
+            data = hf['disaggregator-data']
+            self.mmax = np.array(data['mmax'])[0]
+            self.seq2seq = 'seq2seq' in data and bool(np.array(data['seq2seq'])[0])
+            if 'lookup' in data:
+                self.lookup = np.array(data['lookup'])
+                self.lookup_resolution = np.array(data['lookup_resolution'])[0]
+
+        self.window_size = self.model.input_shape[1]
+        # A seq2seq model's output has no appliance axis
+        self.sequence = len(self.model.output_shape) == 3 or self.seq2seq
+        self.appliances = 1 if self.seq2seq else self.model.output_shape[-1]
+
+    def predict(self, windows, last=True):
+        '''Appliance power at the last sample of every window
+
+        Parameters
+        ----------
+        windows : array of shape (n, window_size), aggregate watts
+        last : only return the last position of a sequence model, False
+            returns all of them, an array of shape (n, window_size, appliances)
+
+        Returns: array of shape (n, appliances) in watts
+        '''
+        X = np.asarray(windows, dtype=np.float32) / self.mmax
+        if self.lookup is not None:
+            pred = self._interpolate(X[:, -1])
+        else:
+            pred = self.model.predict_on_batch(X[:, :, None])
+            if self.sequence and last:
+                pred = pred[:, -1]
+            if not self.sequence or last:
+                pred = pred.reshape(len(X), -1)
+        pred = np.maximum(pred, 0) * self.mmax
+        return pred
+
+    def _interpolate(self, X):
+        '''Lookup table output of the normalized single samples `X`, the model outside its range'''
+        position = X * self.mmax / self.lookup_resolution
+        rows = np.arange(len(self.lookup))
+        inside = (position >= 0) & (position <= rows[-1])
+        pred = np.empty((len(X), self.appliances), dtype=np.float32)
+        for i in range(self.appliances):
+            pred[inside, i] = np.interp(position[inside], rows, self.lookup[:, i])
+        if not inside.all():
+            outside = X[~inside]
+            pred[~inside] = self.model.predict_on_batch(
+                outside.reshape(len(outside), 1, 1)).reshape(len(outside), -1)
+        return pred
+
+
+class Household(object):
+    '''Ring buffer of the last `size` samples of a household
+
+    Every sample is written twice, `size` apart, so the newest window is
+    always one contiguous slice of the buffer.  The buffer starts out
+    zero, the first samples are disaggregated as if the house had been
+    off before them instead of waiting for a full window.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = np.zeros(2 * size, dtype=np.float32)
+        self.position = 0
+
+    def append(self, watts):
+        self.buffer[self.position] = watts
+        self.buffer[self.position + self.size] = watts
+        self.position = (self.position + 1) % self.size
+
+    def window(self, length):
+        '''Copy of the newest `length` samples, oldest first'''
+        end = self.position + self.size
+        return self.buffer[end - length:end].copy()
+
+
+class _Failure(object):
+    '''An exception raised by the worker thread, put on `estimates` for the callers waiting there'''
+
+    def __init__(self, error):
+        self.error = error
+
+
+class StreamingDisaggregator(object):
+    '''Disaggregates live samples of many households with micro-batched predictions
+
+    Attributes
+    ----------
+    models : OrderedDict of appliance name -> LoadedModel
+    max_batch : number of waiting windows that triggers a prediction
+    max_delay : seconds a window waits at most before it is predicted
+    max_pending : number of windows waiting at most, the oldest are dropped
+        beyond it
+    callback : called as callback(household, timestamp, estimates) from
+        the worker thread, estimates is a dict of appliance name -> watts.
+        If None the calls' arguments are put on `estimates` instead
+    estimates : queue.Queue of (household, timestamp, estimates), read it
+        with get() to see errors of the worker
+    dropped : number of windows dropped because max_pending were waiting
+    error : the exception that stopped the worker thread, or None
+    '''
+
+    def __init__(self, models, max_batch=MAX_BATCH, max_delay=MAX_DELAY, callback=None, max_pending=MAX_PENDING):
+        '''
+        Parameters
+        ----------
+        models : dict of appliance name -> LoadedModel or .h5 filename. A
+            model with several outputs gives the appliances name:0, name:1, ...
+        max_batch : number of waiting windows that triggers a prediction
+        max_delay : seconds a window waits at most before it is predicted
+        callback : function(household, timestamp, estimates), or None
+        max_pending : number of windows waiting at most, at least max_batch
+        '''
+        self.models = OrderedDict()
+        for name in models:
+            model = models[name]
+            self.models[name] = model if isinstance(model, LoadedModel) else LoadedModel(model)
+        self.window_size = max(m.window_size for m in self.models.values())
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.callback = callback
+        self.max_pending = max(max_pending, max_batch)
+        self.estimates = queue.Queue()
+        self.dropped = 0
+        self.error = None
+
+        self.households = {}
+        self.pending = deque()   # (arrival, household, timestamp, window)
+        self.condition = threading.Condition()
+        self.running = False
+        self.worker = None
+
+    def start(self):
+        '''Starts the worker thread'''
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def stop(self):
+        '''Predicts the windows still waiting and stops the worker thread
+
+        Raises the error that stopped the worker, if any.
+        '''
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+        self._raise()
+        self.flush()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def push(self, household, timestamp, watts):
+        '''Adds one aggregate sample of `household`
+
+        Parameters
+        ----------
+        household : any hashable id of the household
+        timestamp : time of the sample, handed back with its estimates
+        watts : aggregate power, NaN is taken as 0 like in disaggregate()
+
+        Raises the error that stopped the worker thread, if any.
+        '''
+        self._raise()
+        if watts != watts:
+            watts = 0
+        with self.condition:
+            buffer = self.households.get(household)
+            if buffer is None:
+                buffer = self.households[household] = Household(self.window_size)
+            buffer.append(watts)
+            if len(self.pending) >= self.max_pending:
+                # The model can't keep up, the stalest estimate is given up
+                self.pending.popleft()
+                self.dropped += 1
+            self.pending.append((time.time(), household, timestamp, buffer.window(self.window_size)))
+            # The first waiting window starts the worker's max_delay timer
+            if len(self.pending) == 1 or len(self.pending) >= self.max_batch:
+                self.condition.notify()
+
+    def get(self, timeout=None):
+        '''Takes the next (household, timestamp, estimates) off `estimates`
+
+        Raises the error that stopped the worker thread instead, and
+        queue.Empty if nothing arrived within `timeout` seconds.
+        '''
+        item = self.estimates.get(timeout=timeout)
+        if isinstance(item, _Failure):
+            # Left on the queue for the other callers waiting on it
+            self.estimates.put(item)
+            raise item.error
+        return item
+
+    def flush(self):
+        '''Predicts every waiting window now, in the calling thread'''
+        with self.condition:
+            batch, self.pending = list(self.pending), deque()
+        self._predict(batch)
+
+    def _raise(self):
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and len(self.pending) < self.max_batch:
+                    if self.pending:
+                        wait = self.pending[0][0] + self.max_delay - time.time()
+                        if wait <= 0:
+                            break
+                        self.condition.wait(wait)
+                    else:
+                        self.condition.wait()
+                if not self.running:
+                    return
+                batch = [self.pending.popleft() for _ in range(min(self.max_batch, len(self.pending)))]
+            try:
+                self._predict(batch)
+            except Exception as e:
+                print("Streaming worker stopped: {!r}".format(e), file=sys.stderr)
+                with self.condition:
+                    self.error = e
+                    self.running = False
+                self.estimates.put(_Failure(e))
+                return
+
+    def _predict(self, batch):
+        '''Runs every model once over the windows of `batch` and emits the estimates'''
+        if not batch:
+            return
+        windows = np.stack([window for _, _, _, window in batch])
+        columns = []
+        for name, model in self.models.items():
+            pred = model.predict(windows[:, self.window_size - model.window_size:])
+            if model.appliances == 1:
+                columns.append((name, pred[:, 0]))
+            else:
+                columns.extend(('{}:{}'.format(name, i), pred[:, i]) for i in range(model.appliances))
+
+        for row, (_, household, timestamp, _) in enumerate(batch):
+            estimates = OrderedDict((name, float(pred[row])) for name, pred in columns)
+            if self.callback is None:
+                self.estimates.put((household, timestamp, estimates))
+            else:
+                self.callback(household, timestamp, estimates)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Disaggregate "household,timestamp,watts" lines read from stdin')
+    parser.add_argument('models', nargs='+', help='appliance=model.h5, a file exported by export_model()')
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--max-delay', type=float, default=MAX_DELAY, help='seconds')
+    parser.add_argument('--max-pending', type=int, default=MAX_PENDING,
+                        help='windows waiting at most, the oldest are dropped beyond')
+    args = parser.parse_args()
+
+    models = OrderedDict(m.split('=', 1) for m in args.models)
+    lock = threading.Lock()
+
+    def show(household, timestamp, estimates):
+        with lock:
+            print(','.join([str(household), str(timestamp)] + ['{}={:.1f}'.format(n, w) for n, w in estimates.items()]))
+            sys.stdout.flush()
+
+    with StreamingDisaggregator(models, args.max_batch, args.max_delay, show, args.max_pending) as stream:
+        for line in sys.stdin:
+            fields = line.strip().split(',')
+            if len(fields) != 3:
+                continue
+            try:
+                stream.push(fields[0], fields[1], float(fields[2]))
+            except ValueError:
+                continue